@@ -137,6 +137,15 @@ export const api = {
       method: 'POST',
       body: JSON.stringify({ backup_name: backupName }),
     }),
+
+  // Backup and restore run as jobs: poll for progress, or cancel
+  getJob: (jobId) =>
+    apiCall(`${API_ENDPOINTS.JOBS}/${jobId}`),
+
+  cancelJob: (jobId) =>
+    apiCall(`${API_ENDPOINTS.JOBS}/${jobId}/cancel`, {
+      method: 'POST',
+    }),
 };
 
 export default api;
@@ -8,6 +8,7 @@ export const API_ENDPOINTS = {
   DOWNLOAD: '/download',
   BACKUP: '/backup',
   RESTORE: '/restore',
+  JOBS: '/jobs',
 };
 
 export default API_BASE_URL;
@@ -1,8 +1,12 @@
 # main.py — Flask app factory + routes
 import os
 import sys
+import json
+import time
 import base64
-from flask import Flask, request, jsonify
+import threading
+from urllib.parse import unquote
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 
@@ -14,7 +18,11 @@ try:
     # Try relative imports first (when imported as a module)
     from .utils.logger import log_info, log_error
     from .utils.auth import is_authenticated, get_user_id
-    from .utils.storage_factory import storage
+    from .utils.storage_factory import storage, USE_S3
+    from .utils.http_range import send_object
+    from .utils.streams import LimitedStream
+    from .utils import backups, fs_indexer, jobs
+    from .transfer_app import register_transfer_routes
     from .services.cognito_auth_service import (
         signup_user, login_user, refresh_user_token, 
         token_required, get_user_storage, update_user_storage, get_user_info
@@ -23,20 +31,89 @@ except ImportError:
     # Fall back to absolute imports (when run directly)
     from utils.logger import log_info, log_error
     from utils.auth import is_authenticated, get_user_id
-    from utils.storage_factory import storage
+    from utils.storage_factory import storage, USE_S3
+    from utils.http_range import send_object
+    from utils.streams import LimitedStream
+    from utils import backups, fs_indexer, jobs
+    from transfer_app import register_transfer_routes
     from services.cognito_auth_service import (
         signup_user, login_user, refresh_user_token,
         token_required, get_user_storage, update_user_storage, get_user_info
     )
 
+def _ndjson_listing(prefix):
+    # one JSON object per line as the adapter produces entries; the final
+    # line lets clients tell a complete listing from a dropped connection
+    count = 0
+    for entry in storage.iter_listing(prefix):
+        count += 1
+        yield json.dumps(entry, separators=(",", ":")) + "\n"
+    yield json.dumps({"done": True, "file_count": count}) + "\n"
+
+def _user_file_path(user_id, filename):
+    # sanitize filename (simple) and scope it to the user's folder
+    filename = filename.replace("..", "").lstrip("/")
+    return f"{user_id}/{filename}"
+
+# S3 presigned PUTs never pass through us, so each is charged to its owner's
+# quota the first time the object is seen: email -> [(path, issued_at, expires_at)]
+_presigned_puts = {}
+_presigned_lock = threading.Lock()
+
+def _run_restore(user_id, params, progress):
+    # restores into a target folder add new files, so they are charged to
+    # the quota of "charge_to" as they are written
+    params = dict(params)
+    email = params.pop("charge_to", None)
+    if email is None:
+        return storage.restore_from_manifest(user_id, progress=progress, **params)
+    storage_info = get_user_storage(email)
+    return storage.restore_from_manifest(
+        user_id, progress=progress, **params,
+        max_bytes=storage_info['limit'] - storage_info['used'] if storage_info else None,
+        on_written=lambda size: update_user_storage(email, size))
+
+
+def _user_storage(email):
+    # get_user_storage, after charging any presigned uploads that have landed
+    with _presigned_lock:
+        pending = _presigned_puts.pop(email, [])
+    waiting = []
+    for path, issued_at, expires_at in pending:
+        info = storage.stat_file(path)
+        # LastModified has 1s granularity on S3
+        if info is not None and info["last_modified"].timestamp() >= int(issued_at):
+            update_user_storage(email, info["size"])
+        elif time.time() < expires_at:
+            waiting.append((path, issued_at, expires_at))
+    if waiting:
+        with _presigned_lock:
+            _presigned_puts.setdefault(email, []).extend(waiting)
+    return get_user_storage(email)
+
 def create_app():
     app = Flask(__name__)
     
     # Enable CORS for all routes, allowing requests from localhost:3000 and 3001
     CORS(app, resources={r"/*": {"origins": ["http://localhost:3000", "http://127.0.0.1:3000", "http://localhost:3001", "http://127.0.0.1:3001"]}},
          supports_credentials=True,
-         allow_headers=["Content-Type", "Authorization", "X-User-ID"],
-         methods=["GET", "POST", "OPTIONS"])
+         allow_headers=["Content-Type", "Authorization", "X-User-ID", "X-Filename"],
+         expose_headers=["Content-Range", "Accept-Ranges", "Content-Length", "ETag"],
+         methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
+
+    register_transfer_routes(app)
+    if not USE_S3:
+        fs_indexer.start_if_enabled()
+    jobs.register("backup", lambda user_id, params, progress: storage.create_backup_manifest(
+        user_id, progress=progress, **params), exclusive=True)
+    jobs.register("restore", _run_restore, exclusive=True)
+    jobs.register("scrub", lambda user_id, params, progress: backups.scrub(
+        storage, user_id, progress=progress, **params))
+    jobs.register("delete", lambda user_id, params, progress: backups.delete_snapshot(
+        storage, user_id, params["backup_name"]), exclusive=True)
+    jobs.register("prune", lambda user_id, params, progress: backups.prune(storage, user_id, **params),
+                  exclusive=True)
+    jobs.start_workers()
 
     @app.route("/health", methods=["GET"])
     def health():
@@ -192,7 +269,7 @@ def create_app():
 
         # Check storage limit
         file_size = len(content_bytes)
-        storage_info = get_user_storage(email)
+        storage_info = _user_storage(email)
         if storage_info and (storage_info['used'] + file_size > storage_info['limit']):
             return jsonify({
                 "status": "error",
@@ -200,10 +277,7 @@ def create_app():
                 "storage": storage_info
             }), 400
 
-        # sanitize filename (simple)
-        filename = filename.replace("..", "").lstrip("/")
-
-        path = f"{user_id}/{filename}"
+        path = _user_file_path(user_id, filename)
         meta = storage.save_file(path, content_bytes)
         
         # Update storage used
@@ -217,6 +291,147 @@ def create_app():
             "storage": updated_storage
         }), 200
 
+    @app.route("/files/upload/stream", methods=["POST", "PUT"])
+    @token_required
+    def upload_stream():
+        # raw (application/octet-stream) or multipart upload, streamed to storage
+        email = request.current_user.get('email')
+        user_id = request.current_user.get('user_id')
+
+        if request.mimetype == "multipart/form-data":
+            upload = request.files.get("file")
+            if upload is None:
+                return jsonify({"status": "error", "message": "file field required"}), 400
+            filename = request.form.get("filename") or upload.filename
+            stream = upload.stream
+        else:
+            filename = request.args.get("filename") or unquote(request.headers.get("X-Filename", ""))
+            stream = request.stream
+
+        if not filename:
+            return jsonify({"status": "error", "message": "filename required"}), 400
+
+        # Check storage limit against the declared size before reading the body,
+        # and cap the body at what is left, since chunked uploads declare none
+        declared_size = request.content_length or 0
+        storage_info = _user_storage(email)
+        if storage_info and (storage_info['used'] + declared_size > storage_info['limit']):
+            return jsonify({
+                "status": "error",
+                "message": "Storage limit exceeded",
+                "storage": storage_info
+            }), 400
+
+        path = _user_file_path(user_id, filename)
+        try:
+            meta = storage.save_stream(path, LimitedStream(stream, storage_info['limit'] - storage_info['used']))
+        except ValueError:
+            return jsonify({
+                "status": "error",
+                "message": "Storage limit exceeded",
+                "storage": storage_info
+            }), 400
+
+        file_size = meta["size"]
+        update_user_storage(email, file_size)
+        updated_storage = get_user_storage(email)
+
+        log_info("file uploaded (stream)", user=user_id, path=path, size=file_size)
+        return jsonify({
+            "status": "success",
+            "file": meta,
+            "storage": updated_storage
+        }), 200
+
+    # Resumable uploads: initiate, PUT numbered chunks (any order, in
+    # parallel), poll received ranges, then commit
+    def _owned_upload_session(session_id, user_id):
+        session = storage.get_upload_session(session_id)
+        if session is None or session["user_id"] != user_id:
+            return None
+        return session
+
+    @app.route("/files/uploads", methods=["POST"])
+    @token_required
+    def create_upload_session():
+        email = request.current_user.get('email')
+        user_id = request.current_user.get('user_id')
+        data = request.get_json(silent=True) or {}
+        filename = data.get("filename")
+        try:
+            total_size = int(data.get("size"))
+        except (TypeError, ValueError):
+            total_size = None
+        if not filename or total_size is None:
+            return jsonify({"status": "error", "message": "filename and size required"}), 400
+
+        storage_info = _user_storage(email)
+        if storage_info and (storage_info['used'] + total_size > storage_info['limit']):
+            return jsonify({
+                "status": "error",
+                "message": "Storage limit exceeded",
+                "storage": storage_info
+            }), 400
+
+        try:
+            session = storage.create_upload_session(user_id, _user_file_path(user_id, filename),
+                                                    total_size, data.get("chunk_size"))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify({"status": "success", "session": session}), 201
+
+    @app.route("/files/uploads/<session_id>", methods=["GET"])
+    @token_required
+    def get_upload_session(session_id):
+        session = _owned_upload_session(session_id, request.current_user.get('user_id'))
+        if session is None:
+            return jsonify({"status": "error", "message": "upload session not found"}), 404
+        return jsonify({"status": "success", "session": session}), 200
+
+    @app.route("/files/uploads/<session_id>/chunks/<int:index>", methods=["PUT"])
+    @token_required
+    def put_upload_chunk(session_id, index):
+        if _owned_upload_session(session_id, request.current_user.get('user_id')) is None:
+            return jsonify({"status": "error", "message": "upload session not found"}), 404
+        try:
+            session = storage.put_upload_chunk(session_id, index, request.stream)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        if session is None:
+            return jsonify({"status": "error", "message": "upload session not found"}), 404
+        return jsonify({"status": "success", "session": session}), 200
+
+    @app.route("/files/uploads/<session_id>/commit", methods=["POST"])
+    @token_required
+    def commit_upload_session(session_id):
+        email = request.current_user.get('email')
+        user_id = request.current_user.get('user_id')
+        if _owned_upload_session(session_id, user_id) is None:
+            return jsonify({"status": "error", "message": "upload session not found"}), 404
+        try:
+            meta = storage.commit_upload_session(session_id)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 409
+        if meta is None:
+            # expired, aborted, or committed by a concurrent request
+            return jsonify({"status": "error", "message": "upload session not found"}), 404
+
+        update_user_storage(email, meta["size"])
+        log_info("file uploaded (session)", user=user_id, path=meta["path"], size=meta["size"])
+        return jsonify({
+            "status": "success",
+            "file": meta,
+            "storage": get_user_storage(email)
+        }), 200
+
+    @app.route("/files/uploads/<session_id>", methods=["DELETE"])
+    @token_required
+    def abort_upload_session(session_id):
+        if _owned_upload_session(session_id, request.current_user.get('user_id')) is None:
+            return jsonify({"status": "error", "message": "upload session not found"}), 404
+        storage.abort_upload_session(session_id)
+        return jsonify({"status": "success"}), 200
+
     @app.route("/files/list", methods=["POST"])
     @app.route("/list", methods=["POST"])
     @token_required
@@ -229,9 +444,12 @@ def create_app():
         
         data = request.get_json(silent=True) or {}
         user_path = data.get("user_path") or user_id
-        
+
+        if request.args.get("format") == "ndjson" or "application/x-ndjson" in request.headers.get("Accept", ""):
+            return Response(stream_with_context(_ndjson_listing(user_path)), mimetype="application/x-ndjson")
+
         files = storage.list_files(user_path)
-        storage_info = get_user_storage(email)
+        storage_info = _user_storage(email)
         
         print(f"[DEBUG] list_files - Found {len(files)} files, storage: {storage_info}")  # Debug
         
@@ -243,6 +461,53 @@ def create_app():
             "storage": storage_info
         }), 200
 
+    @app.route("/files/browse", methods=["GET"])
+    @token_required
+    def browse_files():
+        # one page of one folder: ?path=docs/&delimiter=/&limit=200&cursor=...
+        user_id = request.current_user.get('user_id')
+        folder = request.args.get("path", "").replace("..", "").lstrip("/")
+        if folder and not folder.endswith("/"):
+            folder += "/"
+        delimiter = request.args.get("delimiter", "/") or None
+        try:
+            page = storage.list_page(f"{user_id}/{folder}", delimiter=delimiter,
+                                     limit=request.args.get("limit", type=int), cursor=request.args.get("cursor"))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify({
+            "status": "success",
+            "path": folder,
+            "files": page["files"],
+            "folders": [{"name": p[len(user_id) + 1 + len(folder):].rstrip(delimiter or ""), "path": p}
+                        for p in page["folders"]],
+            "next_cursor": page["next_cursor"]
+        }), 200
+
+    @app.route("/files/search", methods=["GET"])
+    @token_required
+    def search_files():
+        # ?q=report&ext=pdf&match=substring|prefix&limit=50&cursor=...
+        user_id = request.current_user.get('user_id')
+        query = request.args.get("q", "").strip()
+        ext = request.args.get("ext", "").strip()
+        match = request.args.get("match", "substring")
+        if not query and not ext:
+            return jsonify({"status": "error", "message": "q or ext required"}), 400
+        if match not in ("substring", "prefix"):
+            return jsonify({"status": "error", "message": "match must be substring or prefix"}), 400
+        try:
+            page = storage.search_files(user_id, query, ext=ext or None, match=match,
+                                        limit=request.args.get("limit", type=int), cursor=request.args.get("cursor"))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify({
+            "status": "success",
+            "query": query,
+            "files": page["files"],
+            "next_cursor": page["next_cursor"]
+        }), 200
+
     @app.route("/files/download", methods=["POST"])
     @app.route("/download", methods=["POST"])
     @token_required
@@ -257,24 +522,297 @@ def create_app():
         b64 = base64.b64encode(content).decode("utf-8")
         return jsonify({"status":"success","filename": filename, "content": b64, "encoding": "base64", "size": len(content)}), 200
 
+    @app.route("/files/download/raw", methods=["GET"])
+    @token_required
+    def download_raw():
+        # binary download with Range/If-Range support (video seeking, resumed downloads)
+        user_id = request.current_user.get('user_id')
+        filename = request.args.get("filename")
+        if not filename:
+            return jsonify({"status":"error","message":"filename required"}), 400
+        if filename.startswith(f"{user_id}/"):
+            filename = filename[len(user_id) + 1:]
+        path = _user_file_path(user_id, filename)
+        resp = send_object(storage, path, as_attachment=request.args.get("attachment") == "1")
+        if resp is None:
+            return jsonify({"status":"error","message":"file not found"}), 404
+        return resp
+
+    @app.route("/files/presign", methods=["POST"])
+    @token_required
+    def presign():
+        # short-lived direct transfer URL so bytes bypass this worker
+        email = request.current_user.get('email')
+        user_id = request.current_user.get('user_id')
+        data = request.get_json(silent=True) or {}
+        filename = data.get("filename")
+        method = (data.get("method") or "GET").upper()
+        if not filename or method not in ("GET", "PUT"):
+            return jsonify({"status": "error", "message": "filename and method GET or PUT required"}), 400
+        if filename.startswith(f"{user_id}/"):
+            filename = filename[len(user_id) + 1:]
+        path = _user_file_path(user_id, filename)
+
+        size = None
+        if method == "PUT":
+            try:
+                size = int(data.get("size"))
+            except (TypeError, ValueError):
+                return jsonify({"status": "error", "message": "size required for PUT"}), 400
+            # charged once the upload lands: by the transfer handler locally,
+            # on S3 by _user_storage when it first sees the object
+            storage_info = _user_storage(email)
+            if storage_info and (storage_info['used'] + size > storage_info['limit']):
+                return jsonify({
+                    "status": "error",
+                    "message": "Storage limit exceeded",
+                    "storage": storage_info
+                }), 400
+        elif storage.stat_file(path) is None:
+            return jsonify({"status": "error", "message": "file not found"}), 404
+
+        signed = storage.presign_url(path, method, data.get("expires_in"), size,
+                                    owner=email if method == "PUT" else None)
+        if method == "PUT" and USE_S3:
+            with _presigned_lock:
+                _presigned_puts.setdefault(email, []).append((path, time.time(), signed["expires_at"]))
+        if signed["url"].startswith("/"):
+            signed["url"] = request.host_url.rstrip("/") + signed["url"]
+        if size is not None:
+            signed["headers"] = {"Content-Length": str(size)}
+        return jsonify({"status": "success", "path": path, **signed}), 200
+
     @app.route("/backup", methods=["POST"])
     @token_required
-    def backup(email):
-        user_id = get_user_storage(email)['user_id']
+    def backup():
+        # queues the snapshot and returns its job at once; poll /jobs/<id>.
+        # mode: "auto" (incremental, periodically full), "full", "incremental"
+        # or "archive" (standalone tar+zstd)
+        user_id = request.current_user.get('user_id')
         data = request.get_json(silent=True) or {}
         backup_name = data.get("backup_name")
-        manifest_meta = storage.create_backup_manifest(user_id, backup_name=backup_name)
-        return jsonify({"status":"success","backup_name": manifest_meta.get("name"), "manifest": manifest_meta}), 200
+        mode = data.get("mode", "auto")
+        if mode not in backups.MODES:
+            return jsonify({"status": "error", "message": f"mode must be one of {', '.join(backups.MODES)}"}), 400
+        if backup_name:
+            try:
+                backups.check_name(backup_name)
+            except ValueError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+        if backup_name and any(s["name"] == backup_name for s in backups.load_index(storage, user_id)):
+            return jsonify({"status": "error", "message": f"backup {backup_name!r} already exists"}), 400
+        job = jobs.submit(user_id, "backup", {"backup_name": backup_name, "mode": mode})
+        return jsonify({"status": "success", "job": job}), 202
+
+    @app.route("/backup/schedule", methods=["GET", "PUT", "DELETE"])
+    @token_required
+    def backup_schedule():
+        # recurring backups: every interval_hours from "at" (UTC, HH:MM),
+        # each run starting at a random point within jitter_minutes
+        user_id = request.current_user.get('user_id')
+        if request.method == "DELETE":
+            if not jobs.delete_schedule(user_id, "backup"):
+                return jsonify({"status": "error", "message": "no backup schedule"}), 404
+            return jsonify({"status": "success"}), 200
+        if request.method == "GET":
+            schedule = jobs.get_schedule(user_id, "backup")
+            if schedule is None:
+                return jsonify({"status": "error", "message": "no backup schedule"}), 404
+            return jsonify({"status": "success", "schedule": schedule}), 200
+        data = request.get_json(silent=True) or {}
+        mode = data.get("mode", "auto")
+        if mode not in backups.MODES:
+            return jsonify({"status": "error", "message": f"mode must be one of {', '.join(backups.MODES)}"}), 400
+        try:
+            schedule = jobs.set_schedule(user_id, "backup", {"backup_name": None, "mode": mode},
+                                         at=data.get("at", "02:00"), interval_hours=data.get("interval_hours", 24),
+                                         jitter_minutes=data.get("jitter_minutes", 60))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify({"status": "success", "schedule": schedule}), 200
+
+    @app.route("/backups", methods=["GET"])
+    @token_required
+    def list_backups():
+        user_id = request.current_user.get('user_id')
+        return jsonify({"status": "success", "backups": backups.load_index(storage, user_id)}), 200
+
+    @app.route("/backups/<backup_name>", methods=["DELETE"])
+    @token_required
+    def delete_backup(backup_name):
+        # queues the delete, which may rewrite later snapshots and so runs
+        # as an exclusive job; freed blobs go on the gc queue
+        user_id = request.current_user.get('user_id')
+        if not any(s["name"] == backup_name for s in backups.load_index(storage, user_id)):
+            return jsonify({"status": "error", "message": f"backup {backup_name!r} not found"}), 404
+        job = jobs.submit(user_id, "delete", {"backup_name": backup_name})
+        return jsonify({"status": "success", "job": job}), 202
+
+    @app.route("/backups/gc", methods=["POST"])
+    @token_required
+    def backup_gc():
+        # one bounded gc batch; call again until cycle_finished
+        user_id = request.current_user.get('user_id')
+        data = request.get_json(silent=True) or {}
+        try:
+            budget = int(data.get("budget") or 0) or None
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "budget must be an integer"}), 400
+        return jsonify({"status": "success", **backups.gc_step(storage, user_id, budget)}), 200
+
+    @app.route("/backups/retention", methods=["GET", "PUT", "DELETE"])
+    @token_required
+    def backup_retention():
+        # keep the newest snapshot of the last N days/weeks/months; PUT also
+        # schedules the daily pruner, which deletes what the policy drops
+        user_id = request.current_user.get('user_id')
+        if request.method == "DELETE":
+            jobs.delete_schedule(user_id, "prune")
+            if not backups.delete_retention(storage, user_id):
+                return jsonify({"status": "error", "message": "no retention policy"}), 404
+            return jsonify({"status": "success"}), 200
+        if request.method == "GET":
+            policy = backups.load_retention(storage, user_id)
+            if policy is None:
+                return jsonify({"status": "error", "message": "no retention policy"}), 404
+            return jsonify({"status": "success", "retention": policy,
+                            "schedule": jobs.get_schedule(user_id, "prune")}), 200
+        data = request.get_json(silent=True) or {}
+        try:
+            # a prune without a policy keeps everything, so scheduling first is harmless
+            schedule = jobs.set_schedule(user_id, "prune", {}, at=data.get("at", "04:00"), interval_hours=24,
+                                         jitter_minutes=data.get("jitter_minutes", 60))
+            policy = backups.set_retention(storage, user_id, data.get("daily"), data.get("weekly"),
+                                           data.get("monthly"))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify({"status": "success", "retention": policy, "schedule": schedule}), 200
+
+    @app.route("/backups/prune", methods=["POST"])
+    @token_required
+    def backup_prune():
+        # dry_run answers straight from the index; otherwise queues a prune now
+        user_id = request.current_user.get('user_id')
+        if backups.load_retention(storage, user_id) is None:
+            return jsonify({"status": "error", "message": "no retention policy"}), 404
+        if (request.get_json(silent=True) or {}).get("dry_run"):
+            return jsonify({"status": "success", **backups.prune(storage, user_id, dry_run=True)}), 200
+        job = jobs.submit(user_id, "prune", {})
+        return jsonify({"status": "success", "job": job}), 202
+
+    @app.route("/backups/scrub", methods=["GET", "POST"])
+    @token_required
+    def backup_scrub():
+        # POST queues a verification of one snapshot (backup_name) or of every
+        # backup; GET returns the last report
+        user_id = request.current_user.get('user_id')
+        if request.method == "GET":
+            try:
+                report = backups.load_scrub_report(storage, user_id, request.args.get("backup_name"))
+            except ValueError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+            if report is None:
+                return jsonify({"status": "error", "message": "no scrub report"}), 404
+            return jsonify({"status": "success", "report": report}), 200
+        backup_name = (request.get_json(silent=True) or {}).get("backup_name")
+        if backup_name and not any(s["name"] == backup_name for s in backups.load_index(storage, user_id)):
+            return jsonify({"status": "error", "message": f"backup {backup_name!r} not found"}), 404
+        job = jobs.submit(user_id, "scrub", {"backup_name": backup_name})
+        return jsonify({"status": "success", "job": job}), 202
+
+    @app.route("/backups/diff", methods=["GET"])
+    @token_required
+    def backup_diff():
+        # what changed since snapshot backup_name: up to snapshot "against",
+        # or up to the live files without it
+        user_id = request.current_user.get('user_id')
+        backup_name = request.args.get("backup_name")
+        if not backup_name:
+            return jsonify({"status": "error", "message": "backup_name required"}), 400
+        try:
+            changes = backups.compare_snapshot(storage, user_id, backup_name, request.args.get("against"))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 404
+        return jsonify({"status": "success", **changes}), 200
+
+    @app.route("/backups/file", methods=["GET"])
+    @token_required
+    def backup_file():
+        # one file out of a snapshot without restoring it; for archive
+        # snapshots this is a single ranged read of the archive
+        user_id = request.current_user.get('user_id')
+        backup_name = request.args.get("backup_name")
+        filename = request.args.get("filename")
+        if not backup_name or not filename:
+            return jsonify({"status": "error", "message": "backup_name and filename required"}), 400
+        if filename.startswith(f"{user_id}/"):
+            filename = filename[len(user_id) + 1:]
+        try:
+            entry, chunks = backups.open_file(storage, user_id, backup_name, _user_file_path(user_id, filename))
+        except (ValueError, FileNotFoundError) as e:
+            return jsonify({"status": "error", "message": str(e)}), 404
+        if entry is None:
+            return jsonify({"status": "error", "message": "file not in backup"}), 404
+        return Response(stream_with_context(chunks), mimetype="application/octet-stream", headers={
+            "Content-Length": str(entry["size"]),
+            "Content-Disposition": f'attachment; filename="{os.path.basename(entry["path"])}"'
+        })
 
     @app.route("/restore", methods=["POST"])
     @token_required
-    def restore(email):
+    def restore():
+        # queues a restore of the caller's own snapshot, in place or under
+        # "target"; repeating an interrupted restore resumes it
+        user_id = request.current_user.get('user_id')
         data = request.get_json(silent=True) or {}
         backup_name = data.get("backup_name")
         if not backup_name:
             return jsonify({"status":"error","message":"backup_name required"}), 400
-        result = storage.restore_from_manifest(backup_name)
-        return jsonify({"status":"success", **result}), 200
+        try:
+            target = backups.check_target(data.get("target"))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        if not any(s["name"] == backup_name for s in backups.load_index(storage, user_id)):
+            return jsonify({"status": "error", "message": f"backup {backup_name!r} not found"}), 404
+        params = {"backup_name": backup_name, "target": target}
+        if target:
+            # a copy beside the live tree takes new space: check it now, and
+            # have the job charge what it writes
+            email = request.current_user.get('email')
+            storage_info = _user_storage(email)
+            needed = backups.restore_size(storage, user_id, backup_name, target)
+            if storage_info and storage_info['used'] + needed > storage_info['limit']:
+                return jsonify({
+                    "status": "error",
+                    "message": "Storage limit exceeded",
+                    "storage": storage_info
+                }), 400
+            params["charge_to"] = email
+        job = jobs.submit(user_id, "restore", params)
+        return jsonify({"status": "success", "job": job}), 202
+
+    @app.route("/jobs", methods=["GET"])
+    @token_required
+    def list_jobs():
+        user_id = request.current_user.get('user_id')
+        return jsonify({"status": "success", "jobs": jobs.list_jobs(user_id)}), 200
+
+    @app.route("/jobs/<job_id>", methods=["GET"])
+    @token_required
+    def get_job(job_id):
+        # status, progress (files/bytes done of total) and, once finished, result or error
+        job = jobs.get(job_id, request.current_user.get('user_id'))
+        if job is None:
+            return jsonify({"status": "error", "message": "job not found"}), 404
+        return jsonify({"status": "success", "job": job}), 200
+
+    @app.route("/jobs/<job_id>/cancel", methods=["POST"])
+    @token_required
+    def cancel_job(job_id):
+        job = jobs.cancel(job_id, request.current_user.get('user_id'))
+        if job is None:
+            return jsonify({"status": "error", "message": "job not found"}), 404
+        return jsonify({"status": "success", "job": job}), 200
 
     return app
 
@@ -0,0 +1,105 @@
+# manage.py — maintenance commands for the storage backend
+#
+#   python manage.py migrate-layout [--dry-run]
+#   python manage.py reindex [--prefix USER_ID]
+#   python manage.py job-metrics [--window SECONDS]
+#   python manage.py scrub --user USER_ID [--backup NAME]
+#   python manage.py prune --user USER_ID [--dry-run]
+import argparse
+import json
+import sys
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Handle both direct execution and package import
+try:
+    from .utils import backups, jobs, local_storage
+    from .utils.storage_factory import storage
+except ImportError:
+    from utils import backups, jobs, local_storage
+    from utils.storage_factory import storage
+
+
+def cmd_migrate_layout(args):
+    # run the server with LOCAL_STORAGE_LAYOUT=sharded first; reads fall back
+    # to the direct path for anything not moved yet, so no downtime is needed
+    if local_storage.LOCAL_STORAGE_LAYOUT != "sharded" and not args.dry_run:
+        print("set LOCAL_STORAGE_LAYOUT=sharded (here and on the running server) before migrating")
+        return 1
+    moved, skipped = local_storage.migrate_to_sharded(dry_run=args.dry_run)
+    print(f"{'would move' if args.dry_run else 'moved'} {moved} object(s), skipped {skipped}")
+    return 0
+
+
+def cmd_reindex(args):
+    result = storage.reindex(args.prefix)
+    print(f"indexed {result['indexed']}, removed {result['removed']} stale row(s), "
+          f"recovered {result['recovered']} and pruned {result['pruned']} unindexed object(s), "
+          f"{result['orphans']} without a path record left in place")
+    return 0
+
+
+def cmd_job_metrics(args):
+    # for autoscaling scripts: queue depth and start lag of backup/restore jobs;
+    # fleet-wide, so it is deliberately not served to tenants over HTTP
+    print(json.dumps(jobs.metrics(args.window), indent=2))
+    return 0
+
+
+def cmd_scrub(args):
+    # runs in the foreground; interrupting it keeps a checkpoint to resume from
+    report = backups.scrub(storage, args.user, args.backup)
+    print(f"checked {report['checked_count']} of {report['object_count']} object(s), "
+          f"{report['bytes_checked']} bytes: {len(report['missing'])} missing, "
+          f"{len(report['corrupt'])} corrupt, {len(report['errors'])} unreadable")
+    for item in report["missing"] + report["corrupt"]:
+        print(json.dumps(item))
+    return 1 if report["missing"] or report["corrupt"] else 0
+
+
+def cmd_prune(args):
+    # applies the user's retention policy in the foreground
+    if backups.load_retention(storage, args.user) is None:
+        print(f"no retention policy for {args.user}")
+        return 1
+    result = backups.prune(storage, args.user, dry_run=args.dry_run)
+    print(f"{'would delete' if args.dry_run else 'deleted'} {len(result['expired'])} snapshot(s), "
+          f"reclaimed {result['reclaimed_blobs']} blob(s)")
+    for name in result["expired"]:
+        print(name)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CloudVault storage maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("migrate-layout", help="move local objects into the sharded directory layout")
+    p.add_argument("--dry-run", action="store_true", help="count objects without moving them")
+    p.set_defaults(func=cmd_migrate_layout)
+
+    p = sub.add_parser("reindex", help="rebuild the listing metadata index from storage")
+    p.add_argument("--prefix", default="", help="limit to one user id / path prefix")
+    p.set_defaults(func=cmd_reindex)
+
+    p = sub.add_parser("job-metrics", help="print background job queue depth and lag as JSON")
+    p.add_argument("--window", type=int, default=3600, help="seconds of history for lag and throughput")
+    p.set_defaults(func=cmd_job_metrics)
+
+    p = sub.add_parser("scrub", help="re-hash backup content and report missing or corrupt objects")
+    p.add_argument("--user", required=True, help="user id whose backups to verify")
+    p.add_argument("--backup", default=None, help="one snapshot (default: every backup of the user)")
+    p.set_defaults(func=cmd_scrub)
+
+    p = sub.add_parser("prune", help="delete snapshots a user's retention policy no longer keeps")
+    p.add_argument("--user", required=True, help="user id whose backups to prune")
+    p.add_argument("--dry-run", action="store_true", help="list expired snapshots without deleting them")
+    p.set_defaults(func=cmd_prune)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
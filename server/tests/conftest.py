@@ -1,4 +1,6 @@
 from server.main import create_app
+from server.services import cognito_auth_service
+from server.utils import backups, jobs, local_storage
 import pytest
 
 @pytest.fixture
@@ -6,3 +8,29 @@ def client():
     app = create_app()
     app.config["TESTING"] = True
     return app.test_client()
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    # point the local adapter at a throwaway data directory
+    monkeypatch.setattr(local_storage, "BASE_DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(jobs, "JOBS_DIR", str(tmp_path / ".jobs"))
+    monkeypatch.setattr(backups, "BACKUP_LOCK_DIR", str(tmp_path / ".locks" / "backups"))
+    return tmp_path
+
+@pytest.fixture
+def auth_headers(monkeypatch):
+    claims = {"sub": "test_user", "email": "test@example.com"}
+    monkeypatch.setattr(cognito_auth_service, "verify_cognito_token", lambda token: (claims, None))
+    return {"Authorization": "Bearer test-token"}
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    from server.utils import s3_storage
+    from server.tests.fake_s3 import FakeS3
+
+    client = FakeS3()
+    monkeypatch.setattr(s3_storage, "s3", client)
+    monkeypatch.setattr(s3_storage, "S3_BUCKET", "test-bucket")
+    monkeypatch.setattr(s3_storage, "_list_cache", s3_storage.list_cache.ListCache(1000))
+    monkeypatch.setattr(s3_storage, "_compressed_tops", {})
+    return client
@@ -0,0 +1,184 @@
+# tests/fake_s3.py — in-memory stand-in for the boto3 S3 client calls we use
+import io
+import uuid
+import hashlib
+import threading
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+
+def _client_error(code, op):
+    return ClientError({"Error": {"Code": code, "Message": code}}, op)
+
+
+class _Exceptions:
+    ClientError = ClientError
+
+    class NoSuchKey(ClientError):
+        pass
+
+
+class _Paginator:
+    def __init__(self, client, op):
+        self.client = client
+        self.op = op
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = getattr(self.client, self.op)(**kwargs, **({"ContinuationToken": token} if token else {}))
+            yield page
+            if not page.get("IsTruncated"):
+                return
+            token = page["NextContinuationToken"]
+
+
+class FakeS3:
+    exceptions = _Exceptions
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.calls = []
+        self.fail_parts = set()
+        self._lock = threading.Lock()
+
+    def _record(self, op, **kwargs):
+        with self._lock:
+            self.calls.append((op, kwargs))
+
+    def _put(self, key, data, metadata=None):
+        self.objects[key] = {
+            "Body": bytes(data),
+            "LastModified": datetime.now(timezone.utc),
+            "ETag": '"%s"' % hashlib.md5(data).hexdigest(),
+            "Metadata": dict(metadata or {}),
+        }
+
+    def put_object(self, Bucket, Key, Body=b"", Metadata=None, IfNoneMatch=None, **kwargs):
+        self._record("put_object", Key=Key)
+        if IfNoneMatch == "*" and Key in self.objects:
+            raise _client_error("PreconditionFailed", "PutObject")
+        data = Body.read() if hasattr(Body, "read") else bytes(Body)
+        self._put(Key, data, Metadata)
+        return {"ETag": self.objects[Key]["ETag"]}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._record("head_object", Key=Key)
+        obj = self.objects.get(Key)
+        if obj is None:
+            raise _client_error("404", "HeadObject")
+        return {"ContentLength": len(obj["Body"]), "ETag": obj["ETag"],
+                "LastModified": obj["LastModified"], "Metadata": obj["Metadata"]}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._record("get_object", Key=Key, Range=Range)
+        obj = self.objects.get(Key)
+        if obj is None:
+            raise _Exceptions.NoSuchKey({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        data = obj["Body"]
+        if Range:
+            start, _, end = Range[len("bytes="):].partition("-")
+            data = data[int(start):int(end) + 1 if end else None]
+        return {"Body": StreamingBody(io.BytesIO(data), len(data)), "ContentLength": len(data),
+                "ETag": obj["ETag"], "LastModified": obj["LastModified"], "Metadata": obj["Metadata"]}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._record("delete_object", Key=Key)
+        self.objects.pop(Key, None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._record("delete_objects", Keys=[o["Key"] for o in Delete["Objects"]])
+        for o in Delete["Objects"]:
+            self.objects.pop(o["Key"], None)
+        return {}
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective="COPY", Metadata=None, **kwargs):
+        self._record("copy_object", Key=Key, CopySource=CopySource["Key"])
+        src = self.objects.get(CopySource["Key"])
+        if src is None:
+            raise _client_error("NoSuchKey", "CopyObject")
+        self._put(Key, src["Body"], Metadata if MetadataDirective == "REPLACE" else src["Metadata"])
+        return {"CopyObjectResult": {"ETag": self.objects[Key]["ETag"]}}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {"Key": Key, "Parts": {}, "Metadata": kwargs.get("Metadata")}
+        self._record("create_multipart_upload", Key=Key)
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._record("upload_part", Key=Key, PartNumber=PartNumber)
+        if PartNumber in self.fail_parts:
+            raise _client_error("InternalError", "UploadPart")
+        data = Body.read() if hasattr(Body, "read") else bytes(Body)
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        with self._lock:
+            self.uploads[UploadId]["Parts"][PartNumber] = (etag, data)
+        return {"ETag": etag}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange, **kwargs):
+        self._record("upload_part_copy", Key=Key, PartNumber=PartNumber)
+        start, _, end = CopySourceRange[len("bytes="):].partition("-")
+        data = self.objects[CopySource["Key"]]["Body"][int(start):int(end) + 1]
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        with self._lock:
+            self.uploads[UploadId]["Parts"][PartNumber] = (etag, data)
+        return {"CopyPartResult": {"ETag": etag}}
+
+    def list_parts(self, Bucket, Key, UploadId, **kwargs):
+        upload = self.uploads.get(UploadId)
+        if upload is None:
+            raise _client_error("NoSuchUpload", "ListParts")
+        parts = [{"PartNumber": n, "ETag": etag, "Size": len(data)}
+                 for n, (etag, data) in sorted(upload["Parts"].items())]
+        return {"Parts": parts, "IsTruncated": False}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._record("complete_multipart_upload", Key=Key)
+        upload = self.uploads.pop(UploadId)
+        data = b"".join(upload["Parts"][p["PartNumber"]][1] for p in MultipartUpload["Parts"])
+        self._put(Key, data, upload["Metadata"])
+        return {"ETag": self.objects[Key]["ETag"]}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._record("abort_multipart_upload", Key=Key)
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", Delimiter=None, MaxKeys=1000, ContinuationToken=None,
+                        StartAfter=None, **kwargs):
+        self._record("list_objects_v2", Prefix=Prefix, Delimiter=Delimiter)
+        after = ContinuationToken or StartAfter or ""
+        entries = []
+        seen = set()
+        for key in sorted(self.objects):
+            if not key.startswith(Prefix) or key <= after:
+                continue
+            if Delimiter:
+                idx = key.find(Delimiter, len(Prefix))
+                if idx != -1:
+                    common = key[:idx + len(Delimiter)]
+                    if common not in seen and not after.startswith(common):
+                        seen.add(common)
+                        entries.append(("prefix", common))
+                    continue
+            entries.append(("key", key))
+        page_entries = entries[:MaxKeys]
+        contents = []
+        for kind, key in page_entries:
+            if kind == "key":
+                obj = self.objects[key]
+                contents.append({"Key": key, "Size": len(obj["Body"]), "LastModified": obj["LastModified"],
+                                 "ETag": obj["ETag"]})
+        page = {"Contents": contents,
+                "CommonPrefixes": [{"Prefix": v} for kind, v in page_entries if kind == "prefix"],
+                "KeyCount": len(page_entries), "IsTruncated": len(entries) > MaxKeys}
+        if page["IsTruncated"]:
+            page["NextContinuationToken"] = page_entries[-1][1]
+        return page
+
+    def get_paginator(self, op):
+        return _Paginator(self, op)
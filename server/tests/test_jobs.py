@@ -0,0 +1,96 @@
+import time
+import pytest
+from server.utils import jobs
+
+@pytest.fixture
+def paused(data_dir, monkeypatch):
+    # keep this process's workers from claiming; tests claim by hand
+    real_claim = jobs._claim
+    monkeypatch.setattr(jobs, "_claim", lambda: None)
+    return real_claim
+
+def test_fair_queue_orders_by_cost_and_weight(paused):
+    big, small = "big_user", "small_user"
+    conn = jobs._db()
+    # previous runs set the cost estimates
+    for user, size in ((big, 1000), (small, 10)):
+        conn.execute("INSERT INTO jobs (id, user_id, kind, params, status, progress, created_at, finished_at) "
+                     "VALUES (?, ?, 'backup', '{}', 'succeeded', ?, ?, ?)",
+                     (f"old-{user}", user, f'{{"bytes_done": {size}, "bytes_total": {size}}}', time.time(), time.time()))
+    first_big = jobs.submit(big, "backup", {}, weight=1)["job_id"]
+    smalls = [jobs.submit(small, "backup", {"n": i}, weight=1)["job_id"] for i in range(3)]
+    interactive = jobs.submit(big, "restore", {}, weight=100)["job_id"]
+    order = [paused()["id"] for _ in range(5)]
+    # small jobs aren't stuck behind the big one queued before them
+    assert order[:3] == smalls and set(order[3:]) == {first_big, interactive}
+    assert paused() is None
+
+    jobs.JOB_MAX_RUNNING, saved = 5, jobs.JOB_MAX_RUNNING
+    try:
+        jobs.submit(small, "backup", {})
+        assert paused() is None  # five already running
+    finally:
+        jobs.JOB_MAX_RUNNING = saved
+
+def test_schedules_jitter_and_metrics(paused, monkeypatch):
+    with pytest.raises(ValueError):
+        jobs.set_schedule("u1", "backup", {}, at="25:00")
+    with pytest.raises(ValueError):
+        jobs.set_schedule("u1", "backup", {}, interval_hours=1, jitter_minutes=60)
+    schedule = jobs.set_schedule("u1", "backup", {"mode": "auto"}, at="03:30", jitter_minutes=30)
+    slot = schedule["next_run"]
+    assert 0 <= (slot - 3.5 * 3600) % 86400 < 30 * 60 and slot > time.time()
+
+    now = slot + 1
+    assert jobs.run_due_schedules(now) == 1
+    after = jobs.get_schedule("u1", "backup")
+    assert 86400 - 30 * 60 < after["next_run"] - slot < 86400 + 30 * 60
+    # the previous run is still queued: the next slot passes without a second job
+    assert jobs.run_due_schedules(after["next_run"] + 1) == 0
+    assert [j["params"] for j in jobs.list_jobs("u1")] == [{"mode": "auto"}]
+
+    monkeypatch.setattr(time, "time", lambda: after["next_run"] + 10)
+    metrics = jobs.metrics()
+    assert metrics["queued"] == 1 and metrics["queued_by_kind"] == {"backup": 1}
+    assert metrics["oldest_queued_seconds"] > 86400 - 30 * 60  # lag counts from the slot it was due at
+    assert metrics["schedules"] == 1 and metrics["schedules_overdue"] == 0
+    assert jobs.delete_schedule("u1", "backup") and jobs.get_schedule("u1", "backup") is None
+
+def test_token_bucket_paces_reported_bytes(monkeypatch):
+    from server.utils.rate_limit import TokenBucket
+    slept = []
+    monkeypatch.setattr(time, "sleep", slept.append)
+    bucket = TokenBucket(100)
+    assert bucket.consume(100) == 0.0  # the initial burst
+    assert bucket.consume(50) == pytest.approx(0.5, abs=0.05)
+    assert slept and TokenBucket(0).consume(10 ** 9) == 0.0
+
+def test_bandwidth_split_between_busy_processes(paused, monkeypatch):
+    from server.utils.rate_limit import TokenBucket
+    monkeypatch.setattr(jobs, "JOB_BANDWIDTH_LIMIT", 900)
+    monkeypatch.setattr(jobs, "_bandwidth", TokenBucket(900))
+    monkeypatch.setattr(jobs, "_process_id", "me")
+    conn = jobs._db()
+    for job_id, worker in (("a", "me"), ("b", "other"), ("c", "other"), ("d", "third")):
+        conn.execute("INSERT INTO jobs (id, user_id, kind, params, status, created_at, worker) "
+                     "VALUES (?, 'u', 'backup', '{}', 'running', ?, ?)", (job_id, time.time(), worker))
+    jobs._rebalance(conn)
+    assert jobs._bandwidth.rate == 300
+    jobs._finish("b", "succeeded")
+    jobs._finish("c", "succeeded")
+    jobs._rebalance(conn)
+    assert jobs._bandwidth.rate == 450
+
+
+def test_exclusive_jobs_of_a_user_never_overlap(paused, monkeypatch):
+    monkeypatch.setattr(jobs, "_exclusive", {"backup", "prune"})
+    first = jobs.submit("u1", "backup", {})["job_id"]
+    assert paused()["id"] == first
+    second = jobs.submit("u1", "prune", {})["job_id"]
+    scrub = jobs.submit("u1", "scrub", {})["job_id"]
+    other = jobs.submit("u2", "backup", {})["job_id"]
+    # u1's prune waits for its running backup; other users and kinds don't
+    assert {paused()["id"], paused()["id"]} == {scrub, other}
+    assert paused() is None
+    jobs._finish(first, "succeeded")
+    assert paused()["id"] == second
@@ -1,5 +1,372 @@
+import time
 from server.utils.auth import DEV_API_KEY
 
 def test_health(client):
     resp = client.get("/health")
     assert resp.status_code == 200
+
+def test_upload_stream_raw(client, data_dir, auth_headers):
+    resp = client.put("/files/upload/stream?filename=notes.txt", data=b"streamed body",
+                      headers={**auth_headers, "Content-Type": "application/octet-stream"})
+    assert resp.status_code == 200
+    assert resp.get_json()["file"]["size"] == len(b"streamed body")
+    assert (data_dir / "test_user" / "notes.txt").read_bytes() == b"streamed body"
+
+def test_upload_stream_multipart(client, data_dir, auth_headers):
+    import io
+    resp = client.post("/files/upload/stream", headers=auth_headers,
+                       data={"file": (io.BytesIO(b"multipart body"), "doc.txt")},
+                       content_type="multipart/form-data")
+    assert resp.status_code == 200
+    assert (data_dir / "test_user" / "doc.txt").read_bytes() == b"multipart body"
+
+def test_upload_stream_chunked_body_capped_at_quota(client, data_dir, auth_headers, monkeypatch):
+    from server import main
+    monkeypatch.setattr(main, "get_user_storage", lambda email: {"used": 90, "limit": 100, "percentage": 90.0})
+    # no Content-Length, as with Transfer-Encoding: chunked
+    resp = client.put("/files/upload/stream?filename=big.bin", data=b"x" * 11,
+                      headers={**auth_headers, "Content-Type": "application/octet-stream"},
+                      environ_overrides={"CONTENT_LENGTH": "", "wsgi.input_terminated": True})
+    assert resp.status_code == 400
+    assert not (data_dir / "test_user" / "big.bin").exists()
+    resp = client.put("/files/upload/stream?filename=fits.bin", data=b"x" * 10,
+                      headers={**auth_headers, "Content-Type": "application/octet-stream"},
+                      environ_overrides={"CONTENT_LENGTH": "", "wsgi.input_terminated": True})
+    assert resp.status_code == 200
+    assert (data_dir / "test_user" / "fits.bin").read_bytes() == b"x" * 10
+
+def test_download_raw_range(client, data_dir, auth_headers):
+    (data_dir / "test_user").mkdir()
+    (data_dir / "test_user" / "clip.bin").write_bytes(bytes(range(100)))
+
+    resp = client.get("/files/download/raw?filename=clip.bin", headers=auth_headers)
+    assert resp.status_code == 200
+    assert resp.data == bytes(range(100))
+
+    resp = client.get("/files/download/raw?filename=clip.bin", headers={**auth_headers, "Range": "bytes=10-19"})
+    assert resp.status_code == 206
+    assert resp.headers["Content-Range"] == "bytes 10-19/100"
+    assert resp.data == bytes(range(10, 20))
+
+    resp = client.get("/files/download/raw?filename=missing.bin", headers=auth_headers)
+    assert resp.status_code == 404
+
+def test_resumable_upload_session(client, data_dir, auth_headers):
+    payload = bytes(range(256)) * 10  # 2560 bytes -> 3 chunks of 1024
+    resp = client.post("/files/uploads", json={"filename": "resume.bin", "size": len(payload), "chunk_size": 1024},
+                       headers=auth_headers)
+    assert resp.status_code == 201
+    session_id = resp.get_json()["session"]["session_id"]
+
+    # out of order; chunk 1 missing
+    for index in (2, 0):
+        resp = client.put(f"/files/uploads/{session_id}/chunks/{index}",
+                          data=payload[index * 1024:(index + 1) * 1024], headers=auth_headers)
+        assert resp.status_code == 200
+    session = client.get(f"/files/uploads/{session_id}", headers=auth_headers).get_json()["session"]
+    assert session["missing_chunks"] == [1]
+    assert session["received_ranges"] == [[0, 1023], [2048, 2559]]
+    assert client.post(f"/files/uploads/{session_id}/commit", headers=auth_headers).status_code == 409
+
+    resp = client.put(f"/files/uploads/{session_id}/chunks/1", data=b"short", headers=auth_headers)
+    assert resp.status_code == 400
+    client.put(f"/files/uploads/{session_id}/chunks/1", data=payload[1024:2048], headers=auth_headers)
+
+    resp = client.post(f"/files/uploads/{session_id}/commit", headers=auth_headers)
+    assert resp.status_code == 200
+    assert (data_dir / "test_user" / "resume.bin").read_bytes() == payload
+    assert client.get(f"/files/uploads/{session_id}", headers=auth_headers).status_code == 404
+
+def test_upload_session_limits_and_exclusive_commit(client, data_dir, auth_headers, monkeypatch):
+    from server.utils import local_storage
+    resp = client.post("/files/uploads", json={"filename": "big.bin", "size": 10, "chunk_size": 1 << 30},
+                       headers=auth_headers)
+    assert resp.status_code == 400
+    resp = client.post("/files/uploads", json={"filename": "x.bin", "size": 10, "chunk_size": [1]},
+                       headers=auth_headers)
+    assert resp.status_code == 400
+
+    session_id = client.post("/files/uploads", json={"filename": "once.bin", "size": 4},
+                             headers=auth_headers).get_json()["session"]["session_id"]
+    client.put(f"/files/uploads/{session_id}/chunks/0", data=b"once", headers=auth_headers)
+    # a second commit arriving while the first is assembling loses the claim
+    racing = []
+    save_stream = local_storage.save_stream
+
+    def commit_during_assembly(path, stream, *args, **kwargs):
+        racing.append(local_storage.commit_upload_session(session_id))
+        return save_stream(path, stream, *args, **kwargs)
+
+    monkeypatch.setattr(local_storage, "save_stream", commit_during_assembly)
+    assert client.post(f"/files/uploads/{session_id}/commit", headers=auth_headers).status_code == 200
+    assert racing == [None]
+    assert (data_dir / "test_user" / "once.bin").read_bytes() == b"once"
+
+def test_presigned_local_transfer(client, data_dir, auth_headers, monkeypatch):
+    from server.services import cognito_auth_service
+    monkeypatch.setattr(cognito_auth_service, "user_storage", {})
+    resp = client.post("/files/presign", json={"filename": "direct.txt", "method": "PUT", "size": 6},
+                       headers=auth_headers)
+    assert resp.status_code == 200
+    # quota is charged when the upload lands, not when the URL is issued
+    assert cognito_auth_service.get_user_storage("test@example.com")["used"] == 0
+    put_url = resp.get_json()["url"].replace("http://localhost", "")
+    assert client.put(put_url, data=b"direct").status_code == 200
+    assert (data_dir / "test_user" / "direct.txt").read_bytes() == b"direct"
+    assert cognito_auth_service.get_user_storage("test@example.com")["used"] == 6
+
+    get_url = client.post("/files/presign", json={"filename": "direct.txt"},
+                          headers=auth_headers).get_json()["url"].replace("http://localhost", "")
+    resp = client.get(get_url, headers={"Range": "bytes=0-1"})
+    assert resp.status_code == 206 and resp.data == b"di"
+
+    # a GET token cannot be replayed as an upload, and tampering breaks it
+    assert client.put(get_url, data=b"x").status_code == 403
+    assert client.get(get_url[:-2] + "AA").status_code == 403
+
+def test_presigned_s3_put_charged_when_seen(fake_s3, monkeypatch):
+    from server import main
+    from server.services import cognito_auth_service
+    from server.utils import s3_storage
+    monkeypatch.setattr(main, "storage", s3_storage)
+    monkeypatch.setattr(main, "_presigned_puts", {})
+    monkeypatch.setattr(cognito_auth_service, "user_storage", {})
+    landing = ("u/direct.bin", time.time(), time.time() + 60)
+    main._presigned_puts["a@example.com"] = [landing, ("u/never.bin", time.time() - 120, time.time() - 60)]
+    assert main._user_storage("a@example.com")["used"] == 0
+    assert main._presigned_puts["a@example.com"] == [landing]
+    fake_s3._put("u/direct.bin", b"12345")
+    assert main._user_storage("a@example.com")["used"] == 5
+    assert main._user_storage("a@example.com")["used"] == 5
+    assert not main._presigned_puts
+
+def test_browse_paginates_one_folder(client, data_dir, auth_headers):
+    from server.utils import local_storage
+    for name in ("a.txt", "b.txt", "c.txt", "docs/x.txt", "docs/deep/y.txt", "pics/z.png"):
+        local_storage.save_file(f"test_user/{name}", b"1")
+
+    seen_files, seen_folders, cursor = [], [], None
+    while True:
+        resp = client.get("/files/browse", query_string={"limit": 2, **({"cursor": cursor} if cursor else {})},
+                          headers=auth_headers)
+        body = resp.get_json()
+        assert resp.status_code == 200 and len(body["files"]) + len(body["folders"]) <= 2
+        seen_files += [f["name"] for f in body["files"]]
+        seen_folders += [f["name"] for f in body["folders"]]
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+    assert seen_files == ["a.txt", "b.txt", "c.txt"]
+    assert seen_folders == ["docs", "pics"]
+
+    body = client.get("/files/browse?path=docs", headers=auth_headers).get_json()
+    assert [f["path"] for f in body["files"]] == ["test_user/docs/x.txt"]
+    assert body["folders"] == [{"name": "deep", "path": "test_user/docs/deep/"}]
+
+    assert client.get("/files/browse?cursor=!!", headers=auth_headers).status_code == 400
+    from server.utils import listing
+    for forged in ({"s": 5}, {"s": ["a"]}):
+        resp = client.get("/files/browse", query_string={"cursor": listing.encode_cursor(forged)}, headers=auth_headers)
+        assert resp.status_code == 400
+
+def test_list_ndjson_stream(client, data_dir, auth_headers, monkeypatch):
+    import json
+    from server.utils import local_storage
+    for i in range(5):
+        local_storage.save_file(f"test_user/f{i}.txt", b"x" * i)
+    monkeypatch.setattr(local_storage.listing, "MAX_PAGE_SIZE", 2)
+
+    resp = client.post("/list?format=ndjson", json={}, headers=auth_headers)
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in resp.data.decode().splitlines()]
+    assert [e["name"] for e in lines[:-1]] == [f"f{i}.txt" for i in range(5)]
+    assert lines[-1] == {"done": True, "file_count": 5}
+
+def test_search_ranks_and_paginates(client, data_dir, auth_headers):
+    from server.utils import local_storage
+    for name in ("report.pdf", "Report-2024.pdf", "annual_report.docx", "reports/q1.txt",
+                 "reports/q2.pdf", "notes.txt"):
+        local_storage.save_file(f"test_user/{name}", b"1")
+    local_storage.save_file("other_user/report.pdf", b"1")
+
+    def search(**params):
+        paths, cursor = [], None
+        while True:
+            resp = client.get("/files/search", query_string={**params, **({"cursor": cursor} if cursor else {})},
+                              headers=auth_headers)
+            assert resp.status_code == 200
+            body = resp.get_json()
+            paths += [(f["path"][len("test_user/"):], f["rank"]) for f in body["files"]]
+            cursor = body["next_cursor"]
+            if not cursor:
+                return paths
+
+    assert search(q="report", limit=2) == [
+        ("report.pdf", 0), ("Report-2024.pdf", 1), ("annual_report.docx", 2),
+        ("reports/q2.pdf", 3), ("reports/q1.txt", 3)]
+    assert [p for p, _ in search(q="rep", match="prefix")] == ["Report-2024.pdf", "report.pdf"]
+    assert [p for p, _ in search(q="report", ext="pdf")] == ["report.pdf", "Report-2024.pdf", "reports/q2.pdf"]
+    assert [p for p, _ in search(q="q", ext="txt")] == ["reports/q1.txt"]
+
+    # saves and deletes reach the index straight away
+    local_storage.save_file("test_user/archive/report", b"1")
+    local_storage.delete_file("test_user/report.pdf")
+    assert search(q="report.pdf") == []
+    assert search(q="report")[0] == ("archive/report", 0)
+    assert client.get("/files/search", headers=auth_headers).status_code == 400
+    assert client.get("/files/search?q=x&cursor=!!", headers=auth_headers).status_code == 400
+
+def wait_for_job(client, auth_headers, job_id):
+    deadline = time.time() + 10
+    while True:
+        job = client.get(f"/jobs/{job_id}", headers=auth_headers).get_json()["job"]
+        if job["status"] not in ("queued", "running") or time.time() > deadline:
+            return job
+        time.sleep(0.02)
+
+def test_backup_routes(client, data_dir, auth_headers):
+    from server.utils import local_storage
+    local_storage.save_file("test_user/a.txt", b"a")
+    resp = client.post("/backup", json={"backup_name": "first"}, headers=auth_headers)
+    assert resp.status_code == 202
+    job = wait_for_job(client, auth_headers, resp.get_json()["job"]["job_id"])
+    assert job["status"] == "succeeded" and job["result"]["type"] == "full"
+    assert job["progress"] == {"files_done": 1, "bytes_done": 1, "files_total": 1, "bytes_total": 1}
+    local_storage.save_file("test_user/b.txt", b"b")
+    job = client.post("/backup", json={}, headers=auth_headers).get_json()["job"]
+    job = wait_for_job(client, auth_headers, job["job_id"])
+    assert job["result"]["type"] == "incremental" and job["result"]["added"] == 1
+    assert client.post("/backup", json={"mode": "bogus"}, headers=auth_headers).status_code == 400
+    assert client.post("/backup", json={"backup_name": "first"}, headers=auth_headers).status_code == 400
+    for bad in ("../../victim/planted", "a/b", "..", "x\ny"):
+        assert client.post("/backup", json={"backup_name": bad}, headers=auth_headers).status_code == 400
+    assert not (data_dir / "victim").exists()
+    assert client.get("/backups/scrub?backup_name=../x", headers=auth_headers).status_code == 400
+    backups = client.get("/backups", headers=auth_headers).get_json()["backups"]
+    assert [b["parent"] for b in backups] == [None, "first"]
+    resp = client.get("/backups/file?backup_name=first&filename=a.txt", headers=auth_headers)
+    assert resp.status_code == 200 and resp.data == b"a"
+    assert client.get("/backups/file?backup_name=first&filename=b.txt", headers=auth_headers).status_code == 404
+    assert client.get("/backups/file?backup_name=nope&filename=a.txt", headers=auth_headers).status_code == 404
+    second = backups[1]["name"]
+    changes = client.get(f"/backups/diff?backup_name=first&against={second}", headers=auth_headers).get_json()
+    assert changes["added"] == ["test_user/b.txt"] and changes["deleted"] == []
+    local_storage.delete_file("test_user/a.txt")
+    changes = client.get(f"/backups/diff?backup_name={second}", headers=auth_headers).get_json()
+    assert changes["deleted"] == ["test_user/a.txt"] and changes["added"] == []
+    assert client.get("/backups/diff", headers=auth_headers).status_code == 400
+    assert client.get("/backups/diff?backup_name=nope", headers=auth_headers).status_code == 404
+    resp = client.delete("/backups/first", headers=auth_headers)
+    assert resp.status_code == 202
+    job = wait_for_job(client, auth_headers, resp.get_json()["job"]["job_id"])
+    assert job["status"] == "succeeded" and job["result"]["freed_blobs"] == 0
+    assert client.delete("/backups/first", headers=auth_headers).status_code == 404
+    assert [b["type"] for b in client.get("/backups", headers=auth_headers).get_json()["backups"]] == ["full"]
+    assert client.post("/backups/gc", json={"budget": "x"}, headers=auth_headers).status_code == 400
+    assert client.post("/backups/gc", json={}, headers=auth_headers).get_json()["cycle_finished"]
+
+def test_restore_jobs_report_progress_and_cancel(client, data_dir, auth_headers, monkeypatch):
+    import threading
+    from server.utils import jobs, local_storage
+    monkeypatch.setattr(jobs, "JOB_PROGRESS_INTERVAL", 0)
+    for i in range(3):
+        local_storage.save_file(f"test_user/f{i}.txt", b"x" * 10)
+    job = client.post("/backup", json={"backup_name": "snap"}, headers=auth_headers).get_json()["job"]
+    assert wait_for_job(client, auth_headers, job["job_id"])["status"] == "succeeded"
+    assert client.post("/restore", json={"backup_name": "nope"}, headers=auth_headers).status_code == 404
+
+    resp = client.post("/restore", json={"backup_name": "snap", "target": "r"}, headers=auth_headers)
+    job = wait_for_job(client, auth_headers, resp.get_json()["job"]["job_id"])
+    assert job["status"] == "succeeded" and job["result"]["restored_count"] == 3
+    assert job["progress"]["files_done"] == 3 and job["progress"]["bytes_total"] == 30
+    assert local_storage.read_file("test_user/r/f1.txt") == b"x" * 10
+
+    # a restore blocked on its first file is cancelled at its next progress report
+    release = threading.Event()
+    real_copy = local_storage.copy_file
+    def slow_copy(src, dst):
+        release.wait(5)
+        return real_copy(src, dst)
+    monkeypatch.setattr(local_storage, "copy_file", slow_copy)
+    job = client.post("/restore", json={"backup_name": "snap", "target": "c"}, headers=auth_headers).get_json()["job"]
+    while client.get(f"/jobs/{job['job_id']}", headers=auth_headers).get_json()["job"]["status"] == "queued":
+        time.sleep(0.01)
+    assert client.post(f"/jobs/{job['job_id']}/cancel", headers=auth_headers).get_json()["job"]["cancel_requested"]
+    release.set()
+    assert wait_for_job(client, auth_headers, job["job_id"])["status"] == "cancelled"
+    assert [j["kind"] for j in client.get("/jobs", headers=auth_headers).get_json()["jobs"]] == [
+        "restore", "restore", "backup"]
+    assert client.get("/jobs/unknown", headers=auth_headers).status_code == 404
+
+def test_restore_target_is_validated_and_charged(client, data_dir, auth_headers, monkeypatch):
+    from server import main
+    from server.utils import local_storage
+    usage = {"used": 0, "limit": 1000, "percentage": 0.0}
+    monkeypatch.setattr(main, "get_user_storage", lambda email: usage)
+    monkeypatch.setattr(main, "update_user_storage", lambda email, size: usage.update(used=usage["used"] + size))
+    for i in range(3):
+        local_storage.save_file(f"test_user/f{i}.txt", b"x" * 100)
+    job = client.post("/backup", json={"backup_name": "snap"}, headers=auth_headers).get_json()["job"]
+    assert wait_for_job(client, auth_headers, job["job_id"])["status"] == "succeeded"
+
+    for target in ("../victim", "a/../../victim", "a\\b", "x\ny"):
+        resp = client.post("/restore", json={"backup_name": "snap", "target": target}, headers=auth_headers)
+        assert resp.status_code == 400
+    assert not (data_dir / "victim").exists()
+
+    # in place nothing new is written, so nothing is charged
+    job = client.post("/restore", json={"backup_name": "snap"}, headers=auth_headers).get_json()["job"]
+    assert wait_for_job(client, auth_headers, job["job_id"])["result"]["restored_count"] == 0
+    assert usage["used"] == 0
+
+    job = client.post("/restore", json={"backup_name": "snap", "target": "r"}, headers=auth_headers).get_json()["job"]
+    assert wait_for_job(client, auth_headers, job["job_id"])["status"] == "succeeded"
+    assert usage["used"] == 300
+
+    usage["used"] = 800
+    resp = client.post("/restore", json={"backup_name": "snap", "target": "s"}, headers=auth_headers)
+    assert resp.status_code == 400 and resp.get_json()["message"] == "Storage limit exceeded"
+    assert not (data_dir / "test_user" / "s").exists()
+
+    assert client.get("/backups/scrub", headers=auth_headers).status_code == 404
+    assert client.post("/backups/scrub", json={"backup_name": "nope"}, headers=auth_headers).status_code == 404
+    job = client.post("/backups/scrub", json={"backup_name": "snap"}, headers=auth_headers).get_json()["job"]
+    assert wait_for_job(client, auth_headers, job["job_id"])["result"]["checked_count"] == 1  # one shared blob
+    report = client.get("/backups/scrub?backup_name=snap", headers=auth_headers).get_json()["report"]
+    assert report["missing"] == [] and report["corrupt"] == []
+
+def test_backup_schedule_routes(client, data_dir, auth_headers):
+    from server.utils import jobs
+    assert client.get("/backup/schedule", headers=auth_headers).status_code == 404
+    assert client.put("/backup/schedule", json={"mode": "bogus"}, headers=auth_headers).status_code == 400
+    assert client.put("/backup/schedule", json={"at": "7pm"}, headers=auth_headers).status_code == 400
+    resp = client.put("/backup/schedule", json={"at": "01:15", "jitter_minutes": 20}, headers=auth_headers)
+    assert resp.status_code == 200 and resp.get_json()["schedule"]["at"] == "01:15"
+    assert client.get("/backup/schedule", headers=auth_headers).get_json()["schedule"]["params"]["mode"] == "auto"
+    # fleet-wide metrics are for operators (manage.py job-metrics), not tenants
+    assert client.get("/metrics/jobs", headers=auth_headers).status_code == 404
+    metrics = jobs.metrics(3600)
+    assert metrics["schedules"] == 1 and metrics["queued"] == 0
+    assert client.delete("/backup/schedule", headers=auth_headers).status_code == 200
+    assert client.delete("/backup/schedule", headers=auth_headers).status_code == 404
+
+def test_backup_retention_routes(client, data_dir, auth_headers):
+    from server.utils import local_storage
+    assert client.get("/backups/retention", headers=auth_headers).status_code == 404
+    assert client.post("/backups/prune", json={}, headers=auth_headers).status_code == 404
+    assert client.put("/backups/retention", json={"daily": "x"}, headers=auth_headers).status_code == 400
+    resp = client.put("/backups/retention", json={"daily": 2, "weekly": 0, "monthly": 0}, headers=auth_headers)
+    assert resp.status_code == 200 and resp.get_json()["retention"] == {"daily": 2, "weekly": 0, "monthly": 0}
+    assert resp.get_json()["schedule"]["kind"] == "prune"
+    for i in range(3):
+        local_storage.save_file("test_user/a.txt", b"a" * (i + 1))
+        local_storage.create_backup_manifest("test_user", f"b{i}")
+    # all taken today: only the newest is kept
+    plan = client.post("/backups/prune", json={"dry_run": True}, headers=auth_headers).get_json()
+    assert plan["expired"] == ["b0", "b1"]
+    job = client.post("/backups/prune", json={}, headers=auth_headers).get_json()["job"]
+    assert wait_for_job(client, auth_headers, job["job_id"])["result"]["reclaimed_blobs"] == 2
+    assert [b["name"] for b in client.get("/backups", headers=auth_headers).get_json()["backups"]] == ["b2"]
+    assert client.delete("/backups/retention", headers=auth_headers).status_code == 200
+    assert client.get("/backups/retention", headers=auth_headers).status_code == 404
@@ -0,0 +1,264 @@
+# tests/test_s3_storage.py — S3 adapter against the in-memory stand-in
+import io
+import pytest
+from server.utils import s3_storage
+
+
+def test_save_stream_small_uses_single_put(fake_s3):
+    meta = s3_storage.save_stream("u/small.txt", io.BytesIO(b"hello"))
+    assert meta["size"] == 5
+    assert fake_s3.objects["u/small.txt"]["Body"] == b"hello"
+    assert not any(op == "create_multipart_upload" for op, _ in fake_s3.calls)
+
+
+def test_save_stream_multipart_parallel(fake_s3, monkeypatch):
+    monkeypatch.setattr(s3_storage, "S3_MULTIPART_THRESHOLD", 10 * 1024 * 1024)
+    monkeypatch.setattr(s3_storage, "S3_PART_SIZE", 5 * 1024 * 1024)
+    payload = bytes(range(256)) * (96 * 1024)  # 24 MiB -> 5 parts of 5 MiB
+    progress = []
+    meta = s3_storage.save_stream("u/big.bin", io.BytesIO(payload), progress=progress.append)
+    assert meta["size"] == len(payload)
+    assert fake_s3.objects["u/big.bin"]["Body"] == payload
+    assert sum(1 for op, _ in fake_s3.calls if op == "upload_part") == 5
+    assert progress[-1] == len(payload)
+
+
+def test_multipart_failure_aborts(fake_s3, monkeypatch):
+    monkeypatch.setattr(s3_storage, "S3_MULTIPART_THRESHOLD", 5 * 1024 * 1024)
+    monkeypatch.setattr(s3_storage, "S3_PART_RETRIES", 1)
+    monkeypatch.setattr(s3_storage.time, "sleep", lambda s: None)
+    fake_s3.fail_parts.add(2)
+    with pytest.raises(Exception):
+        s3_storage.save_file("u/fail.bin", b"x" * (12 * 1024 * 1024))
+    assert "u/fail.bin" not in fake_s3.objects
+    assert not fake_s3.uploads
+    assert any(op == "abort_multipart_upload" for op, _ in fake_s3.calls)
+
+
+def test_parallel_ranged_read(fake_s3, monkeypatch):
+    monkeypatch.setattr(s3_storage, "S3_RANGE_SIZE", 1000)
+    monkeypatch.setattr(s3_storage, "S3_PARALLEL_READ_THRESHOLD", 4000)
+    payload = bytes(range(256)) * 40  # 10240 bytes -> 11 ranges
+    fake_s3._put("u/video.mp4", payload)
+
+    assert s3_storage.read_file("u/video.mp4") == payload
+    assert sum(1 for op, kw in fake_s3.calls if op == "get_object" and kw["Range"]) == 11
+    assert b"".join(s3_storage.iter_file("u/video.mp4", 1500, 9999)) == payload[1500:10000]
+    assert s3_storage.read_file("u/missing") is None
+
+
+def test_download_to_file(fake_s3, monkeypatch, tmp_path):
+    monkeypatch.setattr(s3_storage, "S3_RANGE_SIZE", 1000)
+    payload = bytes(range(256)) * 30
+    fake_s3._put("u/archive.bin", payload)
+
+    dest = tmp_path / "archive.bin"
+    assert s3_storage.download_to_file("u/archive.bin", str(dest))["size"] == len(payload)
+    assert dest.read_bytes() == payload
+
+
+def test_upload_session_uses_multipart_parts(fake_s3):
+    part = 5 * 1024 * 1024
+    payload = b"a" * part + b"b" * 100
+    session = s3_storage.create_upload_session("u", "u/session.bin", len(payload), part)
+    sid = session["session_id"]
+    s3_storage.put_upload_chunk(sid, 1, io.BytesIO(payload[part:]))
+    assert s3_storage.get_upload_session(sid)["missing_chunks"] == [0]
+    s3_storage.put_upload_chunk(sid, 0, io.BytesIO(payload[:part]))
+    meta = s3_storage.commit_upload_session(sid)
+    assert meta["size"] == len(payload)
+    assert fake_s3.objects["u/session.bin"]["Body"] == payload
+    assert s3_storage.get_upload_session(sid) is None
+
+
+def test_upload_session_commit_is_claimed_once(fake_s3):
+    session = s3_storage.create_upload_session("u", "u/once.bin", 4, 4)
+    sid = session["session_id"]
+    s3_storage.put_upload_chunk(sid, 0, io.BytesIO(b"once"))
+    fake_s3._put(f".uploads/{sid}.commit", b"")  # another node is committing
+    assert s3_storage.commit_upload_session(sid) is None
+    assert "u/once.bin" not in fake_s3.objects
+    del fake_s3.objects[f".uploads/{sid}.commit"]
+    assert s3_storage.commit_upload_session(sid)["size"] == 4
+    assert not [k for k in fake_s3.objects if k.startswith(".uploads/")]
+
+
+def test_compressed_multipart_roundtrip(fake_s3, monkeypatch):
+    from server.utils import compression
+    monkeypatch.setattr(compression, "STORAGE_COMPRESSION", "zstd")
+    monkeypatch.setattr(s3_storage, "S3_MULTIPART_THRESHOLD", 5 * 1024 * 1024)
+    payload = b"".join(b"line %08d of a fairly repetitive log file\n" % i for i in range(400000))
+    meta = s3_storage.save_stream("u/app.log", io.BytesIO(payload))
+    assert meta["size"] == len(payload)
+    assert meta["stored_size"] < len(payload) // 4
+
+    info = s3_storage.stat_file("u/app.log")
+    assert info["size"] == len(payload) and info["encoding"] == "zstd"
+    assert s3_storage.list_files("u/")[0]["size"] == len(payload)
+    assert b"".join(s3_storage.iter_file("u/app.log", 1000, 1999)) == payload[1000:2000]
+    # a logical range past the end of the compressed body still resolves
+    assert b"".join(s3_storage.iter_file("u/app.log", len(payload) - 10, len(payload) - 1)) == payload[-10:]
+
+
+def test_listing_carries_logical_sizes_without_heads(fake_s3, monkeypatch, tmp_path):
+    from server.utils import compression
+    monkeypatch.setattr(compression, "STORAGE_COMPRESSION", "zstd")
+    monkeypatch.setattr(s3_storage, "S3_LIST_CACHE_MAX_AGE", 0)
+    payload = b"repetitive text " * 4096
+    s3_storage.save_file("u/a.log", payload)
+    s3_storage.save_file("raw/b.log", b"\xff\xd8\xff\xe0" + b"x" * 100)
+    s3_storage.list_files("u")
+    s3_storage.list_files("raw")
+
+    def object_heads():
+        return [kw["Key"] for op, kw in fake_s3.calls if op == "head_object" and not kw["Key"].startswith(".meta/")]
+
+    # reloads and reindexes reuse the sizes they already know
+    fake_s3.calls.clear()
+    assert s3_storage.list_files("u")[0]["size"] == len(payload)
+    monkeypatch.setattr(s3_storage, "S3_METADATA_INDEX", True)
+    monkeypatch.setattr(s3_storage, "METADATA_INDEX_DIR", str(tmp_path))
+    s3_storage.reindex("u")
+    s3_storage.reindex("u")
+    assert object_heads() == ["u/a.log"]
+
+    # with compression turned off, a fresh node still reports the logical
+    # size, and never HEADs objects in tops that hold nothing compressed
+    monkeypatch.setattr(compression, "STORAGE_COMPRESSION", "off")
+    monkeypatch.setattr(s3_storage, "S3_METADATA_INDEX", False)
+    monkeypatch.setattr(s3_storage, "_list_cache", s3_storage.list_cache.ListCache(1000))
+    monkeypatch.setattr(s3_storage, "_compressed_tops", {})
+    fake_s3.calls.clear()
+    assert s3_storage.list_page("u/")["files"][0]["size"] == len(payload)
+    assert s3_storage.list_files("raw")[0]["size"] == 104
+    assert object_heads() == ["u/a.log"]
+
+
+def test_incompressible_upload_stored_raw(fake_s3, monkeypatch):
+    from server.utils import compression
+    monkeypatch.setattr(compression, "STORAGE_COMPRESSION", "zstd")
+    jpeg = b"\xff\xd8\xff\xe0" + b"a" * 4096
+    s3_storage.save_file("u/photo.jpg", jpeg)
+    assert fake_s3.objects["u/photo.jpg"]["Body"] == jpeg
+    assert s3_storage.stat_file("u/photo.jpg")["encoding"] is None
+
+
+def test_metadata_index_listing(fake_s3, monkeypatch, tmp_path):
+    monkeypatch.setattr(s3_storage, "S3_METADATA_INDEX", True)
+    monkeypatch.setattr(s3_storage, "METADATA_INDEX_DIR", str(tmp_path))
+    fake_s3._put("u/existing.txt", b"12345")
+    s3_storage.save_file("u/new.txt", b"abc")
+
+    assert [(f["path"], f["size"]) for f in s3_storage.list_files("u")] == [("u/existing.txt", 5), ("u/new.txt", 3)]
+    lists = sum(1 for op, _ in fake_s3.calls if op == "list_objects_v2")
+    s3_storage.delete_file("u/existing.txt")
+    assert [f["path"] for f in s3_storage.list_files("u")] == ["u/new.txt"]
+    assert sum(1 for op, _ in fake_s3.calls if op == "list_objects_v2") == lists
+
+    fake_s3._put("u/presigned.bin", b"direct")
+    assert s3_storage.reindex("u")["indexed"] == 2
+    assert [f["path"] for f in s3_storage.list_files("u")] == ["u/new.txt", "u/presigned.bin"]
+
+
+def test_list_page_uses_delimiter_and_token(fake_s3):
+    for key in ("u/a", "u/b", "u/docs/x", "u/docs/y", "u/z"):
+        fake_s3._put(key, b"1")
+    page = s3_storage.list_page("u/", delimiter="/", limit=2)
+    assert [f["path"] for f in page["files"]] == ["u/a", "u/b"] and page["next_cursor"]
+    page = s3_storage.list_page("u/", delimiter="/", limit=2, cursor=page["next_cursor"])
+    assert page["folders"] == ["u/docs/"] and [f["path"] for f in page["files"]] == ["u/z"]
+    assert page["next_cursor"] is None
+    with pytest.raises(ValueError):
+        s3_storage.list_page("u/", cursor=s3_storage.listing.encode_cursor({"t": 1}))
+
+
+def _list_calls(fake_s3):
+    return sum(1 for op, _ in fake_s3.calls if op == "list_objects_v2")
+
+
+def test_list_cache_write_through_and_revalidation(fake_s3, monkeypatch):
+    monkeypatch.setattr(s3_storage, "S3_LIST_CACHE_TTL", 0)
+    s3_storage.save_file("u/a.txt", b"a")
+    assert [f["path"] for f in s3_storage.list_files("u")] == ["u/a.txt"]
+    assert _list_calls(fake_s3) == 1
+
+    # our own writes and deletes update the cached listing in place
+    s3_storage.save_file("u/b.txt", b"bb")
+    s3_storage.delete_file("u/a.txt")
+    assert [f["path"] for f in s3_storage.list_files("u")] == ["u/b.txt"]
+    assert _list_calls(fake_s3) == 1
+
+    # another node's write changes the generation object: one relist
+    fake_s3._put("u/c.txt", b"ccc")
+    fake_s3._put(".meta/generations/u", b"other node")
+    assert [f["path"] for f in s3_storage.list_files("u")] == ["u/b.txt", "u/c.txt"]
+    assert _list_calls(fake_s3) == 2
+    s3_storage.list_files("u")
+    assert _list_calls(fake_s3) == 2
+
+
+def test_list_cache_lru_bound():
+    from server.utils.list_cache import ListCache
+    cache = ListCache(max_entries=3)
+    cache.store("a", {"a/1": {}, "a/2": {}}, "g")
+    cache.store("b", {"b/1": {}}, "g")
+    cache.get("a")
+    cache.store("c", {"c/1": {}}, "g")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_search_index_and_cache_agree(fake_s3, monkeypatch, tmp_path):
+    for key in ("u/notes.txt", "u/old/Notes-2023.txt", "u/meeting_notes.md", "u/notes/todo.txt", "u/pic.png"):
+        s3_storage.save_file(key, b"1")
+
+    def paths(**kw):
+        return [(f["path"], f["rank"]) for f in s3_storage.search_files("u", **kw)["files"]]
+
+    from_cache = paths(query="notes")
+    assert from_cache[:3] == [("u/notes.txt", 0), ("u/old/Notes-2023.txt", 1), ("u/meeting_notes.md", 2)]
+    assert from_cache[3] == ("u/notes/todo.txt", 3)
+    page = s3_storage.search_files("u", "notes", limit=3)
+    assert s3_storage.search_files("u", "notes", limit=3, cursor=page["next_cursor"])["files"][0]["path"] \
+        == "u/notes/todo.txt"
+
+    monkeypatch.setattr(s3_storage, "S3_METADATA_INDEX", True)
+    monkeypatch.setattr(s3_storage, "METADATA_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(s3_storage, "_list_cache", s3_storage.list_cache.ListCache(1000))
+    assert paths(query="notes") == from_cache
+    assert paths(ext="png") == [("u/pic.png", 2)]
+
+
+def test_backup_and_restore_use_server_side_copies(fake_s3):
+    for i in range(3):
+        s3_storage.save_file(f"u/f{i}.txt", b"data %d" % i)
+    s3_storage.create_backup_manifest("u", "snap")
+    s3_storage.delete_file("u/f1.txt")
+    s3_storage.save_file("u/f2.txt", b"changed")
+
+    fake_s3.calls.clear()
+    result = s3_storage.restore_from_manifest("u", "snap")
+    assert result["restored_count"] == 2 and result["skipped_count"] == 1
+    assert s3_storage.read_file("u/f1.txt") == b"data 1" and s3_storage.read_file("u/f2.txt") == b"data 2"
+    restored = [kw for op, kw in fake_s3.calls if op == "copy_object" and kw["Key"].startswith("u/")]
+    assert sorted(kw["Key"] for kw in restored) == ["u/f1.txt", "u/f2.txt"]
+    assert all(kw["CopySource"].startswith("backups/u/blobs/") for kw in restored)
+    assert not [kw for op, kw in fake_s3.calls if op == "put_object" and kw["Key"].startswith("u/")]
+
+
+def test_backup_writes_skip_generation_bumps(fake_s3, monkeypatch, tmp_path):
+    monkeypatch.setattr(s3_storage, "S3_METADATA_INDEX", True)
+    monkeypatch.setattr(s3_storage, "METADATA_INDEX_DIR", str(tmp_path))
+    for i in range(5):
+        s3_storage.save_file(f"u/f{i}.txt", b"data %d" % i)
+    s3_storage.list_files("u")
+    fake_s3.calls.clear()
+    s3_storage.create_backup_manifest("u", "snap")
+    generation_calls = [op for op, kw in fake_s3.calls if kw.get("Key", "").startswith(".meta/generations/")]
+    assert generation_calls == []
+    # backups/ is listed straight from the bucket, never from a stale index
+    blobs = s3_storage.list_page("backups/u/blobs/")["files"]
+    assert len(blobs) == 5
+    assert s3_storage.delete_files([b["path"] for b in blobs]) == 5
+    assert s3_storage.list_files("backups/u/blobs") == []
+    assert [op for op, _ in fake_s3.calls].count("delete_objects") == 1
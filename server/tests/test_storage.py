@@ -1,4 +1,5 @@
 # tests/test_storage.py
+import pytest
 from server.utils.storage_factory import storage
 
 def test_local_storage_save_list_read():
@@ -12,3 +13,550 @@ def test_local_storage_save_list_read():
     # Read
     data = storage.read_file("test_user/hello.txt")
     assert data == b"hello"
+
+def test_local_storage_save_stream(data_dir):
+    import io
+    from server.utils import local_storage
+
+    payload = b"x" * 10000
+    meta = local_storage.save_stream("test_user/big.bin", io.BytesIO(payload), chunk_size=1024)
+    assert meta["size"] == len(payload)
+    assert local_storage.read_file("test_user/big.bin") == payload
+    # no temp files left behind
+    assert [f["name"] for f in local_storage.list_files("test_user")] == ["big.bin"]
+
+def test_local_storage_iter_file_range(data_dir):
+    from server.utils import local_storage
+
+    local_storage.save_file("test_user/range.bin", bytes(range(256)))
+    assert b"".join(local_storage.iter_file("test_user/range.bin", 16, 31, chunk_size=5)) == bytes(range(16, 32))
+    assert local_storage.stat_file("test_user/range.bin")["size"] == 256
+    assert local_storage.stat_file("test_user/nope.bin") is None
+
+def test_local_storage_dedup_mode(data_dir, monkeypatch):
+    import os
+    from server.utils import local_storage, chunk_store
+
+    monkeypatch.setattr(local_storage, "LOCAL_STORAGE_MODE", "dedup")
+    payload = os.urandom(600 * 1024)
+    local_storage.save_file("test_user/a.bin", payload)
+    first = chunk_store.stats(local_storage._chunk_root())
+    local_storage.save_file("test_user/b.bin", payload)
+    second = chunk_store.stats(local_storage._chunk_root())
+
+    # identical content adds references, not chunks
+    assert second["chunks"] == first["chunks"]
+    assert second["referenced_bytes"] == 2 * len(payload)
+    assert local_storage.read_file("test_user/b.bin") == payload
+    assert b"".join(local_storage.iter_file("test_user/a.bin", 100000, 300000)) == payload[100000:300001]
+    assert {f["size"] for f in local_storage.list_files("test_user")} == {len(payload)}
+
+    local_storage.delete_file("test_user/a.bin")
+    local_storage.save_file("test_user/b.bin", b"small")
+    assert chunk_store.stats(local_storage._chunk_root())["chunks"] == 1
+    assert local_storage.read_file("test_user/b.bin") == b"small"
+
+def test_chunk_cut_points_match_without_numpy(monkeypatch):
+    import os
+    import pytest
+    from server.utils import chunk_store
+    pytest.importorskip("numpy")
+
+    # the numpy scan must cut exactly where the pure-Python one does, or
+    # stores written with and without it would stop deduplicating
+    data = bytearray(os.urandom(2 * 1024 * 1024)) + bytearray(300 * 1024) + bytearray(os.urandom(5000))
+    def cuts():
+        out, pos = [], 0
+        while pos < len(data):
+            pos = chunk_store._cut_point(data, pos, len(data))
+            out.append(pos)
+        return out
+    fast = cuts()
+    monkeypatch.setattr(chunk_store, "numpy", None)
+    assert cuts() == fast
+
+def test_local_storage_escapes_magic_prefix(data_dir):
+    from server.utils import local_storage
+
+    payload = local_storage._OBJECT_MAGIC + b"user data"
+    local_storage.save_file("test_user/odd.bin", payload)
+    assert local_storage.read_file("test_user/odd.bin") == payload
+    assert local_storage.stat_file("test_user/odd.bin")["size"] == len(payload)
+
+def test_local_storage_compression(data_dir, monkeypatch):
+    import io
+    import os
+    from server.utils import compression, local_storage
+
+    monkeypatch.setattr(compression, "STORAGE_COMPRESSION", "zstd")
+    payload = b"".join(b"row %06d,status=ok\n" % i for i in range(20000))
+    local_storage.save_stream("test_user/data.csv", io.BytesIO(payload), chunk_size=4096)
+    entry = local_storage.list_files("test_user")[0]
+    assert entry["size"] == len(payload)
+    assert entry["stored_size"] < len(payload) // 4
+    assert local_storage.get_local_path("test_user/data.csv") is None
+    assert local_storage.read_file("test_user/data.csv") == payload
+    assert b"".join(local_storage.iter_file("test_user/data.csv", 5000, 5099)) == payload[5000:5100]
+
+    # high-entropy content is kept verbatim
+    noise = os.urandom(8192)
+    local_storage.save_file("test_user/noise.bin", noise)
+    assert local_storage.get_local_path("test_user/noise.bin") is not None
+
+def test_local_storage_sharded_layout_and_migration(data_dir, monkeypatch):
+    import os
+    import time
+    from server.utils import local_storage
+
+    local_storage.save_file("test_user/old.txt", b"legacy")
+    local_storage.save_file("test_user/docs/keep.txt", b"also legacy")
+    monkeypatch.setattr(local_storage, "LOCAL_STORAGE_LAYOUT", "sharded")
+
+    # unmigrated objects stay readable; new writes go to the shard tree
+    assert local_storage.read_file("test_user/old.txt") == b"legacy"
+    local_storage.save_file("test_user/new.txt", b"fresh")
+    assert not os.path.exists(os.path.join(str(data_dir), "test_user", "new.txt"))
+    assert sorted(f["path"] for f in local_storage.list_files("test_user")) == \
+        ["test_user/docs/keep.txt", "test_user/new.txt", "test_user/old.txt"]
+
+    assert local_storage.migrate_to_sharded() == (2, 0)
+    assert not os.path.exists(os.path.join(str(data_dir), "test_user"))
+    assert local_storage.read_file("test_user/docs/keep.txt") == b"also legacy"
+    assert len(local_storage.list_files("test_user")) == 3
+    assert local_storage.list_files("test_use") == []
+
+    assert local_storage.delete_file("test_user/old.txt")
+    assert local_storage.read_file("test_user/old.txt") is None
+    assert len(local_storage.list_files("test_user")) == 2
+
+    # losing the index must not cost the objects it pointed at
+    local_storage.metadata_index._db(local_storage._index_root()).execute("DELETE FROM objects")
+    old = time.time() - 7200
+    for dirpath, _, filenames in os.walk(os.path.join(str(data_dir), ".objects")):
+        for fn in filenames:
+            os.utime(os.path.join(dirpath, fn), (old, old))
+    stray = os.path.join(str(data_dir), ".objects", "00", "00", "0" * 64)
+    os.makedirs(os.path.dirname(stray))
+    with open(stray, "wb") as f:
+        f.write(b"no record")
+    os.utime(stray, (old, old))
+    result = local_storage.reindex("")
+    assert (result["recovered"], result["pruned"], result["orphans"]) == (2, 0, 1)
+    assert os.path.exists(stray)
+    assert sorted(f["path"] for f in local_storage.list_files("test_user")) == \
+        ["test_user/docs/keep.txt", "test_user/new.txt"]
+    assert local_storage.read_file("test_user/new.txt") == b"fresh"
+
+    # once rewritten at its direct path the shard is dead, and only then pruned
+    monkeypatch.setattr(local_storage, "LOCAL_STORAGE_LAYOUT", "direct")
+    local_storage.save_file("test_user/new.txt", b"direct")
+    assert local_storage.reindex("")["pruned"] == 1
+    shard = os.path.join(str(data_dir), local_storage._shard_path("test_user/new.txt"))
+    assert not os.path.exists(shard) and not os.path.exists(shard + ".path")
+
+def test_local_storage_metadata_index(data_dir):
+    import os
+    from server.utils import local_storage, metadata_index
+
+    local_storage.save_file("test_user/a.txt", b"aaa")
+    # written before the tree was ever listed: picked up by the first scan
+    assert [f["path"] for f in local_storage.list_files("test_user")] == ["test_user/a.txt"]
+
+    local_storage.save_file("test_user/b.txt", b"bbbb")
+    os.makedirs(os.path.join(str(data_dir), "test_user", "sub"))
+    with open(os.path.join(str(data_dir), "test_user", "sub", "dropped.txt"), "wb") as f:
+        f.write(b"out of band")
+    os.remove(os.path.join(str(data_dir), "test_user", "a.txt"))
+
+    # listings come from the index, so out-of-band changes need a reindex
+    assert [f["path"] for f in local_storage.list_files("test_user")] == ["test_user/a.txt", "test_user/b.txt"]
+    assert local_storage.reindex("test_user") == {"indexed": 2, "removed": 1, "recovered": 0, "pruned": 0,
+                                                  "orphans": 0}
+    files = local_storage.list_files("test_user")
+    assert [(f["path"], f["size"]) for f in files] == [("test_user/b.txt", 4), ("test_user/sub/dropped.txt", 11)]
+    assert metadata_index.is_scanned(local_storage._index_root(), "test_user")
+
+def test_fs_indexer_applies_out_of_band_changes(data_dir):
+    import os
+    import time
+    from server.utils import local_storage
+    from server.utils.fs_indexer import FsIndexer
+
+    def paths():
+        return [f["path"] for f in local_storage.list_files("test_user")]
+
+    def wait_for(expected):
+        deadline = time.time() + 5
+        while paths() != expected and time.time() < deadline:
+            time.sleep(0.05)
+        assert paths() == expected
+
+    local_storage.save_file("test_user/kept.txt", b"k")
+    assert paths() == ["test_user/kept.txt"]
+    indexer = FsIndexer(str(data_dir)).start()
+    try:
+        deadline = time.time() + 5
+        while not indexer.watches and time.time() < deadline:
+            time.sleep(0.05)
+        user_dir = data_dir / "test_user"
+        (user_dir / "dropped.txt").write_bytes(b"copied in by an admin")
+        wait_for(["test_user/dropped.txt", "test_user/kept.txt"])
+
+        os.makedirs(user_dir / "restored" / "deep")
+        (user_dir / "restored" / "deep" / "r.txt").write_bytes(b"r")
+        wait_for(["test_user/dropped.txt", "test_user/kept.txt", "test_user/restored/deep/r.txt"])
+
+        os.remove(user_dir / "kept.txt")
+        os.rename(user_dir / "restored", user_dir / "moved")
+        wait_for(["test_user/dropped.txt", "test_user/moved/deep/r.txt"])
+    finally:
+        indexer.stop()
+
+def test_incremental_backups(data_dir, monkeypatch):
+    import hashlib
+    from server.utils import backups, local_storage
+    monkeypatch.setattr(backups, "BACKUP_FULL_INTERVAL", 3)
+    local_storage.save_file("test_user/a.txt", b"a")
+    local_storage.save_file("test_user/b.txt", b"b")
+
+    first = local_storage.create_backup_manifest("test_user", "b1")
+    assert (first["type"], first["file_count"], first["added"]) == ("full", 2, 2)
+
+    captured = []
+    real_capture = backups._capture
+    monkeypatch.setattr(backups, "_capture", lambda store, user, path: captured.append(path) or real_capture(store, user, path))
+    local_storage.save_file("test_user/b.txt", b"bb")
+    local_storage.save_file("test_user/c.txt", b"c")
+    local_storage.delete_file("test_user/a.txt")
+    second = local_storage.create_backup_manifest("test_user", "b2")
+    assert (second["type"], second["added"], second["modified"], second["deleted"]) == ("incremental", 1, 1, 1)
+    assert sorted(captured) == ["test_user/b.txt", "test_user/c.txt"]  # unchanged files aren't read
+
+    manifest = backups.load_manifest(local_storage, "test_user", "b2")
+    assert manifest["parent"] == "b1" and manifest["deleted"] == ["test_user/a.txt"]
+    state = backups.materialize(local_storage, "test_user", "b2")
+    assert sorted(state) == ["test_user/b.txt", "test_user/c.txt"]
+    assert state["test_user/b.txt"]["sha256"] == hashlib.sha256(b"bb").hexdigest()
+
+    # nothing changed: an empty incremental, then the interval forces a synthetic full
+    assert local_storage.create_backup_manifest("test_user", "b3")["type"] == "incremental"
+    fourth = local_storage.create_backup_manifest("test_user")
+    assert fourth["type"] == "full" and fourth["file_count"] == 2
+    assert [s["name"] for s in backups.load_index(local_storage, "test_user")] == ["b1", "b2", "b3", fourth["name"]]
+    with pytest.raises(ValueError):
+        local_storage.create_backup_manifest("test_user", "b1")
+
+@pytest.mark.parametrize("mode", ["plain", "dedup"])
+def test_restore_links_blobs_and_resumes(data_dir, monkeypatch, mode):
+    import os
+    from server.utils import backups, local_storage
+    monkeypatch.setattr(local_storage, "LOCAL_STORAGE_MODE", mode)
+    monkeypatch.setattr(backups, "RESTORE_CHECKPOINT_EVERY", 1)
+    monkeypatch.setattr(backups, "BACKUP_WORKERS", 2)
+    for i in range(6):
+        local_storage.save_file(f"test_user/f{i}.txt", b"content %d" % i)
+    local_storage.create_backup_manifest("test_user", "snap")
+    for i in range(6):
+        local_storage.delete_file(f"test_user/f{i}.txt")
+
+    # the third copy dies mid-restore; the checkpoint remembers the rest
+    real_copy = local_storage.copy_file
+    calls = []
+    def flaky_copy(src, dst):
+        calls.append(dst)
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        return real_copy(src, dst)
+    monkeypatch.setattr(local_storage, "copy_file", flaky_copy)
+    with pytest.raises(KeyboardInterrupt):
+        local_storage.restore_from_manifest("test_user", "snap")
+    ckpt = backups._read_json(local_storage, backups.checkpoint_path("test_user", "snap"))
+    assert ckpt is not None and ckpt["next"] < 6
+
+    monkeypatch.setattr(local_storage, "copy_file", real_copy)
+    result = local_storage.restore_from_manifest("test_user", "snap")
+    assert result["resumed"] and result["failed_count"] == 0
+    # files finished after the last checkpoint are found in place and skipped
+    assert result["restored_count"] + result["skipped_count"] == 6 - ckpt["next"] - len(ckpt["done"])
+    assert [local_storage.read_file(f"test_user/f{i}.txt") for i in range(6)] == [b"content %d" % i for i in range(6)]
+    assert local_storage.read_file(backups.checkpoint_path("test_user", "snap")) is None
+    # a second restore finds everything as backed up; missing blobs are reported per file
+    assert local_storage.restore_from_manifest("test_user", "snap")["skipped_count"] == 6
+    if mode == "plain":
+        # restored and captured files never share an inode with the blob, so
+        # an in-place write to a live file leaves the backup as it was
+        live = local_storage._object_path("test_user/f0.txt")
+        assert os.stat(live).st_nlink == 1
+        with open(live, "r+b") as f:
+            f.write(b"CLOBBERED")
+        entry, chunks = backups.open_file(local_storage, "test_user", "snap", "test_user/f0.txt")
+        assert b"".join(chunks) == b"content 0"
+        local_storage.save_file("test_user/g.txt", b"original")
+        local_storage.create_backup_manifest("test_user", "snap2")
+        with open(local_storage._object_path("test_user/g.txt"), "r+b") as f:
+            f.write(b"CLOBBERED")
+        entry, chunks = backups.open_file(local_storage, "test_user", "snap2", "test_user/g.txt")
+        assert b"".join(chunks) == b"original"
+    sha = backups.materialize(local_storage, "test_user", "snap")["test_user/f1.txt"]["sha256"]
+    local_storage.delete_file(backups.blob_path("test_user", sha))
+    result = local_storage.restore_from_manifest("test_user", "snap", target="restored")
+    assert result["restored_count"] == 5 and [f["path"] for f in result["failed_files"]] == ["test_user/f1.txt"]
+    assert local_storage.read_file("test_user/restored/f2.txt") == b"content 2"
+
+def test_archive_snapshots(data_dir, monkeypatch):
+    import io
+    import tarfile
+    from server.utils import backups, compression, local_storage
+    if not compression.zstandard:
+        pytest.skip("zstandard not installed")
+    files = {"test_user/a.txt": b"alpha" * 300, "test_user/docs/b.bin": bytes(range(256)) * 9, "test_user/empty": b""}
+    for path, content in files.items():
+        local_storage.save_file(path, content)
+    local_storage.create_backup_manifest("test_user", "inc")
+
+    record = local_storage.create_backup_manifest("test_user", "arc", mode="archive")
+    assert (record["type"], record["parent"], record["file_count"]) == ("archive", None, 3)
+    # archives stay out of the incremental chain
+    assert local_storage.create_backup_manifest("test_user", "next")["parent"] == "inc"
+
+    # the whole object is a plain multi-frame tar.zst
+    manifest = backups.load_manifest(local_storage, "test_user", "arc")
+    reader = compression.zstandard.ZstdDecompressor().stream_reader(
+        io.BytesIO(local_storage.read_file(manifest["archive"])), read_across_frames=True)
+    raw = reader.read()
+    with tarfile.open(fileobj=io.BytesIO(raw)) as tar:
+        assert {m.name: tar.extractfile(m).read() for m in tar.getmembers()} == {
+            p.split("/", 1)[1]: c for p, c in files.items()}
+
+    # one member costs one ranged read
+    reads = []
+    real_iter = local_storage.iter_file
+    monkeypatch.setattr(local_storage, "iter_file", lambda path, *a: reads.append((path, a)) or real_iter(path, *a))
+    entry, chunks = backups.open_file(local_storage, "test_user", "arc", "test_user/docs/b.bin")
+    assert b"".join(chunks) == files["test_user/docs/b.bin"]
+    assert [r for r in reads if r[0] == manifest["archive"]] == [(manifest["archive"], (entry["offset"], entry["offset"] + entry["length"] - 1))]
+    monkeypatch.setattr(local_storage, "iter_file", real_iter)
+
+    result = local_storage.restore_from_manifest("test_user", "arc", target="back")
+    assert result["restored_count"] == 3 and result["failed_count"] == 0
+    for path, content in files.items():
+        assert local_storage.read_file(path.replace("test_user/", "test_user/back/")) == content
+
+def test_archive_pads_short_member_in_bounded_blocks(monkeypatch):
+    from server.utils import archives
+    # see the uncompressed stream
+    monkeypatch.setattr(archives.compression, "compress_chunks", lambda chunks: chunks)
+    def failing():
+        yield b"abc"
+        raise OSError("gone")
+    size = 3 * archives._PAD_STEP + 5
+    index = []
+    out = list(archives.iter_archive([{"name": "big", "size": size, "mtime": 0, "chunks": failing()}], index))
+    assert index[0]["incomplete"] and max(len(b) for b in out) <= archives._PAD_STEP
+    header = index[0]["header"]
+    body = b"".join(out)[header:header + size]
+    assert body[:3] == b"abc" and body.count(b"\0") == size - 3
+
+def test_delete_snapshot_and_gc(data_dir, monkeypatch):
+    import hashlib
+    from server.utils import backups, local_storage
+    monkeypatch.setattr(backups, "BACKUP_GC_GRACE_SECONDS", 0)
+    sha = lambda content: hashlib.sha256(content).hexdigest()
+    blobs = lambda: sorted(e["path"].rsplit("/", 1)[1] for e in local_storage.iter_listing("backups/test_user/blobs/"))
+    local_storage.save_file("test_user/keep.txt", b"keep")
+    local_storage.save_file("test_user/old.txt", b"old")
+    local_storage.create_backup_manifest("test_user", "s1")
+    local_storage.save_file("test_user/old.txt", b"new")
+    local_storage.create_backup_manifest("test_user", "s2")
+    local_storage.create_backup_manifest("test_user", "s3")
+    # unchanged files add no blobs and no references
+    assert blobs() == sorted(sha(c) for c in (b"keep", b"old", b"new"))
+    assert backups._read_json(local_storage, backups.refs_path("test_user")) == {
+        sha(b"keep"): 1, sha(b"old"): 1, sha(b"new"): 1}
+
+    # s2 keeps its state once s1 is gone: it's rewritten as full
+    before = backups.materialize(local_storage, "test_user", "s3")
+    assert local_storage.delete_file("test_user/keep.txt") and backups.delete_snapshot(local_storage, "test_user", "s1")["freed_blobs"] == 1
+    assert [(s["name"], s["type"], s["parent"]) for s in backups.load_index(local_storage, "test_user")] == [
+        ("s2", "full", None), ("s3", "incremental", "s2")]
+    assert backups.materialize(local_storage, "test_user", "s3") == before
+
+    # a leaked temporary and an unreferenced blob are swept by the full cycle
+    local_storage.save_file("backups/test_user/blobs/tmp/leftover", b"x")
+    local_storage.save_file(backups.blob_path("test_user", sha(b"stray")), b"stray")
+    monkeypatch.setattr(backups, "BACKUP_GC_GRACE_SECONDS", -60)
+    results = []
+    while not (results and results[-1]["cycle_finished"]):
+        results.append(backups.gc_step(local_storage, "test_user", budget=1))
+    assert results[0]["deleted"] == 1 and len(results) > 3  # queued blob first, then small batches
+    assert sum(r["deleted"] for r in results) == 3
+    assert blobs() == sorted(sha(c) for c in (b"keep", b"new"))
+
+    # deleting everything leaves nothing behind
+    backups.delete_snapshot(local_storage, "test_user", "s3")
+    backups.delete_snapshot(local_storage, "test_user", "s2")
+    while not backups.gc_step(local_storage, "test_user")["cycle_finished"]:
+        pass
+    assert blobs() == [] and backups._read_json(local_storage, backups.refs_path("test_user")) == {}
+    with pytest.raises(ValueError):
+        backups.delete_snapshot(local_storage, "test_user", "s1")
+
+@pytest.mark.parametrize("codec", ["zstd", "none"])
+def test_manifest_blocks_and_lookup(data_dir, monkeypatch, codec):
+    import json
+    from server.utils import backups, local_storage, manifests
+    monkeypatch.setattr(manifests, "MANIFEST_BLOCK_BYTES", 2048)
+    monkeypatch.setattr(manifests, "MANIFEST_COMPRESSION", codec)
+    files = [{"path": f"u/f{i:05d}", "size": i, "sha256": "%064x" % i} for i in range(3000)]
+    manifests.write_manifest(local_storage, "m.manifest", {"type": "full"}, {"files": iter(files), "added": []})
+
+    reads = []
+    real_iter = local_storage.iter_file
+    monkeypatch.setattr(local_storage, "iter_file", lambda path, *a: reads.append(a) or real_iter(path, *a))
+    reader = manifests.open_manifest(local_storage, "m.manifest")
+    assert reader.count("files") == 3000 and len(reads) == 1  # the tail holds the footer
+    assert reader.lookup("files", "u/f01234") == files[1234]
+    assert reader.lookup("files", "a") is None and reader.lookup("files", "u/z") is None
+    assert len(reads) == 2  # one block for the hit, nothing for paths outside every block
+    assert list(reader.iter("files")) == files and reader.to_dict()["added"] == []
+    with pytest.raises(ValueError):
+        manifests.write_manifest(local_storage, "bad.manifest", {}, {"files": reversed(files[:2])})
+
+    # snapshots written as single JSON documents stay readable
+    monkeypatch.setattr(local_storage, "iter_file", real_iter)
+    local_storage.save_file("test_user/a.txt", b"a")
+    local_storage.create_backup_manifest("test_user", "new")
+    legacy = {"name": "old", "user_id": "test_user", "type": "full", "parent": None, "file_count": 1,
+              "files": [{"path": "test_user/a.txt", "size": 1, "updated": "x", "sha256": None}]}
+    local_storage.save_file(backups.legacy_manifest_path("test_user", "old"), json.dumps(legacy).encode())
+    index = backups.load_index(local_storage, "test_user")
+    backups._write_json(local_storage, backups.index_path("test_user"),
+                        {"snapshots": [dict(index[0], name="old")] + index})
+    assert backups.find_entry(local_storage, "test_user", "old", "test_user/a.txt")["updated"] == "x"
+    assert backups.find_entry(local_storage, "test_user", "new", "test_user/a.txt")["sha256"]
+    assert backups.find_entry(local_storage, "test_user", "new", "test_user/b.txt") is None
+
+def test_scrub_reports_damage_and_resumes(data_dir, monkeypatch):
+    import hashlib
+    from server.utils import backups, compression, local_storage
+    monkeypatch.setattr(backups, "SCRUB_CHECKPOINT_EVERY", 1)
+    monkeypatch.setattr(backups, "SCRUB_WORKERS", 1)
+    for i in range(5):
+        local_storage.save_file(f"test_user/f{i}.txt", b"content %d" % i)
+    local_storage.create_backup_manifest("test_user", "snap")
+    sha = lambda i: hashlib.sha256(b"content %d" % i).hexdigest()
+    clean = backups.scrub(local_storage, "test_user", "snap")
+    assert (clean["checked_count"], clean["missing"], clean["corrupt"]) == (5, [], [])
+
+    local_storage.save_file(backups.blob_path("test_user", sha(1)), b"bit rot")
+    local_storage.delete_file(backups.blob_path("test_user", sha(3)))
+    # the third read dies; the checkpoint keeps what was already verified
+    real_iter = local_storage.iter_file
+    reads = []
+    def flaky_iter(path, *a):
+        reads.append(path)
+        if len(reads) == 3:
+            raise KeyboardInterrupt
+        return real_iter(path, *a)
+    monkeypatch.setattr(local_storage, "iter_file", flaky_iter)
+    with pytest.raises(KeyboardInterrupt):
+        backups.scrub(local_storage, "test_user")
+    monkeypatch.setattr(local_storage, "iter_file", real_iter)
+    report = backups.scrub(local_storage, "test_user")
+    assert report["resumed"] and report["checked_count"] == 5 and report["object_count"] == 5
+    assert [m["sha256"] for m in report["missing"]] == [sha(3)]
+    assert [c["sha256"] for c in report["corrupt"]] == [sha(1)]
+    assert backups.load_scrub_report(local_storage, "test_user")["finished_at"] == report["finished_at"]
+    assert local_storage.stat_file(backups.scrub_path("test_user", checkpoint=True)) is None
+
+    if compression.zstandard:
+        local_storage.create_backup_manifest("test_user", "arc", mode="archive")
+        manifest = backups.load_manifest(local_storage, "test_user", "arc")
+        raw = bytearray(local_storage.read_file(manifest["archive"]))
+        member = manifest["files"][2]
+        raw[member["offset"]:member["offset"] + member["length"]] = b"\x5a" * member["length"]
+        local_storage.save_file(manifest["archive"], bytes(raw))
+        report = backups.scrub(local_storage, "test_user", "arc")
+        assert [c["path"] for c in report["corrupt"]] == [member["path"]] and report["checked_count"] == 5
+
+def test_merkle_trees_diff_changed_subtrees(data_dir):
+    from server.utils import backups, local_storage, merkle, metadata_index
+    for d in ("docs", "photos/2020", "photos/2021", "music/a", "music/b"):
+        for i in range(3):
+            local_storage.save_file(f"test_user/{d}/f{i}.txt", b"x" * i)
+    local_storage.create_backup_manifest("test_user", "s1")
+    local_storage.save_file("test_user/photos/2021/f1.txt", b"changed")
+    local_storage.save_file("test_user/docs/new.txt", b"new")
+    local_storage.delete_file("test_user/docs/f0.txt")
+    for i in range(3):
+        local_storage.delete_file(f"test_user/music/b/f{i}.txt")
+
+    # the triggers keep the live tree equal to one built from scratch
+    live = local_storage.dir_tree("test_user")
+    built = merkle.build(local_storage.iter_listing("test_user"))
+    assert {d: live(d) for d in built} == built and live("test_user/music/b") is None
+    root = metadata_index._db(local_storage._index_root()).execute(
+        "SELECT files FROM dir_hashes WHERE path = 'test_user'").fetchone()[0]
+    assert root == 12
+
+    expected = {"added": ["test_user/docs/new.txt"], "modified": ["test_user/photos/2021/f1.txt"],
+                "deleted": ["test_user/docs/f0.txt"] + [f"test_user/music/b/f{i}.txt" for i in range(3)]}
+    changes = backups.compare_snapshot(local_storage, "test_user", "s1")
+    # root, docs, photos, photos/2021, music, music/b: untouched subtrees aren't read
+    assert changes == dict(expected, nodes_read=6)
+    local_storage.create_backup_manifest("test_user", "s2")
+    assert backups.compare_snapshot(local_storage, "test_user", "s1", "s2") == dict(expected, nodes_read=6)
+    assert backups.compare_snapshot(local_storage, "test_user", "s2")["nodes_read"] == 1
+    # folding s1 into s2 rewrites s2 as a full with the same tree
+    backups.delete_snapshot(local_storage, "test_user", "s1")
+    assert backups.compare_snapshot(local_storage, "test_user", "s2") == {
+        "added": [], "modified": [], "deleted": [], "nodes_read": 1}
+
+def test_retention_prunes_expired_snapshots_in_bulk(data_dir, monkeypatch):
+    from datetime import datetime, timedelta
+    from server.utils import backups, local_storage
+    monkeypatch.setattr(backups, "BACKUP_GC_GRACE_SECONDS", 0)
+    now = datetime.utcnow()
+    ages = {"s1": 60, "s2": 40, "s3": 10.2, "s4": 10, "s5": 0}
+    for i, name in enumerate(ages):
+        local_storage.save_file("test_user/f.txt", b"v%d" % i)
+        local_storage.create_backup_manifest("test_user", name, mode="incremental")
+    index = backups._read_json(local_storage, backups.index_path("test_user"))
+    for record in index["snapshots"]:
+        record["created_at"] = (now - timedelta(days=ages[record["name"]])).isoformat()
+    backups._write_json(local_storage, backups.index_path("test_user"), index)
+
+    with pytest.raises(ValueError):
+        backups.set_retention(local_storage, "test_user", daily=-1)
+    assert backups.prune(local_storage, "test_user")["expired"] == []  # no policy: keep everything
+    backups.set_retention(local_storage, "test_user", daily=1, weekly=2, monthly=1)
+    # s5 is the newest day and month, s4 the newest of the previous week
+    plan = backups.prune(local_storage, "test_user", dry_run=True)
+    assert plan["expired"] == ["s1", "s2", "s3"] and len(backups.load_index(local_storage, "test_user")) == 5
+
+    calls = []
+    real_delete_files = local_storage.delete_files
+    monkeypatch.setattr(local_storage, "delete_files", lambda paths: calls.append(len(paths)) or real_delete_files(paths))
+    monkeypatch.setattr(local_storage, "delete_file", lambda path: pytest.fail("deleted one at a time"))
+    result = backups.prune(local_storage, "test_user")
+    assert result == {"expired": ["s1", "s2", "s3"], "dry_run": False, "freed_blobs": 3, "reclaimed_blobs": 3}
+    # the snapshots' objects in one batch, their blobs in another
+    assert calls[:2] == [10, 3]
+    assert [(s["name"], s["type"]) for s in backups.load_index(local_storage, "test_user")] == [
+        ("s4", "full"), ("s5", "incremental")]
+    assert backups.materialize(local_storage, "test_user", "s4")["test_user/f.txt"]["size"] == 2
+    assert len(list(local_storage.iter_listing("backups/test_user/blobs/"))) == 2
+    assert local_storage.stat_file(backups.manifest_path("test_user", "s1")) is None
+
+def test_backup_lock_excludes_other_holders(data_dir):
+    import threading
+    from server.utils import backups, local_storage
+    local_storage.save_file("test_user/a.txt", b"a")
+    done = threading.Event()
+    # a separate open of the lock file, as another process would make
+    with backups._user_lock("test_user"):
+        worker = threading.Thread(target=lambda: local_storage.create_backup_manifest("test_user", "b") and done.set())
+        worker.start()
+        assert not done.wait(0.3)
+    worker.join(5)
+    assert done.is_set() and [s["name"] for s in backups.load_index(local_storage, "test_user")] == ["b"]
@@ -0,0 +1,53 @@
+# transfer_app.py — minimal signed-URL file handler
+#
+# Serves /transfer/<token> for the local storage backend. It verifies only
+# the HMAC signature and expiry (no Cognito round trip), so it can run as its
+# own gunicorn process and scale separately from the API:
+#
+#   gunicorn "transfer_app:create_transfer_app()" --bind 0.0.0.0:5001
+#
+# create_app() also mounts these routes so a single process works in dev.
+from flask import Flask, request, jsonify
+
+try:
+    from .utils.logger import log_info
+    from .utils.storage_factory import storage
+    from .utils.http_range import send_object
+    from .utils import signed_urls
+    from .services.cognito_auth_service import update_user_storage
+except ImportError:
+    from utils.logger import log_info
+    from utils.storage_factory import storage
+    from utils.http_range import send_object
+    from utils import signed_urls
+    from services.cognito_auth_service import update_user_storage
+
+def register_transfer_routes(app):
+    @app.route("/transfer/<token>", methods=["GET", "HEAD", "PUT"])
+    def transfer(token):
+        method = "PUT" if request.method == "PUT" else "GET"
+        claims = signed_urls.verify(token, method)
+        if claims is None:
+            return jsonify({"status": "error", "message": "invalid or expired link"}), 403
+        path = claims["p"]
+
+        if method == "GET":
+            resp = send_object(storage, path, as_attachment=request.args.get("attachment") == "1")
+            if resp is None:
+                return jsonify({"status": "error", "message": "file not found"}), 404
+            return resp
+
+        expected = claims.get("s")
+        if expected is not None and request.content_length != expected:
+            return jsonify({"status": "error", "message": f"Content-Length must be {expected}"}), 400
+        meta = storage.save_stream(path, request.stream)
+        if claims.get("o"):
+            # charged now that the bytes are stored, not when the URL was issued
+            update_user_storage(claims["o"], meta["size"])
+        log_info("file uploaded (signed url)", path=path, size=meta["size"])
+        return jsonify({"status": "success", "file": meta}), 200
+
+def create_transfer_app():
+    app = Flask(__name__)
+    register_transfer_routes(app)
+    return app
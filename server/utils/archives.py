@@ -0,0 +1,80 @@
+# utils/archives.py — seekable tar+zstd archives
+#
+# The archive is an ordinary tar stream (`zstd -d | tar x` unpacks it), but
+# every member — header, data and padding — is compressed as its own zstd
+# frame. An index of (offset, length) per member therefore lets one ranged
+# read of `length` bytes recover a single file without touching the rest.
+import hashlib
+import tarfile
+from . import compression
+from .logger import log_warn
+
+_BLOCK = 512
+# zero padding for a member that came up short is yielded this much at a time
+_PAD_STEP = 1 << 20
+# what a damaged member raises while being decoded
+FORMAT_ERRORS = (compression.zstandard.ZstdError,) if compression.zstandard is not None else ()
+
+def available():
+    return compression.zstandard is not None
+
+def _header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+def iter_archive(members, index):
+    """Yield the compressed archive for `members`, appending to `index`.
+
+    members yields dicts with name, size, mtime and chunks (an iterable of
+    the file's bytes). size is written into the tar header up front: a file
+    that comes up short is zero-padded and its index entry marked
+    "incomplete", bytes past size are left out. index receives one
+    {name, size, sha256, offset, length, header} per member, offsets being
+    into the compressed archive.
+    """
+    offset = 0
+    for m in members:
+        header = _header(m["name"], m["size"], m["mtime"])
+        digest = hashlib.sha256()
+        written = 0
+        incomplete = False
+
+        def body():
+            nonlocal written, incomplete
+            yield header
+            try:
+                for chunk in m["chunks"]:
+                    chunk = chunk[:m["size"] - written]
+                    digest.update(chunk)
+                    written += len(chunk)
+                    yield chunk
+            except Exception as e:
+                log_warn("archive member could not be read", name=m["name"], error=str(e))
+            if written < m["size"]:
+                incomplete = True
+                pad = bytes(min(m["size"] - written, _PAD_STEP))
+                for remaining in range(m["size"] - written, 0, -len(pad)):
+                    yield pad[:remaining]
+            yield b"\0" * (-m["size"] % _BLOCK)
+
+        length = 0
+        for out in compression.compress_chunks(body()):
+            length += len(out)
+            yield out
+        entry = {"name": m["name"], "size": m["size"], "sha256": digest.hexdigest(),
+                 "offset": offset, "length": length, "header": len(header)}
+        if incomplete:
+            entry["incomplete"] = True
+        index.append(entry)
+        offset += length
+    yield compression.compress_bytes(b"\0" * (2 * _BLOCK))  # end-of-archive marker
+
+def read_member(chunks, header, size):
+    # file bytes from the compressed frame of one member (the ranged read
+    # [offset, offset + length - 1] of the archive)
+    if size == 0:
+        return iter(())
+    return compression.slice_chunks(compression.decompress_chunks(chunks), header, header + size - 1)
@@ -0,0 +1,999 @@
+# utils/backups.py — backend-neutral snapshot manifests with incremental chains
+#
+# A snapshot is either "full" (every file) or "incremental" (only what was
+# added, modified or deleted since its parent). Content of new and changed
+# files is kept under backups/<user>/blobs/ keyed by sha256, so unchanged
+# content is stored once however many snapshots reference it.
+# backups/<user>/index.json lists a user's snapshots oldest first, so the
+# parent is found without listing and a snapshot's full state is rebuilt
+# from the nearest full manifest forward. Every BACKUP_FULL_INTERVAL-th snapshot is written as a
+# synthetic full built from that state, which bounds the chain length.
+# Manifests use the block-indexed format of utils/manifests.py, so one
+# file's entry is found without reading whole manifests (find_entry).
+# Each manifest also carries a "dirs" section of directory hash tree nodes
+# (utils/merkle.py): every node for a full or archive snapshot, the changed
+# ones for an incremental. compare_snapshot diffs a snapshot against another
+# or against the live tree kept by the metadata index, reading only the
+# directories whose hashes differ.
+#
+# Blobs are reference-counted per manifest entry in backups/<user>/refs.json.
+# Deleting a snapshot folds it into its incremental child and queues blobs
+# whose count hits zero; gc_step removes those and runs an incremental
+# mark-and-sweep over every manifest and blob, so leaked blobs (interrupted
+# captures, drifted counts) are reclaimed too, one bounded batch per call.
+# prune applies a per-user retention policy (backups/<user>/retention.json,
+# keep N daily/weekly/monthly) read against the index alone, deleting the
+# expired snapshots in one batch and draining the blobs they freed.
+#
+# "archive" snapshots are self-contained instead: one seekable tar+zstd
+# object (see utils/archives.py) plus a manifest indexing its members.
+# They stand outside the incremental chain.
+#
+# Functions take the storage adapter module ("store") for I/O, the same
+# way each adapter drives upload_sessions. Long-running ones accept a
+# progress(files_done, bytes_done, files_total, bytes_total) callback
+# (totals None while unknown); an exception it raises aborts the run.
+import os
+import json
+import uuid
+import fcntl
+import time
+import hashlib
+from collections import Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from . import archives, manifests, merkle
+from .logger import log_info, log_warn
+from .rate_limit import TokenBucket
+from .streams import IterStream
+
+BACKUP_FULL_INTERVAL = int(os.getenv("BACKUP_FULL_INTERVAL", "7"))
+# parallel copies while capturing and restoring (server-side on S3, links locally)
+BACKUP_WORKERS = int(os.getenv("BACKUP_WORKERS", "16"))
+# a restore persists its progress after this many files
+RESTORE_CHECKPOINT_EVERY = int(os.getenv("RESTORE_CHECKPOINT_EVERY", "1000"))
+# blobs younger than this (relative to the start of a gc cycle) are never
+# swept, covering captures that haven't reached a manifest yet
+BACKUP_GC_GRACE_SECONDS = int(os.getenv("BACKUP_GC_GRACE_SECONDS", "3600"))
+# manifests read or blobs examined per gc_step call
+BACKUP_GC_BATCH = int(os.getenv("BACKUP_GC_BATCH", "1000"))
+# scrubbing re-reads backup content: its threads and read budget (bytes/s, 0: unlimited)
+SCRUB_WORKERS = int(os.getenv("SCRUB_WORKERS", "4"))
+SCRUB_BANDWIDTH_LIMIT = int(os.getenv("SCRUB_BANDWIDTH_LIMIT", str(64 * 1024 * 1024)))
+SCRUB_CHECKPOINT_EVERY = int(os.getenv("SCRUB_CHECKPOINT_EVERY", "1000"))
+# retention: the newest snapshot of each of the last N days, ISO weeks and
+# months is kept; these fill in fields a user's policy leaves out
+BACKUP_KEEP_DAILY = int(os.getenv("BACKUP_KEEP_DAILY", "7"))
+BACKUP_KEEP_WEEKLY = int(os.getenv("BACKUP_KEEP_WEEKLY", "4"))
+BACKUP_KEEP_MONTHLY = int(os.getenv("BACKUP_KEEP_MONTHLY", "12"))
+MODES = ("auto", "full", "incremental", "archive")
+
+# snapshot writes, deletes, gc batches and prunes of one user run one at a
+# time across every thread and process on the host (gunicorn workers, their
+# job threads, manage.py): an flock on a per-user file in this directory
+BACKUP_LOCK_DIR = os.getenv("BACKUP_LOCK_DIR", os.path.join(os.getenv("DATA_DIR", "./data"), ".locks", "backups"))
+
+@contextmanager
+def _user_lock(user_id):
+    # not reentrant: a holder must not take it again, even from another thread
+    os.makedirs(BACKUP_LOCK_DIR, exist_ok=True)
+    name = hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+    with open(os.path.join(BACKUP_LOCK_DIR, name), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _safe_segment(s):
+    return isinstance(s, str) and 0 < len(s) <= 200 and "/" not in s and "\\" not in s \
+        and ".." not in s and not any(ord(c) < 32 or ord(c) == 127 for c in s)
+
+def check_name(name):
+    # a snapshot name becomes one segment of several storage paths, so it
+    # must not be able to leave backups/<user_id>/
+    if not _safe_segment(name):
+        raise ValueError(f"invalid backup name {name!r}")
+    return name
+
+def check_target(target):
+    # a restore target is a folder below <user_id>/; None restores in place
+    target = (target or "").strip("/")
+    if not target:
+        return None
+    if any(part == "." or not _safe_segment(part) for part in target.split("/")):
+        raise ValueError(f"invalid restore target {target!r}")
+    return target
+
+def manifest_path(user_id, name):
+    return f"backups/{user_id}/{check_name(name)}.manifest"
+
+def legacy_manifest_path(user_id, name):
+    # single-document JSON manifests written before utils/manifests.py
+    return f"backups/{user_id}/{check_name(name)}_manifest.json"
+
+def index_path(user_id):
+    return f"backups/{user_id}/index.json"
+
+def blob_path(user_id, sha256):
+    return f"backups/{user_id}/blobs/{sha256[:2]}/{sha256}"
+
+def archive_path(user_id, name):
+    return f"backups/{user_id}/{check_name(name)}.tar.zst"
+
+def checkpoint_path(user_id, name):
+    return f"backups/{user_id}/restores/{check_name(name)}.json"
+
+def scrub_path(user_id, name=None, checkpoint=False):
+    # report of the last scrub of one snapshot, or of every backup (name None)
+    base = f"backups/{user_id}/scrubs/{'snapshot-' + check_name(name) if name else 'all'}"
+    return base + (".checkpoint.json" if checkpoint else ".json")
+
+def retention_path(user_id):
+    return f"backups/{user_id}/retention.json"
+
+def refs_path(user_id):
+    return f"backups/{user_id}/refs.json"
+
+def gc_path(user_id):
+    return f"backups/{user_id}/gc.json"
+
+def _read_json(store, path):
+    raw = store.read_file(path)
+    return json.loads(raw) if raw is not None else None
+
+def _write_json(store, path, obj):
+    store.save_file(path, json.dumps(obj, separators=(",", ":")).encode("utf-8"))
+
+def load_index(store, user_id):
+    return (_read_json(store, index_path(user_id)) or {}).get("snapshots", [])
+
+def load_scrub_report(store, user_id, name=None):
+    return _read_json(store, scrub_path(user_id, name))
+
+def load_retention(store, user_id):
+    return _read_json(store, retention_path(user_id))
+
+def open_manifest(store, user_id, name):
+    # a reader (see utils/manifests.py) for snapshot `name`, or None
+    reader = manifests.open_manifest(store, manifest_path(user_id, name))
+    if reader is None:
+        legacy = _read_json(store, legacy_manifest_path(user_id, name))
+        reader = manifests.MemoryManifest(legacy) if legacy is not None else None
+    return reader
+
+def load_manifest(store, user_id, name):
+    # the whole manifest as one dict; prefer open_manifest for large ones
+    reader = open_manifest(store, user_id, name)
+    return reader.to_dict() if reader is not None else None
+
+def _write_manifest(store, user_id, manifest):
+    meta = {k: v for k, v in manifest.items() if k not in manifests.SECTIONS}
+    if manifest["type"] == "incremental":
+        sections = {"added": manifest["added"], "modified": manifest["modified"],
+                    "deleted": ({"path": p} for p in manifest["deleted"])}
+    else:
+        sections = {"files": manifest["files"]}
+    sections["dirs"] = manifest["dirs"]
+    path = manifest_path(user_id, manifest["name"])
+    manifests.write_manifest(store, path, meta, sections)
+    return path
+
+def _blob_refs(reader):
+    # sha256 -> count of the entries this manifest itself stores
+    if reader is None or reader.meta["type"] == "archive":
+        return Counter()
+    sections = ("files",) if reader.meta["type"] == "full" else ("added", "modified")
+    return Counter(e["sha256"] for section in sections for e in reader.iter(section) if e.get("sha256"))
+
+def _load_refs(store, user_id, snapshots):
+    refs = _read_json(store, refs_path(user_id))
+    if refs is None:
+        # snapshots written before refcounting: count them once
+        refs = Counter()
+        for record in snapshots:
+            refs.update(_blob_refs(open_manifest(store, user_id, record["name"])))
+        refs = dict(refs)
+    return refs
+
+def _update_refs(store, user_id, snapshots, plus, minus=None):
+    # apply a refcount delta; returns the shas no manifest references anymore
+    if not plus and not minus:
+        return []
+    refs = _load_refs(store, user_id, snapshots)
+    for sha, n in plus.items():
+        refs[sha] = refs.get(sha, 0) + n
+    freed = []
+    for sha, n in (minus or {}).items():
+        left = refs.get(sha, 0) - n
+        if left > 0:
+            refs[sha] = left
+        else:
+            refs.pop(sha, None)
+            freed.append(sha)
+    _write_json(store, refs_path(user_id), refs)
+    return freed
+
+def _hash(store, path):
+    h = hashlib.sha256()
+    size = 0
+    for chunk in store.iter_file(path):
+        h.update(chunk)
+        size += len(chunk)
+    return h.hexdigest(), size
+
+def _parallel(items, fn, workers=None):
+    # yields (item, result, error) as calls finish, with a bounded number
+    # in flight so huge item lists aren't queued up front
+    workers = workers or BACKUP_WORKERS
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        items = iter(items)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < workers * 2:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((item, pool.submit(fn, item)))
+            if not pending:
+                return
+            wait([f for _, f in pending], return_when=FIRST_COMPLETED)
+            for entry in [e for e in pending if e[1].done()]:
+                pending.remove(entry)
+                item, future = entry
+                error = future.exception()
+                if error is not None and not isinstance(error, Exception):
+                    raise error  # KeyboardInterrupt and friends stop the whole run
+                yield item, None if error else future.result(), error
+
+def _capture(store, user_id, path):
+    """Copy path's content into the blob store; returns (sha256, size).
+
+    The file is copied before it is hashed, so the blob always matches its
+    name even if the file is rewritten meanwhile.
+    """
+    tmp = f"backups/{user_id}/blobs/tmp/{uuid.uuid4().hex}"
+    store.copy_file(path, tmp)
+    try:
+        sha256, size = _hash(store, tmp)
+        if store.stat_file(blob_path(user_id, sha256)) is None:
+            store.copy_file(tmp, blob_path(user_id, sha256))
+    finally:
+        store.delete_file(tmp)
+    return sha256, size
+
+def _chain(store, user_id, name, snapshots):
+    # (record, reader) from snapshot `name` back to its full or archive base
+    by_name = {s["name"]: s for s in snapshots}
+    while name is not None:
+        record = by_name.get(name)
+        if record is None:
+            raise ValueError(f"backup {name!r} not found")
+        reader = open_manifest(store, user_id, name)
+        if reader is None:
+            raise ValueError(f"manifest for backup {name!r} is missing")
+        yield record, reader
+        name = None if record["type"] in ("full", "archive") else record["parent"]
+
+def materialize(store, user_id, name, snapshots=None):
+    """path -> entry for every file in snapshot `name`, replaying its chain."""
+    snapshots = snapshots if snapshots is not None else load_index(store, user_id)
+    state = {}
+    for record, reader in reversed(list(_chain(store, user_id, name, snapshots))):
+        if record["type"] == "full":
+            state = {e["path"]: e for e in reader.iter("files")}
+            continue
+        if record["type"] == "archive":
+            state = {e["path"]: dict(e, archive=reader.meta["archive"]) for e in reader.iter("files")}
+            continue
+        for e in reader.iter("deleted"):
+            state.pop(e["path"], None)
+        for section in ("added", "modified"):
+            for entry in reader.iter(section):
+                state[entry["path"]] = entry
+    return state
+
+def find_entry(store, user_id, name, path, snapshots=None):
+    """path's entry in snapshot `name` or None, without materializing it.
+
+    Walks the chain newest first and stops at the first manifest that
+    mentions path; each manifest costs its tail plus at most one block.
+    """
+    snapshots = snapshots if snapshots is not None else load_index(store, user_id)
+    for record, reader in _chain(store, user_id, name, snapshots):
+        if record["type"] in ("full", "archive"):
+            entry = reader.lookup("files", path)
+            if entry is not None and record["type"] == "archive":
+                entry = dict(entry, archive=reader.meta["archive"])
+            return entry
+        for section in ("added", "modified"):
+            entry = reader.lookup(section, path)
+            if entry is not None:
+                return entry
+        if reader.lookup("deleted", path) is not None:
+            return None
+    return None
+
+def _tree_nodes(entries):
+    # the "dirs" section of a full or archive manifest
+    nodes = merkle.build(entries)
+    return [nodes[d] for d in sorted(nodes)]
+
+def snapshot_tree(store, user_id, name, snapshots=None):
+    """Snapshot `name`'s directory hash tree as path -> node.
+
+    Like find_entry, a node comes from the newest manifest in the chain that
+    stores it; chains with manifests written before trees existed are
+    materialized and hashed in memory instead.
+    """
+    snapshots = snapshots if snapshots is not None else load_index(store, user_id)
+    chain = list(_chain(store, user_id, name, snapshots))
+    if not all(reader.has("dirs") for _, reader in chain):
+        return merkle.build(materialize(store, user_id, name, snapshots).values()).get
+
+    def node(path):
+        for record, reader in chain:
+            found = reader.lookup("dirs", path)
+            if found is not None:
+                return None if found.get("removed") else found
+            if record["type"] in ("full", "archive"):
+                return None
+        return None
+    return node
+
+def compare_snapshot(store, user_id, name, against=None):
+    """Paths added, modified and deleted from snapshot `name` to snapshot
+    `against`, or to the live files when against is None.
+
+    Both sides are directory hash trees and only subtrees whose hashes
+    differ are read, so the cost follows the size of the change rather
+    than of the vault. Files count as modified when size or mtime differ,
+    as they do for incremental snapshots.
+    """
+    snapshots = load_index(store, user_id)
+    old = snapshot_tree(store, user_id, name, snapshots)
+    new = snapshot_tree(store, user_id, against, snapshots) if against else store.dir_tree(user_id)
+    return merkle.diff(old, new, user_id)
+
+def diff(store, user_id, parent_state, entries, progress=None):
+    """Compare current listing entries with the parent's state.
+
+    Files whose size and mtime match the parent keep the parent's entry
+    without being read; the rest are captured into the blob store. Returns
+    (state, added, modified, deleted).
+    """
+    state, changed = {}, []
+    for e in entries:
+        prev = parent_state.get(e["path"])
+        if prev is not None and prev["size"] == e["size"] and prev["updated"] == e["updated"]:
+            state[e["path"]] = prev
+        else:
+            changed.append(e)
+    added, modified = [], []
+    total_bytes = sum(e["size"] for e in changed)
+    files_done = bytes_done = 0
+    for e, result, error in _parallel(changed, lambda e: _capture(store, user_id, e["path"])):
+        files_done += 1
+        if progress:
+            bytes_done += result[1] if result else e["size"]
+            progress(files_done, bytes_done, len(changed), total_bytes)
+        if isinstance(error, FileNotFoundError):
+            continue  # deleted since it was listed
+        if error is not None:
+            raise error
+        sha256, size = result
+        entry = {"path": e["path"], "size": size, "updated": e["updated"], "sha256": sha256}
+        state[e["path"]] = entry
+        # a touched file with the same content still records its new mtime
+        (added if e["path"] not in parent_state else modified).append(entry)
+    added.sort(key=lambda e: e["path"])
+    modified.sort(key=lambda e: e["path"])
+    deleted = sorted(set(parent_state) - set(state))
+    return state, added, modified, deleted
+
+def _epoch(iso):
+    dt = datetime.fromisoformat(iso)
+    return (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
+
+def _create_archive(store, user_id, name, progress=None):
+    # stream every file into one archive object; nothing is staged, the
+    # backend's save_stream (multipart on S3) consumes the generator
+    if not archives.available():
+        raise ValueError("archive backups need the zstandard package")
+    listed = []
+
+    def members():
+        bytes_done = 0
+        for e in store.iter_listing(user_id):
+            listed.append(e)
+            yield {"name": e["path"].split("/", 1)[1], "size": e["size"], "mtime": _epoch(e["updated"]),
+                   "chunks": store.iter_file(e["path"], 0, e["size"] - 1) if e["size"] else ()}
+            # resumed once the member is written
+            bytes_done += e["size"]
+            if progress:
+                progress(len(listed), bytes_done, None, None)
+
+    index = []
+    path = archive_path(user_id, name)
+    store.save_stream(path, IterStream(archives.iter_archive(members(), index)))
+    files = []
+    for e, member in zip(listed, index):
+        entry = {"path": e["path"], "size": member["size"], "updated": e["updated"], "sha256": member["sha256"],
+                 "offset": member["offset"], "length": member["length"], "header": member["header"]}
+        if member.get("incomplete"):
+            entry["incomplete"] = True
+        files.append(entry)
+    files.sort(key=lambda e: e["path"])
+    return {"archive": path, "files": files, "file_count": len(files), "dirs": _tree_nodes(files)}
+
+def _member_chunks(store, entry):
+    end = entry["offset"] + entry["length"] - 1
+    return archives.read_member(store.iter_file(entry["archive"], entry["offset"], end),
+                                entry["header"], entry["size"])
+
+def open_file(store, user_id, name, path):
+    # (entry, chunks) for one file of a snapshot, or (None, None); archive
+    # members cost a single ranged read
+    entry = find_entry(store, user_id, name, path)
+    if entry is None:
+        return None, None
+    if entry.get("archive"):
+        return entry, _member_chunks(store, entry)
+    if not entry.get("sha256"):
+        raise FileNotFoundError("content was not retained by this backup")
+    return entry, store.iter_file(blob_path(user_id, entry["sha256"]))
+
+def _since_full(snapshots):
+    n = 0
+    for record in reversed(snapshots):
+        if record["type"] == "full":
+            return n
+        n += 1
+    return None
+
+def _default_name(snapshots):
+    taken = {s["name"] for s in snapshots}
+    name = base = f"backup_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
+    n = 1
+    while name in taken:
+        n += 1
+        name = f"{base}_{n}"
+    return name
+
+def _diff_manifest(store, user_id, name, snapshots, mode, progress=None):
+    # archives aren't part of the chain: the parent is the last other snapshot
+    chain = [s for s in snapshots if s["type"] != "archive"]
+    parent = chain[-1]["name"] if chain else None
+    parent_state = materialize(store, user_id, parent, snapshots) if parent else {}
+    state, added, modified, deleted = diff(store, user_id, parent_state, store.iter_listing(user_id), progress)
+
+    since_full = _since_full(chain)
+    full = parent is None or mode == "full" or (
+        mode == "auto" and since_full is not None and since_full + 1 >= BACKUP_FULL_INTERVAL)
+    manifest = {
+        "name": name,
+        "user_id": user_id,
+        "created_at": datetime.utcnow().isoformat(),
+        "type": "full" if full else "incremental",
+        "parent": parent,
+        "file_count": len(state)
+    }
+    if full:
+        manifest.update(files=[state[p] for p in sorted(state)], dirs=_tree_nodes(state.values()))
+    else:
+        manifest.update(added=added, modified=modified, deleted=deleted,
+                        dirs=merkle.changes(merkle.build(state.values()), merkle.build(parent_state.values())))
+    return manifest, added, modified, deleted
+
+def create_snapshot(store, user_id, backup_name=None, mode="auto", progress=None):
+    """Write a snapshot manifest for user_id and append it to the index.
+
+    mode "auto" writes an incremental unless there is no parent or
+    BACKUP_FULL_INTERVAL snapshots have passed since the last full one;
+    "full" and "incremental" force the type (an incremental without a
+    parent is written as full); "archive" writes a standalone tar+zstd
+    copy of every file.
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    with _user_lock(user_id):
+        return _create_snapshot(store, user_id, backup_name, mode, progress)
+
+def _create_snapshot(store, user_id, backup_name, mode, progress):
+    snapshots = load_index(store, user_id)
+    if backup_name:
+        check_name(backup_name)
+    if backup_name and any(s["name"] == backup_name for s in snapshots):
+        raise ValueError(f"backup {backup_name!r} already exists")
+    name = backup_name or _default_name(snapshots)
+    if mode == "archive":
+        manifest = {
+            "name": name,
+            "user_id": user_id,
+            "created_at": datetime.utcnow().isoformat(),
+            "type": "archive",
+            "parent": None,
+            **_create_archive(store, user_id, name, progress)
+        }
+        added, modified, deleted = manifest["files"], [], []
+    else:
+        manifest, added, modified, deleted = _diff_manifest(store, user_id, name, snapshots, mode, progress)
+    path = _write_manifest(store, user_id, manifest)
+    # counted before the index lists the snapshot: a crash in between
+    # over-counts, which the next gc cycle repairs, and never frees a blob
+    _update_refs(store, user_id, snapshots, _blob_refs(manifests.MemoryManifest(manifest)))
+
+    record = {k: manifest[k] for k in ("name", "type", "parent", "created_at", "file_count")}
+    record.update(added=len(added), modified=len(modified), deleted=len(deleted))
+    _write_json(store, index_path(user_id), {"snapshots": snapshots + [record]})
+    return dict(record, manifest_path=path)
+
+def _restore_target(user_id, path, target):
+    return path if not target else f"{user_id}/{target}/{path.split('/', 1)[1]}"
+
+def _in_place(entry, current):
+    # a restore skips files still exactly as backed up
+    return current is not None and current["size"] == entry["size"] and current["updated"] == entry["updated"]
+
+def _live_files(store, user_id, target):
+    return {e["path"]: e for e in store.iter_listing(f"{user_id}/{target}" if target else user_id)}
+
+def restore_size(store, user_id, backup_name, target=None):
+    """Bytes restoring backup_name (into target) would write: its files not already in place."""
+    target = check_target(target)
+    live = _live_files(store, user_id, target)
+    return sum(e["size"] for e in materialize(store, user_id, backup_name).values()
+               if not _in_place(e, live.get(_restore_target(user_id, e["path"], target))))
+
+def restore_snapshot(store, user_id, backup_name, target=None, progress=None, max_bytes=None, on_written=None):
+    """Copy every file of a snapshot back from the blob store.
+
+    Files go back to their original paths, or below <user_id>/<target>/
+    when target is given; files not in the snapshot are left alone, and
+    ones still exactly as backed up (same size and mtime) are skipped.
+    Copies run BACKUP_WORKERS at a time. Progress is checkpointed to
+    backups/<user>/restores/<name>.json as a low-water mark over the
+    snapshot's sorted paths plus the few finished above it, so calling
+    this again after an interruption resumes; a run that ends with
+    failures keeps only those in the checkpoint, to be retried next time.
+
+    With max_bytes, a restore that would write more than that raises
+    ValueError before copying anything; on_written(size) is called for
+    every file written, e.g. to charge it to the user's quota.
+    """
+    target = check_target(target)
+    plan = sorted(materialize(store, user_id, backup_name).values(), key=lambda e: e["path"])
+    ckpt_path = checkpoint_path(user_id, backup_name)
+    ckpt = _read_json(store, ckpt_path)
+    stored = ckpt is not None
+    resumed = stored and ckpt.get("target") == target
+    if not resumed:
+        ckpt = {"target": target, "next": 0, "done": [], "failed": []}
+    done = set(ckpt["done"])
+    todo = ckpt["failed"] + [i for i in range(ckpt["next"], len(plan)) if i not in done]  # ascending
+    live = _live_files(store, user_id, target)
+    total_bytes = sum(plan[i]["size"] for i in todo)
+    if max_bytes is not None:
+        needed = sum(plan[i]["size"] for i in todo
+                     if not _in_place(plan[i], live.get(_restore_target(user_id, plan[i]["path"], target))))
+        if needed > max_bytes:
+            raise ValueError(f"restore needs {needed} bytes, more than the {max(max_bytes, 0)} left in the quota")
+    bytes_done = 0
+
+    def restore_one(i):
+        entry = plan[i]
+        dest = _restore_target(user_id, entry["path"], target)
+        if _in_place(entry, live.get(dest)):
+            return False
+        if entry.get("archive"):
+            if entry.get("incomplete"):
+                raise ValueError("file changed while the archive was written")
+            store.save_stream(dest, IterStream(_member_chunks(store, entry)))
+            return True
+        if not entry.get("sha256"):
+            raise FileNotFoundError("content was not retained by this backup")
+        try:
+            store.copy_file(blob_path(user_id, entry["sha256"]), dest)
+        except FileNotFoundError:
+            raise FileNotFoundError("backup content is missing from the blob store") from None
+        return True
+
+    restored, skipped, failed = [], 0, []
+    # todo is ascending and runs nearly in order: everything before todo[low]
+    # has finished, so a checkpoint is that mark plus the few successes
+    # past it and the failures before it
+    succeeded, failed_idx, finished = set(), set(), set()
+    low = since_checkpoint = 0
+
+    def checkpoint():
+        nonlocal stored
+        stored = True
+        nxt = todo[low] if low < len(todo) else len(plan)
+        _write_json(store, ckpt_path, {
+            "target": target,
+            "next": nxt,
+            "done": sorted(i for i in succeeded if i >= nxt),
+            "failed": sorted(i for i in failed_idx if i < nxt)
+        })
+
+    try:
+        for i, result, error in _parallel(todo, restore_one):
+            path = plan[i]["path"]
+            if error is not None:
+                failed.append({"path": path, "error": str(error)})
+                failed_idx.add(i)
+                log_warn("restore failed for file", backup=backup_name, path=path, error=str(error))
+            else:
+                succeeded.add(i)
+                if result:
+                    restored.append(_restore_target(user_id, path, target))
+                    if on_written:
+                        on_written(plan[i]["size"])
+                else:
+                    skipped += 1
+            finished.add(i)
+            bytes_done += plan[i]["size"]
+            if progress:
+                progress(len(finished), bytes_done, len(todo), total_bytes)
+            while low < len(todo) and todo[low] in finished:
+                low += 1
+            since_checkpoint += 1
+            if since_checkpoint >= RESTORE_CHECKPOINT_EVERY:
+                checkpoint()
+                since_checkpoint = 0
+    finally:
+        if low < len(todo):
+            checkpoint()  # interrupted: the next call resumes from here
+    if failed_idx:
+        checkpoint()
+    elif stored:
+        store.delete_file(ckpt_path)
+    log_info("restore finished", backup=backup_name, restored=len(restored), skipped=skipped, failed=len(failed))
+    return {
+        "backup_name": backup_name,
+        "file_count": len(plan),
+        "restored_count": len(restored),
+        "skipped_count": skipped,
+        "failed_count": len(failed),
+        "restored_files": restored,
+        "failed_files": failed,
+        "resumed": resumed
+    }
+
+def delete_snapshot(store, user_id, name):
+    """Remove snapshot `name`, keeping every other snapshot restorable.
+
+    An incremental child is rewritten against the deleted snapshot's parent
+    (or as full when the deleted one was), so later states don't change.
+    Blobs left unreferenced are queued for gc_step rather than deleted here.
+    """
+    with _user_lock(user_id):
+        freed = _delete_snapshots(store, user_id, [name])
+    return {"name": name, "freed_blobs": freed}
+
+def delete_snapshots(store, user_id, names):
+    # delete_snapshot for many at once: one refs and index update, and the
+    # snapshots' objects removed with bulk deletes
+    with _user_lock(user_id):
+        freed = _delete_snapshots(store, user_id, names)
+    return {"deleted": sorted(names), "freed_blobs": freed}
+
+def _delete_snapshots(store, user_id, names):
+    snapshots = load_index(store, user_id)
+    by_name = {s["name"]: s for s in snapshots}
+    doomed = set(names)
+    missing = sorted(doomed - set(by_name))
+    if missing:
+        raise ValueError(f"backup {missing[0]!r} not found")
+    plus, minus = Counter(), Counter()
+    for name in doomed:
+        minus.update(_blob_refs(open_manifest(store, user_id, name)))
+    rest = [s for s in snapshots if s["name"] not in doomed]
+    paths = []
+    for child in rest:
+        if child["type"] != "incremental" or child["parent"] not in doomed:
+            continue
+        # the new parent is the nearest kept ancestor; past a deleted full
+        # there is none and the child becomes full
+        parent = child["parent"]
+        while parent in doomed:
+            parent = by_name[parent]["parent"] if by_name[parent]["type"] == "incremental" else None
+        state = materialize(store, user_id, child["name"], snapshots)
+        base = materialize(store, user_id, parent, snapshots) if parent is not None else None
+        child_manifest = open_manifest(store, user_id, child["name"])
+        rewritten = dict(child_manifest.meta, parent=parent)
+        if base is None:
+            rewritten.update(type="full", files=[state[p] for p in sorted(state)],
+                             dirs=_tree_nodes(state.values()))
+            counts = {"added": len(state), "modified": 0, "deleted": 0}
+        else:
+            rewritten.update(
+                added=[state[p] for p in sorted(state) if p not in base],
+                modified=[state[p] for p in sorted(state) if p in base and state[p] != base[p]],
+                deleted=sorted(set(base) - set(state)),
+                dirs=merkle.changes(merkle.build(state.values()), merkle.build(base.values())))
+            counts = {k: len(rewritten[k]) for k in ("added", "modified", "deleted")}
+        minus.update(_blob_refs(child_manifest))
+        plus.update(_blob_refs(manifests.MemoryManifest(rewritten)))
+        # the child is rewritten before the snapshot goes, so a crash
+        # leaves both valid chains readable
+        _write_manifest(store, user_id, rewritten)
+        paths.append(legacy_manifest_path(user_id, child["name"]))
+        child.update(type=rewritten["type"], parent=rewritten["parent"], **counts)
+    freed = _update_refs(store, user_id, snapshots, plus, minus)
+    _write_json(store, index_path(user_id), {"snapshots": rest})
+    for name in sorted(doomed):
+        paths += [manifest_path(user_id, name), legacy_manifest_path(user_id, name), checkpoint_path(user_id, name)]
+        if by_name[name]["type"] == "archive":
+            paths.append(archive_path(user_id, name))
+    store.delete_files(paths)
+    if freed:
+        gc_state = _read_json(store, gc_path(user_id)) or {}
+        gc_state["pending"] = gc_state.get("pending", []) + freed
+        _write_json(store, gc_path(user_id), gc_state)
+    log_info("backups deleted", user_id=user_id, backups=sorted(doomed), freed_blobs=len(freed))
+    return len(freed)
+
+def gc_step(store, user_id, budget=None):
+    """Run one bounded batch of blob garbage collection for user_id.
+
+    Blobs queued by delete_snapshot go first. Remaining budget advances a
+    mark-and-sweep cycle persisted in backups/<user>/gc.json: mark counts
+    the blob references of every manifest, sweep pages through blobs/ and
+    removes blobs neither marked nor counted in refs.json (plus stale
+    temporaries) that predate the cycle by BACKUP_GC_GRACE_SECONDS. A mark
+    over an unchanged snapshot list also rewrites refs.json if it drifted.
+    """
+    budget = budget or BACKUP_GC_BATCH
+    with _user_lock(user_id):
+        snapshots = load_index(store, user_id)
+        refs = _load_refs(store, user_id, snapshots)
+        state = _read_json(store, gc_path(user_id)) or {}
+        pending = state.get("pending", [])
+        finished = False
+        doomed = []
+        while pending and budget > 0:
+            sha = pending.pop()
+            budget -= 1
+            if sha not in refs:
+                doomed.append(blob_path(user_id, sha))
+        deleted = store.delete_files(doomed) if doomed else 0
+
+        if budget > 0 and "phase" not in state:
+            names = [s["name"] for s in snapshots]
+            state.update(phase="mark", started=time.time(), names=names, todo=names[::-1], marked={})
+        if state.get("phase") == "mark":
+            marked = state["marked"]
+            while state["todo"] and budget > 0:
+                budget -= 1
+                for sha, n in _blob_refs(open_manifest(store, user_id, state["todo"].pop())).items():
+                    marked[sha] = marked.get(sha, 0) + n
+            if not state["todo"]:
+                if state["names"] == [s["name"] for s in snapshots] and marked != refs:
+                    log_warn("backup refcounts repaired", user_id=user_id, counted=len(refs), marked=len(marked))
+                    refs = dict(marked)
+                    _write_json(store, refs_path(user_id), refs)
+                state.update(phase="sweep", cursor=None)
+        if state.get("phase") == "sweep":
+            marked, cutoff = state["marked"], state["started"] - BACKUP_GC_GRACE_SECONDS
+            while budget > 0:
+                page = store.list_page(f"backups/{user_id}/blobs/", limit=budget, cursor=state["cursor"])
+                doomed = []
+                for e in page["files"]:
+                    sha = e["path"].rsplit("/", 1)[1]
+                    unused = "/blobs/tmp/" in e["path"] or (sha not in marked and sha not in refs)
+                    if unused and _epoch(e["updated"]) < cutoff:
+                        doomed.append(e["path"])
+                deleted += store.delete_files(doomed) if doomed else 0
+                budget -= max(len(page["files"]), 1)
+                state["cursor"] = page["next_cursor"]
+                if not state["cursor"]:
+                    log_info("backup gc cycle finished", user_id=user_id, blobs=len(marked))
+                    state, finished = {}, True
+                    break
+        state["pending"] = pending
+        _write_json(store, gc_path(user_id), state)
+    return {"deleted": deleted, "phase": state.get("phase", "idle"), "pending": len(pending),
+            "cycle_finished": finished}
+
+def set_retention(store, user_id, daily=None, weekly=None, monthly=None):
+    # None takes the BACKUP_KEEP_* default; 0 keeps nothing for that period
+    policy = {"daily": BACKUP_KEEP_DAILY if daily is None else daily,
+              "weekly": BACKUP_KEEP_WEEKLY if weekly is None else weekly,
+              "monthly": BACKUP_KEEP_MONTHLY if monthly is None else monthly}
+    for period, n in policy.items():
+        if isinstance(n, bool) or not isinstance(n, int) or n < 0:
+            raise ValueError(f"{period} must be a non-negative integer")
+    _write_json(store, retention_path(user_id), policy)
+    return policy
+
+def delete_retention(store, user_id):
+    return store.delete_file(retention_path(user_id))
+
+def expired_snapshots(snapshots, policy):
+    """Names of the index records `policy` no longer keeps, oldest first.
+
+    The newest snapshot of each of the last policy["daily"] days with a
+    snapshot is kept, likewise for ISO weeks and months, and so is the
+    newest snapshot overall. Only created_at is read, so this needs
+    nothing but the index.
+    """
+    if not snapshots:
+        return []
+    keep = {snapshots[-1]["name"]}
+    periods = {"daily": lambda dt: dt.date(), "weekly": lambda dt: dt.isocalendar()[:2],
+               "monthly": lambda dt: (dt.year, dt.month)}
+    for period, key in periods.items():
+        seen = set()
+        for record in reversed(snapshots):
+            bucket = key(datetime.fromisoformat(record["created_at"]))
+            if bucket in seen:
+                continue
+            if len(seen) >= policy[period]:
+                break
+            seen.add(bucket)
+            keep.add(record["name"])
+    return [s["name"] for s in snapshots if s["name"] not in keep]
+
+def prune(store, user_id, dry_run=False):
+    """Apply user_id's retention policy: delete expired snapshots in one
+    batch, then drain the blobs only they referenced through gc_step.
+
+    A user without a policy keeps everything.
+    """
+    policy = load_retention(store, user_id)
+    with _user_lock(user_id):
+        expired = expired_snapshots(load_index(store, user_id), policy) if policy else []
+        freed = _delete_snapshots(store, user_id, expired) if expired and not dry_run else 0
+    reclaimed = 0
+    while freed:
+        step = gc_step(store, user_id)
+        reclaimed += step["deleted"]
+        if not step["pending"]:
+            break
+    return {"expired": expired, "dry_run": dry_run, "freed_blobs": freed, "reclaimed_blobs": reclaimed}
+
+def _scrub_plan(store, user_id, name):
+    # key -> object to verify, deduplicated: blobs by sha, archive members by
+    # archive and path
+    snapshots = load_index(store, user_id)
+    plan = {}
+
+    def add_archive_members(entries):
+        for e in entries:
+            plan[f"{e['archive']}:{e['path']}"] = e
+
+    if name is not None:
+        for e in materialize(store, user_id, name, snapshots).values():
+            if e.get("archive"):
+                add_archive_members([e])
+            elif e.get("sha256"):
+                plan[e["sha256"]] = {"sha256": e["sha256"], "size": e["size"]}
+        return plan
+    for sha in _load_refs(store, user_id, snapshots):
+        plan[sha] = {"sha256": sha}
+    for record in snapshots:
+        if record["type"] == "archive":
+            reader = open_manifest(store, user_id, record["name"])
+            if reader is not None:
+                add_archive_members(dict(e, archive=reader.meta["archive"]) for e in reader.iter("files"))
+    return plan
+
+def scrub(store, user_id, backup_name=None, progress=None):
+    """Re-read and re-hash the backup content behind one snapshot, or all of them.
+
+    Every blob (and archive member) is streamed once, SCRUB_WORKERS at a
+    time and paced to SCRUB_BANDWIDTH_LIMIT, and its sha256 and size are
+    compared with the manifest. Missing and corrupt objects are listed in a
+    report at scrub_path(); read errors are reported separately and retried
+    by the next run. Progress is checkpointed by sorted key, so a scrub of a
+    large vault that is interrupted resumes where it stopped.
+    """
+    plan = _scrub_plan(store, user_id, backup_name)
+    keys = sorted(plan)
+    ckpt_path = scrub_path(user_id, backup_name, checkpoint=True)
+    ckpt = _read_json(store, ckpt_path)
+    resumed = ckpt is not None
+    if not resumed:
+        ckpt = {"started_at": datetime.utcnow().isoformat(), "next": "", "done": [], "retry": [],
+                "checked": 0, "bytes": 0, "missing": [], "corrupt": []}
+    done = set(ckpt["done"])
+    todo = sorted(set(k for k in ckpt["retry"] if k in plan)
+                  | {k for k in keys if ckpt["next"] is not None and k >= ckpt["next"] and k not in done})
+    bucket = TokenBucket(SCRUB_BANDWIDTH_LIMIT)
+    archive_present = {}
+
+    def check(key):
+        obj = plan[key]
+        if obj.get("archive"):
+            # a ranged read of a missing object isn't a FileNotFoundError on S3
+            if obj["archive"] not in archive_present:
+                archive_present[obj["archive"]] = store.stat_file(obj["archive"]) is not None
+            if not archive_present[obj["archive"]]:
+                return "missing", 0
+            chunks = _member_chunks(store, obj)
+        else:
+            chunks = store.iter_file(blob_path(user_id, obj["sha256"]))
+        h, size = hashlib.sha256(), 0
+        try:
+            for chunk in chunks:
+                bucket.consume(len(chunk))
+                h.update(chunk)
+                size += len(chunk)
+        except FileNotFoundError:
+            return "missing", size
+        except archives.FORMAT_ERRORS as e:
+            return f"corrupt: {e}", size
+        if h.hexdigest() != obj["sha256"] or (obj.get("size") is not None and size != obj["size"]):
+            return "corrupt: content does not match its checksum", size
+        if obj.get("incomplete"):
+            return "corrupt: file changed while the archive was written", size
+        return "ok", size
+
+    def report(key, status):
+        obj = plan[key]
+        item = {"sha256": obj["sha256"]}
+        if obj.get("archive"):
+            item.update(path=obj["path"], archive=obj["archive"])
+        if status != "missing":
+            item["error"] = status.split(": ", 1)[1]
+        ckpt["missing" if status == "missing" else "corrupt"].append(item)
+
+    finished, retry, errors = set(), set(), []
+    low = since_checkpoint = 0
+
+    def checkpoint():
+        nxt = todo[low] if low < len(todo) else None  # None: only retries are left
+        ckpt.update(next=nxt, retry=sorted(retry),
+                    done=sorted(k for k in finished if nxt is not None and k >= nxt))
+        _write_json(store, ckpt_path, ckpt)
+
+    try:
+        for key, result, error in _parallel(todo, check, SCRUB_WORKERS):
+            if error is not None:
+                retry.add(key)
+                errors.append({"key": key, "error": str(error)})
+                log_warn("scrub read failed", user_id=user_id, key=key, error=str(error))
+            else:
+                status, size = result
+                ckpt["checked"] += 1
+                ckpt["bytes"] += size
+                if status != "ok":
+                    report(key, status)
+            finished.add(key)
+            while low < len(todo) and todo[low] in finished:
+                low += 1
+            if progress:
+                progress(len(finished), ckpt["bytes"], len(todo), None)
+            since_checkpoint += 1
+            if since_checkpoint >= SCRUB_CHECKPOINT_EVERY:
+                checkpoint()
+                since_checkpoint = 0
+    finally:
+        if low < len(todo):
+            checkpoint()
+
+    result = {
+        "backup_name": backup_name,
+        "started_at": ckpt["started_at"],
+        "finished_at": datetime.utcnow().isoformat(),
+        "object_count": len(keys),
+        "checked_count": ckpt["checked"],
+        "bytes_checked": ckpt["bytes"],
+        "missing": ckpt["missing"],
+        "corrupt": ckpt["corrupt"],
+        "errors": errors,
+        "resumed": resumed
+    }
+    _write_json(store, scrub_path(user_id, backup_name), result)
+    if retry:
+        checkpoint()
+    elif resumed or store.stat_file(ckpt_path) is not None:
+        store.delete_file(ckpt_path)
+    log_info("scrub finished", user_id=user_id, backup=backup_name, checked=ckpt["checked"],
+             missing=len(ckpt["missing"]), corrupt=len(ckpt["corrupt"]), errors=len(errors))
+    return result
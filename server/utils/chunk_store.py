@@ -0,0 +1,246 @@
+# utils/chunk_store.py — content-defined chunking + content-addressed chunk store
+import os
+import uuid
+import random
+import sqlite3
+import hashlib
+import threading
+from collections import Counter
+from . import compression
+
+try:
+    import numpy
+except ImportError:  # optional dependency; chunking falls back to pure Python
+    numpy = None
+
+CDC_MIN_SIZE = int(os.getenv("CDC_MIN_SIZE", str(16 * 1024)))
+CDC_AVG_SIZE = int(os.getenv("CDC_AVG_SIZE", str(64 * 1024)))
+CDC_MAX_SIZE = int(os.getenv("CDC_MAX_SIZE", str(256 * 1024)))
+
+# chunks are committed to the refcount table in batches of about this size
+_BATCH_BYTES = 4 * 1024 * 1024
+
+# FastCDC-style gear hash. A boundary is declared where the masked hash is
+# zero; the mask is stricter before the average size and looser after it,
+# which keeps chunk sizes clustered around CDC_AVG_SIZE.
+_rng = random.Random(0x43564F)
+_GEAR = [_rng.getrandbits(32) for _ in range(256)]
+_AVG_BITS = CDC_AVG_SIZE.bit_length() - 1
+_MASK_S = ((1 << (_AVG_BITS + 2)) - 1) << (32 - _AVG_BITS - 2)
+_MASK_L = ((1 << (_AVG_BITS - 2)) - 1) << (32 - _AVG_BITS + 2)
+# a byte is shifted out of the 32-bit hash after this many more bytes
+_WINDOW = 32
+_SCAN_STEP = 16 * 1024
+_GEAR_ARRAY = numpy.array(_GEAR, dtype=numpy.uint32) if numpy is not None else None
+
+_local = threading.local()
+
+def _first_hit(buf, origin, lo, hi, mask):
+    # numpy version of the scans below: the hash after byte j is the sum of
+    # gear[buf[j - k]] << k over the last 32 bytes since `origin`, computed
+    # for every j in [lo, hi) at once by doubling the window 1, 2, ..., 32
+    if hi <= lo:
+        return None
+    base = max(origin, lo - _WINDOW + 1)
+    h = _GEAR_ARRAY[numpy.frombuffer(buf[base:hi], dtype=numpy.uint8)]
+    w = 1
+    while w < _WINDOW:
+        h[w:] += h[:-w] << numpy.uint32(w)
+        w *= 2
+    hits = numpy.flatnonzero((h[lo - base:] & numpy.uint32(mask)) == 0)
+    return lo + int(hits[0]) + 1 if hits.size else None
+
+def _cut_point(buf, start, end):
+    # position (exclusive) where the chunk starting at `start` ends
+    if end - start <= CDC_MIN_SIZE:
+        return end
+    if numpy is not None:
+        i = start + CDC_MIN_SIZE
+        normal = min(start + CDC_AVG_SIZE, end)
+        limit = min(start + CDC_MAX_SIZE, end)
+        cut = _first_hit(buf, i, i, normal, _MASK_S)
+        # past the average size a cut usually comes soon, so look in steps
+        # rather than hashing all the way to CDC_MAX_SIZE
+        lo = max(i, normal)
+        while cut is None and lo < limit:
+            hi = min(lo + _SCAN_STEP, limit)
+            cut = _first_hit(buf, i, lo, hi, _MASK_L)
+            lo = hi
+        return limit if cut is None else cut
+    gear = _GEAR
+    h = 0
+    i = start + CDC_MIN_SIZE
+    normal = min(start + CDC_AVG_SIZE, end)
+    limit = min(start + CDC_MAX_SIZE, end)
+    mask = _MASK_S
+    for b in buf[i:normal]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+        i += 1
+        if not h & mask:
+            return i
+    mask = _MASK_L
+    for b in buf[i:limit]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+        i += 1
+        if not h & mask:
+            return i
+    return limit
+
+def iter_chunks(stream, read_size=1024 * 1024):
+    # split a file-like object into content-defined chunks; at most
+    # read_size + CDC_MAX_SIZE bytes are buffered at a time
+    buf = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < CDC_MAX_SIZE:
+            del buf[:pos]
+            pos = 0
+            while len(buf) < CDC_MAX_SIZE:
+                data = stream.read(read_size)
+                if not data:
+                    eof = True
+                    break
+                buf += data
+        if pos >= len(buf):
+            return
+        cut = _cut_point(buf, pos, len(buf))
+        yield bytes(buf[pos:cut])
+        pos = cut
+
+def _db(root):
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(root)
+    if conn is None:
+        os.makedirs(root, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(root, "refs.db"), timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS chunks ("
+                     "hash TEXT PRIMARY KEY, size INTEGER NOT NULL, refcount INTEGER NOT NULL) WITHOUT ROWID")
+        conns[root] = conn
+    return conn
+
+def _chunk_path(root, digest):
+    return os.path.join(root, digest[:2], digest[2:4], digest)
+
+def _write_chunk(root, digest, data):
+    # compressible chunks are stored as <hash>.zst, the rest verbatim
+    p = _chunk_path(root, digest)
+    os.makedirs(os.path.dirname(p), exist_ok=True)
+    if compression.should_compress(data):
+        data = compression.compress_bytes(data)
+        p += ".zst"
+    tmp = f"{p}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, p)
+
+def _read_chunk(root, digest):
+    p = _chunk_path(root, digest)
+    try:
+        with open(p, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        with open(p + ".zst", "rb") as f:
+            return compression.decompress_bytes(f.read())
+
+def _store_batch(root, batch):
+    # refcount updates and new chunk files happen under the database write
+    # lock so a concurrent release can't delete a chunk we just referenced
+    conn = _db(root)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for digest, data in batch:
+            row = conn.execute("SELECT refcount FROM chunks WHERE hash = ?", (digest,)).fetchone()
+            if row:
+                conn.execute("UPDATE chunks SET refcount = refcount + 1 WHERE hash = ?", (digest,))
+            else:
+                _write_chunk(root, digest, data)
+                conn.execute("INSERT INTO chunks (hash, size, refcount) VALUES (?, ?, 1)", (digest, len(data)))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def store(root, stream):
+    """Chunk `stream` into the store and return its recipe.
+
+    The recipe is {"size": total_bytes, "chunks": [[sha256, size], ...]};
+    every chunk it lists holds one reference until release() is called.
+    """
+    chunks = []
+    batch = []
+    batch_bytes = 0
+    total = 0
+    try:
+        for data in iter_chunks(stream):
+            digest = hashlib.sha256(data).hexdigest()
+            batch.append((digest, data))
+            batch_bytes += len(data)
+            total += len(data)
+            if batch_bytes >= _BATCH_BYTES:
+                _store_batch(root, batch)
+                chunks.extend([d, len(c)] for d, c in batch)
+                batch, batch_bytes = [], 0
+        if batch:
+            _store_batch(root, batch)
+            chunks.extend([d, len(c)] for d, c in batch)
+    except BaseException:
+        if chunks:
+            release(root, {"size": 0, "chunks": chunks})
+        raise
+    return {"size": total, "chunks": chunks}
+
+def retain(root, recipe):
+    # add one reference per listed chunk, for a second object sharing the recipe
+    conn = _db(root)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for digest, count in Counter(d for d, _ in recipe["chunks"]).items():
+            if conn.execute("UPDATE chunks SET refcount = refcount + ? WHERE hash = ?", (count, digest)).rowcount == 0:
+                raise FileNotFoundError(f"chunk {digest} is not in the store")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def release(root, recipe):
+    # drop one reference per listed chunk; unreferenced chunks are deleted
+    conn = _db(root)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for digest, count in Counter(d for d, _ in recipe["chunks"]).items():
+            conn.execute("UPDATE chunks SET refcount = refcount - ? WHERE hash = ?", (count, digest))
+            row = conn.execute("SELECT refcount FROM chunks WHERE hash = ?", (digest,)).fetchone()
+            if row and row[0] <= 0:
+                conn.execute("DELETE FROM chunks WHERE hash = ?", (digest,))
+                for p in (_chunk_path(root, digest), _chunk_path(root, digest) + ".zst"):
+                    try:
+                        os.remove(p)
+                    except FileNotFoundError:
+                        pass
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def iter_recipe(root, chunks, start=0, end=None):
+    # yield bytes [start, end] (inclusive) of the object described by `chunks`
+    offset = 0
+    for digest, size in chunks:
+        if end is not None and offset > end:
+            break
+        if offset + size > start:
+            data = _read_chunk(root, digest)
+            lo = max(start - offset, 0)
+            hi = size if end is None else min(end - offset + 1, size)
+            yield data[lo:hi]
+        offset += size
+
+def stats(root):
+    row = _db(root).execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * refcount), 0) "
+                            "FROM chunks").fetchone()
+    return {"chunks": row[0], "stored_bytes": row[1], "referenced_bytes": row[2]}
@@ -0,0 +1,93 @@
+# utils/compression.py — optional transparent zstd compression for stored objects
+import os
+import math
+from collections import Counter
+from .logger import log_warn
+
+try:
+    import zstandard
+except ImportError:  # optional dependency; compression just stays off
+    zstandard = None
+
+# "zstd" to compress new objects; anything else stores them raw
+STORAGE_COMPRESSION = os.getenv("STORAGE_COMPRESSION", "none").lower()
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+
+# below this a frame header costs more than it saves
+_MIN_SIZE = 256
+_SAMPLE_SIZE = 64 * 1024
+# bits/byte above which data is treated as already compressed or encrypted
+_MAX_ENTROPY = 7.5
+
+# container/codec signatures of formats that don't compress further
+_COMPRESSED_MAGIC = (
+    b"\xff\xd8\xff",          # JPEG
+    b"\x89PNG",               # PNG
+    b"GIF8",                  # GIF
+    b"PK\x03\x04",            # ZIP, docx/xlsx, jar, apk
+    b"\x1f\x8b",              # gzip
+    b"\x28\xb5\x2f\xfd",      # zstd
+    b"BZh",                   # bzip2
+    b"\xfd7zXZ",              # xz
+    b"7z\xbc\xaf",            # 7z
+    b"Rar!",                  # rar
+    b"\x1a\x45\xdf\xa3",      # Matroska/WebM
+    b"OggS",                  # Ogg
+    b"fLaC",                  # FLAC
+    b"ID3",                   # MP3
+)
+
+if STORAGE_COMPRESSION == "zstd" and zstandard is None:
+    log_warn("STORAGE_COMPRESSION=zstd but the zstandard package is not installed; storing raw")
+
+def enabled():
+    return STORAGE_COMPRESSION == "zstd" and zstandard is not None
+
+def entropy(sample):
+    n = len(sample)
+    if not n:
+        return 0.0
+    return -sum(c / n * math.log2(c / n) for c in Counter(sample).values())
+
+def should_compress(sample):
+    # decide from the first bytes of an object whether compressing is worthwhile
+    if not enabled() or len(sample) < _MIN_SIZE:
+        return False
+    if sample.startswith(_COMPRESSED_MAGIC) or sample[4:8] == b"ftyp":  # ftyp: MP4/MOV/HEIC
+        return False
+    return entropy(sample[:_SAMPLE_SIZE]) < _MAX_ENTROPY
+
+def compress_bytes(data):
+    # single frame with the content size recorded, for small self-contained blobs
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+def decompress_bytes(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+def compress_chunks(chunks):
+    cobj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    for chunk in chunks:
+        out = cobj.compress(chunk)
+        if out:
+            yield out
+    yield cobj.flush()
+
+def decompress_chunks(chunks):
+    dobj = zstandard.ZstdDecompressor().decompressobj()
+    for chunk in chunks:
+        out = dobj.decompress(chunk)
+        if out:
+            yield out
+
+def slice_chunks(chunks, start=0, end=None):
+    # bytes [start, end] (inclusive) of a stream that can't seek
+    offset = 0
+    for chunk in chunks:
+        chunk_end = offset + len(chunk)
+        if end is not None and offset > end:
+            return
+        if chunk_end > start:
+            lo = max(start - offset, 0)
+            hi = len(chunk) if end is None else min(end - offset + 1, len(chunk))
+            yield chunk[lo:hi]
+        offset = chunk_end
@@ -0,0 +1,261 @@
+# utils/fs_indexer.py — keeps the metadata index in step with out-of-band
+# changes to DATA_DIR using Linux inotify (through libc, no extra packages)
+import os
+import time
+import errno
+import fcntl
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from .logger import log_info, log_warn, log_error
+from . import local_storage, metadata_index
+
+FS_INDEXER = os.getenv("FS_INDEXER", "0") == "1"
+# how often the "caught up until" checkpoint is persisted
+FS_INDEXER_CHECKPOINT_INTERVAL = float(os.getenv("FS_INDEXER_CHECKPOINT_INTERVAL", "30"))
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+               | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+_EVENT = struct.Struct("iIII")
+# mtimes can lag the event that caused them by a filesystem tick
+_CHECKPOINT_SLACK = 2.0
+_CHECKPOINT_KEY = "fs_indexer_checkpoint"
+
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+class FsIndexer:
+    """Applies create/modify/move/delete events under DATA_DIR to the index.
+
+    Watches are placed on every user directory (dot-directories hold storage
+    internals whose changes come from our own writes). On start it catches
+    up on changes made while it wasn't running by re-reading only the
+    directories modified since the last checkpoint. Files rewritten in place
+    while the indexer was down leave their directory untouched; run
+    `manage.py reindex` after such maintenance.
+    """
+
+    def __init__(self, base_dir=None):
+        self.base = os.path.abspath(base_dir or local_storage.BASE_DATA_DIR)
+        self.libc = _libc()
+        self.fd = None
+        self.watches = {}  # wd -> directory path relative to base ("" for base)
+        self._stop = threading.Event()
+        self._thread = None
+
+    # -- watches -------------------------------------------------------
+
+    def _rel(self, path):
+        rel = os.path.relpath(path, self.base)
+        return "" if rel == "." else rel
+
+    def _skip_dir(self, rel):
+        return rel.split(os.sep, 1)[0].startswith(".")
+
+    def _add_watch(self, rel):
+        wd = self.libc.inotify_add_watch(self.fd, os.path.join(self.base, rel).encode(), _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                log_warn("inotify watch limit reached; raise fs.inotify.max_user_watches", dir=rel)
+            elif err != errno.ENOENT:
+                log_warn("inotify_add_watch failed", dir=rel, error=os.strerror(err))
+            return
+        self.watches[wd] = rel
+
+    def _watch_tree(self, rel):
+        # returns the directories now watched under rel
+        added = []
+        for dirpath, dirnames, _ in os.walk(os.path.join(self.base, rel)):
+            dir_rel = self._rel(dirpath)
+            if dir_rel and self._skip_dir(dir_rel):
+                dirnames[:] = []
+                continue
+            if dir_rel == "":
+                dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            self._add_watch(dir_rel)
+            added.append(dir_rel)
+        return added
+
+    def _forget_tree(self, rel):
+        prefix = rel + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == rel or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                self.watches.pop(wd, None)
+
+    # -- applying changes ----------------------------------------------
+
+    def _sync_file(self, rel):
+        if os.sep not in rel or os.path.basename(rel).startswith(local_storage._TMP_PREFIX):
+            return  # loose files in DATA_DIR itself aren't user objects
+        try:
+            local_storage.sync_index_entry(rel)
+        except OSError as e:
+            log_warn("fs indexer could not index path", path=rel, error=str(e))
+
+    def _sync_dir(self, rel):
+        # reconcile one directory's direct children against the index
+        full = os.path.join(self.base, rel)
+        on_disk = set()
+        try:
+            with os.scandir(full) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False):
+                        on_disk.add(os.path.join(rel, entry.name))
+        except FileNotFoundError:
+            pass
+        indexed = {row["path"] for row in metadata_index.iter_prefix(local_storage._index_root(), rel)
+                   if os.path.dirname(row["path"]) == rel}
+        for path in on_disk | indexed:
+            self._sync_file(path)
+
+    def _sync_removed_tree(self, rel):
+        for row in list(metadata_index.iter_prefix(local_storage._index_root(), rel)):
+            self._sync_file(row["path"])
+
+    def catch_up(self, since):
+        # re-read directories whose entries changed after `since`; unchanged
+        # directories are only descended through
+        changed = 0
+        present = set()
+        for dirpath, dirnames, _ in os.walk(self.base):
+            rel = self._rel(dirpath)
+            if rel == "":
+                dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+                continue
+            present.add(rel)
+            if os.stat(dirpath).st_mtime >= since:
+                self._sync_dir(rel)
+                changed += 1
+        # rows left behind by directories removed while we were down
+        gone = [row["path"] for row in metadata_index.iter_prefix(local_storage._index_root(), "")
+                if row["physical"] == row["path"] and os.path.dirname(row["path"]) not in present]
+        for path in gone:
+            self._sync_file(path)
+        log_info("fs indexer caught up", since=since, changed_dirs=changed)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log_warn("inotify queue overflowed; reindexing everything")
+            local_storage.reindex("")
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        parent = self.watches.get(wd)
+        if parent is None or not name:
+            return
+        rel = os.path.join(parent, name) if parent else name
+        if mask & IN_ISDIR:
+            if parent == "" and name.startswith("."):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                for d in self._watch_tree(rel):
+                    self._sync_dir(d)
+            elif mask & IN_MOVED_FROM:
+                self._forget_tree(rel)
+                self._sync_removed_tree(rel)
+            elif mask & IN_DELETE:
+                self._sync_removed_tree(rel)
+            return
+        if mask & (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+            self._sync_file(rel)
+
+    def _read_events(self):
+        buf = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset + length].rstrip(b"\0").decode("utf-8", "surrogateescape")
+            offset += length
+            try:
+                self._handle(wd, mask, name)
+            except Exception as e:
+                log_error("fs indexer failed to apply event", name=name, mask=mask, error=str(e))
+
+    # -- lifecycle -----------------------------------------------------
+
+    def run(self):
+        root = local_storage._index_root()
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            os.makedirs(self.base, exist_ok=True)
+            # watch first, then catch up, so nothing falls in between
+            self._watch_tree("")
+            since = float(metadata_index.get_state(root, _CHECKPOINT_KEY, "0"))
+            self.catch_up(since - _CHECKPOINT_SLACK if since else 0)
+            last_checkpoint = 0.0
+            while not self._stop.is_set():
+                idle_since = time.time()
+                ready, _, _ = select.select([self.fd], [], [], 1.0)
+                if ready:
+                    self._read_events()
+                elif idle_since - last_checkpoint >= FS_INDEXER_CHECKPOINT_INTERVAL:
+                    # queue was empty at idle_since: everything before it is applied
+                    metadata_index.set_state(root, _CHECKPOINT_KEY, repr(idle_since))
+                    last_checkpoint = idle_since
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run_logged, name="fs-indexer", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run_logged(self):
+        try:
+            self.run()
+        except Exception as e:
+            log_error("fs indexer stopped", error=str(e))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+def start_if_enabled():
+    """Start one indexer per host when FS_INDEXER=1; returns it or None.
+
+    Several worker processes may call this; an flock on the index directory
+    elects the one that runs the indexer.
+    """
+    if not FS_INDEXER:
+        return None
+    lock_dir = local_storage._index_root()
+    os.makedirs(lock_dir, exist_ok=True)
+    lock = open(os.path.join(lock_dir, "fs_indexer.lock"), "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    indexer = FsIndexer()
+    indexer._lock_file = lock  # held for the life of the process
+    log_info("fs indexer started", base=indexer.base)
+    return indexer.start()
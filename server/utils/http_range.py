@@ -0,0 +1,51 @@
+# utils/http_range.py — Range/If-Range aware binary responses for stored objects
+import os
+import mimetypes
+from flask import Response, request, send_file, stream_with_context
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+def _requested_range(size, etag, last_modified):
+    # returns (start, end) inclusive, or None to send the whole object
+    rng = request.range
+    if rng is None or rng.units != "bytes" or len(rng.ranges) != 1:
+        # multi-range requests are answered with the full body (RFC 9110 allows this)
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and (last_modified is None or last_modified.replace(microsecond=0) > if_range.date):
+        return None
+    bounds = rng.range_for_length(size)
+    if bounds is None:
+        raise RequestedRangeNotSatisfiable(length=size)
+    start, stop = bounds
+    return start, stop - 1
+
+def send_object(storage, path, download_name=None, as_attachment=False):
+    """Build a streaming response for `path`, or None if it does not exist."""
+    download_name = download_name or os.path.basename(path)
+    local_path = storage.get_local_path(path)
+    if local_path:
+        # werkzeug handles Range/If-Range itself and passes the open file to
+        # wsgi.file_wrapper, which gunicorn serves with sendfile()
+        return send_file(local_path, download_name=download_name, as_attachment=as_attachment,
+                         conditional=True, etag=True)
+
+    info = storage.stat_file(path)
+    if info is None:
+        return None
+    size = info["size"]
+    rng = _requested_range(size, info["etag"], info["last_modified"])
+    start, end = rng or (0, size - 1)
+
+    mimetype = mimetypes.guess_type(download_name)[0] or "application/octet-stream"
+    body = storage.iter_file(path, start, end) if size else iter(())
+    resp = Response(stream_with_context(body), status=206 if rng else 200, mimetype=mimetype)
+    resp.content_length = end - start + 1 if size else 0
+    resp.set_etag(info["etag"])
+    resp.last_modified = info["last_modified"]
+    resp.headers["Accept-Ranges"] = "bytes"
+    if rng:
+        resp.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    resp.headers.set("Content-Disposition", "attachment" if as_attachment else "inline", filename=download_name)
+    return resp
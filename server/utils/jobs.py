@@ -0,0 +1,459 @@
+# utils/jobs.py — persistent background jobs (backups, restores) with progress
+#
+# Jobs are rows in a small SQLite database, so they survive restarts and
+# any process can report on them; each process runs a pool of worker
+# threads that claim queued jobs. Handlers get a progress callback that
+# records files/bytes done and raises JobCancelled once a cancel has been
+# requested. A running job's heartbeat is refreshed by its process; jobs
+# whose process died are requeued (restores resume from their checkpoint).
+#
+# Queued jobs are served in weighted-fair order rather than FIFO: each gets
+# a virtual finish tag of max(virtual clock, its user's last tag) +
+# cost / weight, cost being the bytes that user's previous job of the same
+# kind moved. A huge vault thus waits its turn behind many small ones
+# instead of blocking them, and interactive jobs outweigh scheduled ones.
+# Per-user schedules queue jobs at a daily (or N-hourly) time plus random
+# jitter so tenants' nightly backups don't all start at once.
+import os
+import json
+import math
+import time
+import uuid
+import random
+import sqlite3
+import threading
+from .logger import log_info, log_warn, log_error
+from .rate_limit import TokenBucket
+
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join(os.getenv("DATA_DIR", "./data"), ".jobs"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# idle workers look for jobs queued by other processes this often
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+# progress is written, and cancellation checked, at most this often
+JOB_PROGRESS_INTERVAL = float(os.getenv("JOB_PROGRESS_INTERVAL", "1"))
+# a running job without a heartbeat for this long is requeued
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "300"))
+# finished jobs stay pollable this long
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", str(7 * 86400)))
+# running jobs across all processes sharing JOBS_DIR (0: only JOB_WORKERS per process)
+JOB_MAX_RUNNING = int(os.getenv("JOB_MAX_RUNNING", "0"))
+# bytes/second for all jobs together, across every process sharing JOBS_DIR
+# (0: unlimited); split evenly between the processes currently running jobs
+JOB_BANDWIDTH_LIMIT = int(os.getenv("JOB_BANDWIDTH_LIMIT", "0"))
+# fair-queue cost of a job whose user has no previous job of that kind
+JOB_DEFAULT_COST = int(os.getenv("JOB_DEFAULT_COST", str(64 * 1024 * 1024)))
+# weights: a user waiting on a request outranks the nightly schedule
+JOB_INTERACTIVE_WEIGHT = float(os.getenv("JOB_INTERACTIVE_WEIGHT", "4"))
+JOB_SCHEDULED_WEIGHT = float(os.getenv("JOB_SCHEDULED_WEIGHT", "1"))
+# how often due schedules are looked for; "0" turns the scheduler off
+JOB_SCHEDULER_INTERVAL = float(os.getenv("JOB_SCHEDULER_INTERVAL", "30"))
+
+FINISHED = ("succeeded", "failed", "cancelled")
+
+_MIGRATIONS = [
+    "CREATE TABLE jobs (id TEXT PRIMARY KEY, user_id TEXT NOT NULL, kind TEXT NOT NULL, params TEXT NOT NULL, "
+    "status TEXT NOT NULL, progress TEXT, result TEXT, error TEXT, cancel_requested INTEGER NOT NULL DEFAULT 0, "
+    "created_at REAL NOT NULL, started_at REAL, finished_at REAL, heartbeat REAL)",
+    "CREATE INDEX jobs_queue ON jobs (status, created_at)",
+    "CREATE INDEX jobs_user ON jobs (user_id, created_at)",
+    "ALTER TABLE jobs ADD COLUMN due_at REAL",
+    "ALTER TABLE jobs ADD COLUMN cost REAL",
+    "ALTER TABLE jobs ADD COLUMN vstart REAL",
+    "ALTER TABLE jobs ADD COLUMN vfinish REAL",
+    "CREATE INDEX jobs_fair ON jobs (status, vfinish)",
+    "CREATE TABLE fair_queue (user_id TEXT PRIMARY KEY, last_finish REAL NOT NULL) WITHOUT ROWID",
+    "CREATE TABLE state (key TEXT PRIMARY KEY, value REAL) WITHOUT ROWID",
+    "CREATE TABLE schedules (user_id TEXT NOT NULL, kind TEXT NOT NULL, params TEXT NOT NULL, "
+    "at_minute INTEGER NOT NULL, interval_seconds INTEGER NOT NULL, jitter_seconds INTEGER NOT NULL, "
+    "next_run REAL NOT NULL, last_run REAL, last_job TEXT, PRIMARY KEY (user_id, kind)) WITHOUT ROWID",
+    "CREATE INDEX schedules_due ON schedules (next_run)",
+    "ALTER TABLE jobs ADD COLUMN worker TEXT",
+]
+
+class JobCancelled(Exception):
+    pass
+
+_local = threading.local()
+_handlers = {}
+_exclusive = set()
+_running = set()
+_wake = threading.Event()
+_threads = []
+_threads_lock = threading.Lock()
+_bandwidth = None
+# tags this process's running jobs; set by start_workers, i.e. after any fork
+_process_id = None
+
+def _migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(_MIGRATIONS):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for stmt in _MIGRATIONS[version:]:
+            conn.execute(stmt)
+        conn.execute(f"PRAGMA user_version = {len(_MIGRATIONS)}")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def _db():
+    # one connection per thread and jobs directory
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(JOBS_DIR)
+    if conn is None:
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(JOBS_DIR, "jobs.db"), timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        _migrate(conn)
+        conns[JOBS_DIR] = conn
+    return conn
+
+def _job(row):
+    if row is None:
+        return None
+    return {
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "params": json.loads(row["params"]),
+        "progress": json.loads(row["progress"]) if row["progress"] else None,
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+        "cancel_requested": bool(row["cancel_requested"]),
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"]
+    }
+
+def register(kind, handler, exclusive=False):
+    # handler(user_id, params, progress) -> JSON-serializable result; a user's
+    # exclusive jobs (those rewriting the same state) never run side by side
+    _handlers[kind] = handler
+    if exclusive:
+        _exclusive.add(kind)
+
+def _transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    return conn
+
+def _state(conn, key, default=0.0):
+    row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def _enqueue(conn, user_id, kind, params, weight, due_at):
+    # runs inside the caller's write transaction
+    now = time.time()
+    row = conn.execute(
+        "SELECT coalesce(json_extract(progress, '$.bytes_total'), json_extract(progress, '$.bytes_done')) "
+        "FROM jobs WHERE user_id = ? AND kind = ? AND status = 'succeeded' ORDER BY finished_at DESC LIMIT 1",
+        (user_id, kind)).fetchone()
+    cost = max(row[0] if row and row[0] else JOB_DEFAULT_COST, 1)
+    last = conn.execute("SELECT last_finish FROM fair_queue WHERE user_id = ?", (user_id,)).fetchone()
+    vstart = max(_state(conn, "vclock"), last[0] if last else 0.0)
+    vfinish = vstart + cost / weight
+    conn.execute("INSERT INTO fair_queue (user_id, last_finish) VALUES (?, ?) "
+                 "ON CONFLICT (user_id) DO UPDATE SET last_finish = excluded.last_finish", (user_id, vfinish))
+    job_id = uuid.uuid4().hex
+    conn.execute("INSERT INTO jobs (id, user_id, kind, params, status, created_at, due_at, cost, vstart, vfinish) "
+                 "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?)",
+                 (job_id, user_id, kind, json.dumps(params), now, due_at or now, cost, vstart, vfinish))
+    return job_id
+
+def submit(user_id, kind, params, weight=None):
+    conn = _transaction(_db())
+    try:
+        job_id = _enqueue(conn, user_id, kind, params, weight or JOB_INTERACTIVE_WEIGHT, None)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    start_workers()
+    _wake.set()
+    log_info("job queued", job_id=job_id, kind=kind, user_id=user_id)
+    return get(job_id, user_id)
+
+def get(job_id, user_id):
+    return _job(_db().execute("SELECT * FROM jobs WHERE id = ? AND user_id = ?", (job_id, user_id)).fetchone())
+
+def list_jobs(user_id, limit=50):
+    rows = _db().execute("SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?", (user_id, limit))
+    return [_job(row) for row in rows]
+
+def cancel(job_id, user_id):
+    """Cancel a job: queued ones at once, running ones at their next progress report."""
+    conn = _db()
+    conn.execute("UPDATE jobs SET status = 'cancelled', cancel_requested = 1, finished_at = ? "
+                 "WHERE id = ? AND user_id = ? AND status = 'queued'", (time.time(), job_id, user_id))
+    conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND user_id = ? AND status = 'running'",
+                 (job_id, user_id))
+    return get(job_id, user_id)
+
+def _claim():
+    # the queued job with the smallest finish tag, unless JOB_MAX_RUNNING
+    # jobs are already running somewhere; exclusive jobs wait while one of
+    # their user's is running
+    conn = _transaction(_db())
+    try:
+        row = None
+        if not JOB_MAX_RUNNING or conn.execute(
+                "SELECT count(*) FROM jobs WHERE status = 'running'").fetchone()[0] < JOB_MAX_RUNNING:
+            kinds = sorted(_exclusive)
+            marks = ", ".join("?" * len(kinds))
+            busy = (f" AND NOT (q.kind IN ({marks}) AND EXISTS (SELECT 1 FROM jobs r WHERE r.user_id = q.user_id "
+                    f"AND r.status = 'running' AND r.kind IN ({marks})))") if kinds else ""
+            row = conn.execute(f"SELECT * FROM jobs q WHERE q.status = 'queued'{busy} "
+                               "ORDER BY q.vfinish, q.created_at LIMIT 1", kinds + kinds).fetchone()
+        if row is not None:
+            now = time.time()
+            conn.execute("UPDATE jobs SET status = 'running', started_at = ?, heartbeat = ?, worker = ? "
+                         "WHERE id = ?", (now, now, _process_id, row["id"]))
+            # the virtual clock follows the start tag of the job in service
+            conn.execute("INSERT INTO state (key, value) VALUES ('vclock', ?) ON CONFLICT (key) "
+                         "DO UPDATE SET value = max(value, excluded.value)", (row["vstart"] or 0.0,))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return row
+
+def _finish(job_id, status, result=None, error=None, progress=None):
+    _db().execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, "
+                  "progress = coalesce(?, progress) WHERE id = ?",
+                  (status, json.dumps(result) if result is not None else None, error, time.time(),
+                   json.dumps(progress) if progress is not None else None, job_id))
+
+def _rebalance(conn):
+    # this process's share of JOB_BANDWIDTH_LIMIT: an even split between the
+    # processes with running jobs, rechecked with every persisted progress
+    if _bandwidth is None:
+        return
+    busy = conn.execute("SELECT count(DISTINCT worker) FROM jobs WHERE status = 'running' "
+                        "AND worker != ?", (_process_id,)).fetchone()[0]
+    rate = JOB_BANDWIDTH_LIMIT / (busy + 1)
+    if rate != _bandwidth.rate:
+        _bandwidth.set_rate(rate)
+
+class _Progress:
+    """The callback handed to a handler; persists at most every JOB_PROGRESS_INTERVAL."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.state = None
+        self._last = 0.0
+        self._bytes = 0
+
+    def __call__(self, files_done, bytes_done, files_total=None, bytes_total=None):
+        self.state = {"files_done": files_done, "bytes_done": bytes_done,
+                      "files_total": files_total, "bytes_total": bytes_total}
+        # bytes are reported once moved, so the cap paces the next ones
+        if _bandwidth is not None:
+            _bandwidth.consume(bytes_done - self._bytes)
+        self._bytes = bytes_done
+        now = time.monotonic()
+        if now - self._last < JOB_PROGRESS_INTERVAL:
+            return
+        self._last = now
+        conn = _db()
+        _rebalance(conn)
+        conn.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(self.state), self.job_id))
+        if conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (self.job_id,)).fetchone()[0]:
+            raise JobCancelled()
+
+def _run(row):
+    job_id, kind = row["id"], row["kind"]
+    handler = _handlers.get(kind)
+    if handler is None:
+        _finish(job_id, "failed", error=f"no handler for job kind {kind!r}")
+        return
+    progress = _Progress(job_id)
+    _running.add(job_id)
+    started = time.monotonic()
+    try:
+        result = handler(row["user_id"], json.loads(row["params"]), progress)
+    except JobCancelled:
+        _finish(job_id, "cancelled", progress=progress.state)
+        log_info("job cancelled", job_id=job_id, kind=kind)
+    except Exception as e:
+        _finish(job_id, "failed", error=str(e), progress=progress.state)
+        log_error("job failed", job_id=job_id, kind=kind, error=str(e))
+    else:
+        _finish(job_id, "succeeded", result=result, progress=progress.state)
+        log_info("job finished", job_id=job_id, kind=kind, seconds=round(time.monotonic() - started, 3))
+    finally:
+        _running.discard(job_id)
+
+def _worker():
+    while True:
+        _wake.clear()
+        try:
+            row = _claim()
+        except Exception as e:
+            log_error("job claim failed", error=str(e))
+            row = None
+        if row is None:
+            _wake.wait(JOB_POLL_INTERVAL)
+            continue
+        _run(row)
+
+def _heartbeat():
+    # keeps this process's running jobs from looking stale, and requeues
+    # those of processes that stopped
+    while True:
+        try:
+            now = time.time()
+            conn = _db()
+            for job_id in list(_running):
+                conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (now, job_id))
+            requeued = conn.execute("UPDATE jobs SET status = 'queued', heartbeat = NULL "
+                                    "WHERE status = 'running' AND heartbeat < ?", (now - JOB_STALE_SECONDS,)).rowcount
+            if requeued:
+                log_warn("requeued stale jobs", count=requeued)
+                _wake.set()
+            conn.execute("DELETE FROM jobs WHERE finished_at < ?", (now - JOB_RETENTION_SECONDS,))
+        except Exception as e:
+            log_error("job heartbeat failed", error=str(e))
+        time.sleep(JOB_STALE_SECONDS / 3)
+
+def _next_run(after, at_minute, interval, jitter):
+    # the first slot after `after` on the grid of at_minute (UTC) + k * interval,
+    # pushed back by a fresh random jitter
+    anchor = math.floor(after / 86400) * 86400 + at_minute * 60
+    slot = anchor + math.ceil((after - anchor) / interval) * interval
+    if slot <= after:
+        slot += interval
+    return slot + random.uniform(0, jitter)
+
+def _schedule(row):
+    if row is None:
+        return None
+    return {
+        "kind": row["kind"],
+        "params": json.loads(row["params"]),
+        "at": f"{row['at_minute'] // 60:02d}:{row['at_minute'] % 60:02d}",
+        "interval_hours": row["interval_seconds"] / 3600,
+        "jitter_minutes": row["jitter_seconds"] / 60,
+        "next_run": row["next_run"],
+        "last_run": row["last_run"],
+        "last_job": row["last_job"]
+    }
+
+def set_schedule(user_id, kind, params, at="02:00", interval_hours=24, jitter_minutes=60):
+    """Run `kind` for user_id every interval_hours from `at` (UTC), each run
+    starting at a random point within jitter_minutes of its slot."""
+    try:
+        hour, minute = (int(x) for x in at.split(":"))
+        interval, jitter = int(float(interval_hours) * 3600), int(float(jitter_minutes) * 60)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError("at must be HH:MM; interval_hours and jitter_minutes numbers") from None
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError("at must be a time of day, HH:MM")
+    if interval < 3600 or not 0 <= jitter < interval:
+        raise ValueError("interval_hours must be at least 1 and jitter_minutes shorter than the interval")
+    at_minute = hour * 60 + minute
+    next_run = _next_run(time.time(), at_minute, interval, jitter)
+    _db().execute("INSERT INTO schedules (user_id, kind, params, at_minute, interval_seconds, jitter_seconds, "
+                  "next_run) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user_id, kind) DO UPDATE SET "
+                  "params = excluded.params, at_minute = excluded.at_minute, "
+                  "interval_seconds = excluded.interval_seconds, jitter_seconds = excluded.jitter_seconds, "
+                  "next_run = excluded.next_run",
+                  (user_id, kind, json.dumps(params), at_minute, interval, jitter, next_run))
+    return get_schedule(user_id, kind)
+
+def get_schedule(user_id, kind):
+    return _schedule(_db().execute("SELECT * FROM schedules WHERE user_id = ? AND kind = ?",
+                                   (user_id, kind)).fetchone())
+
+def delete_schedule(user_id, kind):
+    return _db().execute("DELETE FROM schedules WHERE user_id = ? AND kind = ?", (user_id, kind)).rowcount > 0
+
+def run_due_schedules(now=None, limit=100):
+    """Queue a job for every schedule that is due; returns how many were queued.
+
+    A schedule whose previous job is still queued or running is moved on
+    to its next slot without queuing another.
+    """
+    now = now or time.time()
+    queued = 0
+    conn = _transaction(_db())
+    try:
+        due = conn.execute("SELECT * FROM schedules WHERE next_run <= ? ORDER BY next_run LIMIT ?",
+                           (now, limit)).fetchall()
+        for row in due:
+            job_id = row["last_job"]
+            busy = job_id and conn.execute("SELECT 1 FROM jobs WHERE id = ? AND status IN ('queued', 'running')",
+                                           (job_id,)).fetchone()
+            if busy:
+                log_warn("scheduled job skipped, previous run unfinished", user_id=row["user_id"], kind=row["kind"])
+            else:
+                job_id = _enqueue(conn, row["user_id"], row["kind"], json.loads(row["params"]),
+                                  JOB_SCHEDULED_WEIGHT, row["next_run"])
+                queued += 1
+            conn.execute("UPDATE schedules SET next_run = ?, last_run = ?, last_job = ? WHERE user_id = ? AND kind = ?",
+                         (_next_run(now, row["at_minute"], row["interval_seconds"], row["jitter_seconds"]),
+                          now, job_id, row["user_id"], row["kind"]))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    if queued:
+        _wake.set()
+    return queued
+
+def _scheduler():
+    while True:
+        try:
+            run_due_schedules()
+        except Exception as e:
+            log_error("job scheduler failed", error=str(e))
+        time.sleep(JOB_SCHEDULER_INTERVAL)
+
+def metrics(window=3600):
+    """Queue depth and lag across all users, for sizing the worker fleet.
+
+    Lag is how long a job waited between being due (queued, or its
+    scheduled slot) and starting; start_lag covers jobs started in the
+    last `window` seconds.
+    """
+    now = time.time()
+    conn = _db()
+    depth = {row[0]: row[1] for row in conn.execute(
+        "SELECT kind, count(*) FROM jobs WHERE status = 'queued' GROUP BY kind")}
+    oldest = conn.execute("SELECT min(due_at) FROM jobs WHERE status = 'queued'").fetchone()[0]
+    lag = conn.execute("SELECT count(*), avg(started_at - due_at), max(started_at - due_at) FROM jobs "
+                       "WHERE started_at >= ?", (now - window,)).fetchone()
+    finished = {row[0]: row[1] for row in conn.execute(
+        "SELECT status, count(*) FROM jobs WHERE finished_at >= ? GROUP BY status", (now - window,))}
+    overdue = conn.execute("SELECT count(*) FROM schedules WHERE next_run < ?",
+                           (now - max(JOB_SCHEDULER_INTERVAL, 1) * 2,)).fetchone()[0]
+    return {
+        "queued": sum(depth.values()),
+        "queued_by_kind": depth,
+        "running": conn.execute("SELECT count(*) FROM jobs WHERE status = 'running'").fetchone()[0],
+        "oldest_queued_seconds": round(now - oldest, 3) if oldest is not None else 0.0,
+        "start_lag": {"jobs": lag[0], "avg_seconds": round(lag[1] or 0.0, 3), "max_seconds": round(lag[2] or 0.0, 3)},
+        "finished": {status: finished.get(status, 0) for status in FINISHED},
+        "schedules": conn.execute("SELECT count(*) FROM schedules").fetchone()[0],
+        "schedules_overdue": overdue,
+        "window_seconds": window
+    }
+
+def start_workers():
+    # idempotent; threads are daemons so they never hold up shutdown
+    global _bandwidth, _process_id
+    with _threads_lock:
+        if _threads:
+            return
+        _process_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        if JOB_BANDWIDTH_LIMIT:
+            _bandwidth = TokenBucket(JOB_BANDWIDTH_LIMIT)
+        targets = [_worker] * JOB_WORKERS + [_heartbeat] + ([_scheduler] if JOB_SCHEDULER_INTERVAL else [])
+        for target in targets:
+            t = threading.Thread(target=target, daemon=True, name=f"jobs-{target.__name__.strip('_')}")
+            t.start()
+            _threads.append(t)
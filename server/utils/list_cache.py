@@ -0,0 +1,101 @@
+# utils/list_cache.py — in-memory per-user listing cache, LRU-bounded by entry count
+import time
+import threading
+from collections import OrderedDict
+
+
+class _Slot:
+    __slots__ = ("entries", "generation", "validated_at", "loaded_at")
+
+    def __init__(self, entries, generation):
+        self.entries = entries  # path -> listing entry, or None when only the generation is tracked
+        self.generation = generation
+        self.validated_at = self.loaded_at = time.time()
+
+
+class ListCache:
+    """Listings keyed by top-level prefix (user id).
+
+    Callers revalidate a slot against its generation once validated_at is
+    older than their TTL and reload it entirely once loaded_at is older than
+    their max age. The total number of cached entries across all slots is
+    kept under max_entries by evicting the least recently used users.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._slots = OrderedDict()
+        self._size = 0
+        self._volatile = {}
+        self._lock = threading.Lock()
+
+    def get(self, top):
+        with self._lock:
+            slot = self._slots.get(top)
+            if slot is not None:
+                self._slots.move_to_end(top)
+            return slot
+
+    def store(self, top, entries, generation):
+        slot = _Slot(entries, generation)
+        with self._lock:
+            self._drop(top)
+            self._slots[top] = slot
+            self._size += len(entries or ())
+            while self._size > self.max_entries and len(self._slots) > 1:
+                self._drop(next(iter(self._slots)))
+        return slot
+
+    def touch(self, top, generation):
+        with self._lock:
+            slot = self._slots.get(top)
+            if slot is not None:
+                slot.generation = generation
+                slot.validated_at = time.time()
+
+    def upsert(self, top, entry, generation):
+        # write-through from this node; generation is the one our write produced
+        with self._lock:
+            slot = self._slots.get(top)
+            if slot is None:
+                return
+            if slot.entries is not None:
+                self._size += entry["path"] not in slot.entries
+                slot.entries[entry["path"]] = entry
+            slot.generation = generation
+
+    def remove(self, top, path, generation):
+        with self._lock:
+            slot = self._slots.get(top)
+            if slot is None:
+                return
+            if slot.entries is not None and slot.entries.pop(path, None) is not None:
+                self._size -= 1
+            slot.generation = generation
+
+    def mark_volatile(self, top, until):
+        # writes we can't see (e.g. presigned uploads) may land before
+        # `until`; callers should reload the user's listing until then
+        with self._lock:
+            self._volatile[top] = max(until, self._volatile.get(top, 0))
+            self._drop(top)
+
+    def volatile(self, top):
+        # True while a volatile window is open, and once more after it
+        # closes so the last write in the window is picked up
+        with self._lock:
+            until = self._volatile.get(top)
+            if until is None:
+                return False
+            if until <= time.time():
+                del self._volatile[top]
+            return True
+
+    def invalidate(self, top):
+        with self._lock:
+            self._drop(top)
+
+    def _drop(self, top):
+        slot = self._slots.pop(top, None)
+        if slot is not None:
+            self._size -= len(slot.entries or ())
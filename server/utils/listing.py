@@ -0,0 +1,67 @@
+# utils/listing.py — helpers shared by the paginated/streamed listing APIs
+import json
+import base64
+
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(state):
+    raw = json.dumps(state, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    # cursors are opaque to clients; anything we didn't issue is a ValueError
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(state, dict):
+        raise ValueError("invalid cursor")
+    return state
+
+def cursor_field(state, key, kind):
+    # one field of a decoded cursor, None when absent; the wrong type means
+    # the cursor was forged or mangled, which is a ValueError like any other
+    value = state.get(key)
+    if value is not None and not isinstance(value, kind):
+        raise ValueError("invalid cursor")
+    return value
+
+def clamp_limit(limit):
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+def prefix_end(prefix):
+    # smallest string greater than every string starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def _match_rank(name, rel, query, ext, match):
+    if ext and not (name.rfind(".") > 0 and name.rsplit(".", 1)[1] == ext):
+        return None
+    if not query:
+        return 2
+    if name == query or name.startswith(query + "."):
+        return 0
+    if name.startswith(query):
+        return 1
+    if match == "prefix":
+        return None
+    if query in name:
+        return 2
+    return 3 if query in rel else None
+
+def rank_matches(entries, query="", ext=None, match="substring"):
+    # in-memory counterpart of metadata_index.search over listing entries:
+    # (rank, entry) pairs, name prefixes alphabetically, the rest newest first
+    query = query.lower()
+    ext = (ext or "").lower().lstrip(".")
+    hits = []
+    for entry in entries:
+        rel = entry["path"].split("/", 1)[-1].lower()
+        rank = _match_rank(entry["name"].lower(), rel, query, ext, match)
+        if rank is not None:
+            hits.append((rank, entry))
+    named = sorted((h for h in hits if h[0] < 2), key=lambda h: (h[0], h[1]["name"].lower(), h[1]["path"]))
+    rest = sorted((h for h in hits if h[0] >= 2), key=lambda h: h[1]["updated"] or "", reverse=True)
+    return named + sorted(rest, key=lambda h: h[0])
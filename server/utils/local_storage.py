@@ -1,10 +1,58 @@
 # utils/storage.py — local filesystem storage adapter
 import os
+import sys
 import json
-from datetime import datetime
-from .logger import log_info
+import io
+import uuid
+import time
+import fcntl
+import struct
+import shutil
+import hashlib
+import functools
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from .logger import log_info, log_warn
+from . import backups, chunk_store, compression, listing, metadata_index, upload_sessions, signed_urls
+from .streams import IterStream, iter_files
 
 BASE_DATA_DIR = os.getenv("DATA_DIR", "./data")
+# where the /transfer handler is reachable; empty means "same host as the API"
+TRANSFER_BASE_URL = os.getenv("TRANSFER_BASE_URL", "").rstrip("/")
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(1024 * 1024)))
+
+# "plain" stores every file verbatim; "dedup" splits content into
+# content-defined chunks kept once in DATA_DIR/.chunks, and the file itself
+# becomes a small recipe of chunk references
+LOCAL_STORAGE_MODE = os.getenv("LOCAL_STORAGE_MODE", "plain")
+
+# "direct" keeps objects at DATA_DIR/<path>; "sharded" spreads them over a
+# fan-out tree (.objects/ab/cd/<sha256 of path>) so no directory grows with
+# a user's file count, and records logical -> physical in the metadata index.
+# Objects not yet migrated (see manage.py migrate-layout) are still found at
+# their direct path. Each shard has a path record beside it (<shard>.path,
+# the logical path), so a full reindex can rebuild a lost index from disk.
+LOCAL_STORAGE_LAYOUT = os.getenv("LOCAL_STORAGE_LAYOUT", "direct")
+_PATH_SUFFIX = ".path"
+
+# ioctl number for a copy-on-write clone of a whole file (linux/fs.h)
+_FICLONE = 0x40049409
+
+# in-progress writes land next to their target under this prefix and are
+# renamed into place once complete, so readers never see a partial file
+_TMP_PREFIX = ".cvtmp-"
+
+# paths per delete_files batch
+_DELETE_BATCH = 1000
+
+# objects not stored verbatim start with a header: magic, a kind byte and
+# the logical (user-visible) size. Verbatim content that happens to begin
+# with the magic is escaped with the "P" kind so reads stay unambiguous.
+_OBJECT_MAGIC = b"\x89CVO\r\n\x1a\n"
+_HEADER = struct.Struct(">8scQ")
+_KIND_RECIPE = b"R"
+_KIND_ESCAPED = b"P"
+_KIND_ZSTD = b"Z"
 
 def _full_path(path):
     return os.path.join(BASE_DATA_DIR, path)
@@ -13,71 +61,723 @@ def _ensure_dir_for(path):
     d = os.path.dirname(_full_path(path))
     os.makedirs(d, exist_ok=True)
 
-def save_file(path, content_bytes):
-    _ensure_dir_for(path)
-    p = _full_path(path)
-    with open(p, "wb") as f:
-        f.write(content_bytes)
+def _chunk_root():
+    return os.path.join(BASE_DATA_DIR, ".chunks")
+
+def _index_root():
+    return os.path.join(BASE_DATA_DIR, ".index")
+
+def _shard_path(path):
+    # physical location (relative to BASE_DATA_DIR) of an object in the sharded layout
+    h = hashlib.sha256(path.encode("utf-8")).hexdigest()
+    return os.path.join(".objects", h[:2], h[2:4], h)
+
+def _is_shard(physical):
+    return physical.startswith(".objects" + os.sep)
+
+def _write_path_record(path, physical):
+    # before the shard is moved into place, under path's lock, so no shard
+    # exists without one; the name is fixed by the path, so it never changes
+    record = os.path.join(BASE_DATA_DIR, physical) + _PATH_SUFFIX
+    if os.path.exists(record):
+        return
+    tmp = os.path.join(os.path.dirname(record), f"{_TMP_PREFIX}{uuid.uuid4().hex}")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(path)
+    os.replace(tmp, record)
+
+def _recorded_path(p):
+    # the logical path a shard's record names, if it matches the shard's name
+    try:
+        with open(p + _PATH_SUFFIX, encoding="utf-8") as f:
+            path = f.read()
+    except (FileNotFoundError, UnicodeDecodeError):
+        return None
+    return path if _shard_path(path) == os.path.relpath(p, BASE_DATA_DIR) else None
+
+def _remove_object(p):
+    # an object's file and, for a shard, its path record
+    os.remove(p)
+    if _is_shard(os.path.relpath(p, BASE_DATA_DIR)):
+        try:
+            os.remove(p + _PATH_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+def _object_path(path):
+    # where the object's bytes live on disk right now
+    if LOCAL_STORAGE_LAYOUT == "sharded":
+        physical = metadata_index.lookup(_index_root(), path)
+        if physical:
+            return os.path.join(BASE_DATA_DIR, physical)
+    return _full_path(path)
+
+def _index_object(path, physical):
+    # record the object's current state; callers hold _path_lock(path)
+    p = os.path.join(BASE_DATA_DIR, physical)
     stat = os.stat(p)
+    metadata_index.put(_index_root(), path, physical, _logical_size(p, stat), stat.st_size,
+                       datetime.utcfromtimestamp(stat.st_ctime).isoformat(),
+                       datetime.utcfromtimestamp(stat.st_mtime).isoformat())
+
+def _stripe(path):
+    return hashlib.sha1(path.encode("utf-8")).hexdigest()[:2]
+
+@contextmanager
+def _path_lock(path):
+    # striped advisory lock serializing replace/delete of the same path
+    # across threads and worker processes
+    with _path_locks([path]):
+        yield
+
+@contextmanager
+def _path_locks(paths):
+    # every stripe paths fall in, taken in order so two bulk callers can't deadlock
+    lock_dir = os.path.join(BASE_DATA_DIR, ".locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    with ExitStack() as stack:
+        for stripe in sorted({_stripe(p) for p in paths}):
+            f = stack.enter_context(open(os.path.join(lock_dir, stripe), "a"))
+            fcntl.flock(f, fcntl.LOCK_EX)
+            stack.callback(fcntl.flock, f, fcntl.LOCK_UN)
+        yield
+
+def _read_header(f):
+    # returns (kind, logical_size) and leaves f at the payload; (None, None)
+    # with f rewound for verbatim files
+    head = f.read(_HEADER.size)
+    if len(head) == _HEADER.size and head.startswith(_OBJECT_MAGIC):
+        _, kind, size = _HEADER.unpack(head)
+        return kind, size
+    f.seek(0)
+    return None, None
+
+def _object_info(p):
+    with open(p, "rb") as f:
+        kind, size = _read_header(f)
+        recipe = {"size": size, "chunks": json.loads(f.read())} if kind == _KIND_RECIPE else None
+    return kind, size, recipe
+
+def _logical_size(p, stat):
+    if stat.st_size < _HEADER.size:
+        return stat.st_size
+    with open(p, "rb") as f:
+        kind, size = _read_header(f)
+    return stat.st_size if kind is None else size
+
+def _write_plain(f, stream, chunk_size, progress):
+    first = stream.read(chunk_size)
+    while first and len(first) < len(_OBJECT_MAGIC):
+        more = stream.read(chunk_size)
+        if not more:
+            break
+        first += more
+    if compression.should_compress(first):
+        kind = _KIND_ZSTD
+    elif first.startswith(_OBJECT_MAGIC):
+        kind = _KIND_ESCAPED
+    else:
+        kind = None
+    if kind:
+        f.write(_HEADER.pack(_OBJECT_MAGIC, kind, 0))
+    written = 0
+
+    def chunks():
+        nonlocal written
+        chunk = first
+        while chunk:
+            written += len(chunk)
+            if progress:
+                progress(written)
+            yield chunk
+            chunk = stream.read(chunk_size)
+
+    for out in compression.compress_chunks(chunks()) if kind == _KIND_ZSTD else chunks():
+        f.write(out)
+    if kind:
+        # the logical size is only known once the stream is drained
+        f.seek(0)
+        f.write(_HEADER.pack(_OBJECT_MAGIC, kind, written))
+    return written
+
+def _write_recipe(f, recipe):
+    f.write(_HEADER.pack(_OBJECT_MAGIC, _KIND_RECIPE, recipe["size"]))
+    f.write(json.dumps(recipe["chunks"], separators=(",", ":")).encode("utf-8"))
+
+class _ProgressReader:
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+        self.done = 0
+
+    def read(self, n=-1):
+        chunk = self.stream.read(n)
+        self.done += len(chunk)
+        if chunk and self.progress:
+            self.progress(self.done)
+        return chunk
+
+def _install(path, tmp, physical):
+    # move a finished temp file into place as path's object; returns the
+    # replaced object's recipe, whose chunks the caller releases
+    p = os.path.join(BASE_DATA_DIR, physical)
+    with _path_lock(path):
+        current = _object_path(path)
+        previous = _object_info(current)[2] if os.path.isfile(current) else None
+        if _is_shard(physical):
+            _write_path_record(path, physical)
+        os.replace(tmp, p)
+        _index_object(path, physical)
+        if current != p and os.path.isfile(current):
+            _remove_object(current)
+    return previous
+
+def save_file(path, content_bytes):
+    return save_stream(path, io.BytesIO(content_bytes))
+
+def save_stream(path, stream, chunk_size=None, progress=None):
+    # copy a file-like object to disk in bounded chunks; memory use does not
+    # depend on the size of the upload
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    sharded = LOCAL_STORAGE_LAYOUT == "sharded"
+    physical = _shard_path(path) if sharded else path
+    p = os.path.join(BASE_DATA_DIR, physical)
+    os.makedirs(os.path.dirname(p), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(p), f"{_TMP_PREFIX}{uuid.uuid4().hex}")
+    recipe = None
+    try:
+        if LOCAL_STORAGE_MODE == "dedup":
+            recipe = chunk_store.store(_chunk_root(), _ProgressReader(stream, progress))
+        with open(tmp, "wb") as f:
+            if recipe is not None:
+                _write_recipe(f, recipe)
+                size = recipe["size"]
+            else:
+                size = _write_plain(f, stream, chunk_size, progress)
+        previous = _install(path, tmp, physical)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if recipe is not None:
+            chunk_store.release(_chunk_root(), recipe)
+        raise
+    if previous is not None:
+        chunk_store.release(_chunk_root(), previous)
     meta = {
         "filename": os.path.basename(path),
         "path": path,
         "full_path": p,
-        "size": stat.st_size,
+        "size": size,
         "url": None,
         "uploaded_at": datetime.utcnow().isoformat()
     }
     log_info("saved file", meta=meta)
     return meta
 
+def _clone_file(src, dst, link=False):
+    # reflink (FICLONE: btrfs, XFS, ...), else a byte copy; with link, a hard
+    # link first. Only pass link when neither side is ever written in place:
+    # out-of-band writers (fs_indexer) may rewrite user files, and a shared
+    # inode would carry that write into the copy
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    with open(src, "rb") as fs, open(dst, "wb") as fd:
+        try:
+            fcntl.ioctl(fd.fileno(), _FICLONE, fs.fileno())
+            return
+        except OSError:
+            shutil.copyfileobj(fs, fd, STREAM_CHUNK_SIZE)
+    # keep the mtime as a link would, so restored files match their entries
+    st = os.stat(src)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def _internal(path):
+    # objects under backups/ are written only by this module and only replaced
+    return path.split("/", 1)[0] == "backups"
+
+def copy_file(src, dst):
+    # copy the stored object as is (no decode/re-encode); raises
+    # FileNotFoundError when src doesn't exist
+    physical = _shard_path(dst) if LOCAL_STORAGE_LAYOUT == "sharded" else dst
+    p = os.path.join(BASE_DATA_DIR, physical)
+    os.makedirs(os.path.dirname(p), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(p), f"{_TMP_PREFIX}{uuid.uuid4().hex}")
+    recipe = None
+    try:
+        with _path_lock(src):
+            source = _object_path(src)
+            if not os.path.isfile(source):
+                raise FileNotFoundError(src)
+            _clone_file(source, tmp, link=_internal(src) and _internal(dst))
+            # under src's lock, so a concurrent delete can't release the chunks first
+            recipe = _object_info(tmp)[2]
+            if recipe is not None:
+                chunk_store.retain(_chunk_root(), recipe)
+        previous = _install(dst, tmp, physical)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if recipe is not None:
+            chunk_store.release(_chunk_root(), recipe)
+        raise
+    if previous is not None:
+        chunk_store.release(_chunk_root(), previous)
+    return {"path": dst, "size": _logical_size(p, os.stat(p))}
+
+def _ensure_indexed(prefix):
+    # a user's tree is walked into the index only the first time it is
+    # listed (see reindex for repairing drift)
+    top = metadata_index.top_level(prefix)
+    if top and not metadata_index.is_scanned(_index_root(), top):
+        reindex(top)
+
+def _index_entry(row):
+    return {
+        "name": os.path.basename(row["path"]),
+        "path": row["path"],
+        "full_path": os.path.join(BASE_DATA_DIR, row["physical"]),
+        "size": row["size"],
+        "stored_size": row["stored_size"],
+        "created": row["created"],
+        "updated": row["updated"]
+    }
+
 def list_files(prefix):
-    root = _full_path(prefix)
-    out = []
-    if not os.path.exists(root):
+    # served from the metadata index rather than a directory walk
+    _ensure_indexed(prefix)
+    return [_index_entry(row) for row in metadata_index.iter_prefix(_index_root(), prefix)]
+
+def iter_listing(prefix, page_size=listing.MAX_PAGE_SIZE):
+    # same entries as list_files, produced lazily in keyset-paginated batches
+    # so neither memory nor a database read transaction grows with the vault
+    _ensure_indexed(prefix)
+    start = None
+    while True:
+        rows, _, start = metadata_index.list_page(_index_root(), prefix, None, page_size, start)
+        for row in rows:
+            yield _index_entry(row)
+        if start is None:
+            return
+
+def list_page(prefix, delimiter=None, limit=None, cursor=None):
+    # one page of objects under a raw key prefix; with a delimiter, deeper
+    # keys are folded into "folders" (common prefixes) as on S3
+    limit = listing.clamp_limit(limit)
+    start = listing.cursor_field(listing.decode_cursor(cursor), "s", str) if cursor else None
+    _ensure_indexed(prefix)
+    rows, folders, next_start = metadata_index.list_page(_index_root(), prefix, delimiter, limit, start)
+    return {
+        "files": [_index_entry(row) for row in rows],
+        "folders": folders,
+        "next_cursor": listing.encode_cursor({"s": next_start}) if next_start is not None else None
+    }
+
+def search_files(prefix, query="", ext=None, match="substring", limit=None, cursor=None):
+    # ranked name/path search within one user, served from the metadata index
+    limit = listing.clamp_limit(limit)
+    after = listing.decode_cursor(cursor).get("a") if cursor else None
+    top = metadata_index.top_level(prefix)
+    _ensure_indexed(top)
+    rows, after = metadata_index.search(_index_root(), top, query, ext, match, limit, after)
+    return {
+        "files": [dict(_index_entry(row), rank=row["rank"]) for row in rows],
+        "next_cursor": listing.encode_cursor({"a": after}) if after else None
+    }
+
+def dir_tree(top):
+    # the live directory hash tree under top, as path -> node (see utils/merkle.py)
+    _ensure_indexed(top)
+    return functools.partial(metadata_index.dir_node, _index_root())
+
+def sync_index_entry(path):
+    # re-read one direct-layout path from disk into the index (used by the
+    # filesystem indexer for changes made behind our back)
+    root = _index_root()
+    with _path_lock(path):
+        current = metadata_index.lookup(root, path)
+        if current and current != path:
+            return  # a sharded copy supersedes this direct path
+        if os.path.isfile(_full_path(path)):
+            _index_object(path, path)
+        elif current:
+            metadata_index.remove(root, path)
+
+def _top_dirs():
+    # per-user directories; dot-directories hold storage internals
+    if not os.path.isdir(BASE_DATA_DIR):
         return []
-    # walk and list files under prefix
-    for dirpath, _, filenames in os.walk(root):
+    return sorted(e for e in os.listdir(BASE_DATA_DIR) if not e.startswith("."))
+
+def _walk_direct(prefix):
+    # logical paths of objects stored at their direct path under prefix
+    for top in [prefix.strip("/")] if prefix.strip("/") else _top_dirs():
+        for dirpath, _, filenames in os.walk(_full_path(top)):
+            for fn in filenames:
+                if not fn.startswith(_TMP_PREFIX):
+                    yield os.path.relpath(os.path.join(dirpath, fn), BASE_DATA_DIR)
+
+def reindex(prefix=""):
+    """Bring the metadata index for prefix ("" for everything) in line with disk.
+
+    Adds or refreshes every object found and drops rows whose file is gone.
+    A full reindex also walks the shard tree: a shard missing from the index
+    is indexed again under the logical path in its record, and pruned only
+    when that path is confirmed to live elsewhere now. Shards without a
+    record are reported as orphans and left in place. Returns counts of each.
+    """
+    root = _index_root()
+    started = time.time()
+    indexed = removed = recovered = pruned = orphans = 0
+    for path in _walk_direct(prefix):
+        with _path_lock(path):
+            current = metadata_index.lookup(root, path)
+            if current and current != path:
+                continue  # superseded by a sharded copy; migration cleans it up
+            if os.path.isfile(_full_path(path)):
+                _index_object(path, path)
+                indexed += 1
+    for row in list(metadata_index.iter_prefix(root, prefix, indexed_before=started)):
+        with _path_lock(row["path"]):
+            p = os.path.join(BASE_DATA_DIR, row["physical"])
+            if os.path.isfile(p):
+                _index_object(row["path"], row["physical"])
+                indexed += 1
+            elif metadata_index.lookup(root, row["path"]) == row["physical"]:
+                metadata_index.remove(root, row["path"])
+                removed += 1
+    if not prefix.strip("/"):
+        recovered, pruned, orphans = _recover_shards(started)
+    top = metadata_index.top_level(prefix)
+    for t in [top] if top else _top_dirs():
+        metadata_index.mark_scanned(root, t)
+    log_info("metadata index rebuilt", prefix=prefix, indexed=indexed, removed=removed,
+             recovered=recovered, pruned=pruned, orphans=orphans)
+    return {"indexed": indexed, "removed": removed, "recovered": recovered, "pruned": pruned, "orphans": orphans}
+
+def _recover_shards(started, grace=3600):
+    # shard files no row points at: left behind by a crash between write and
+    # index update, or every shard once the index is lost. Returns
+    # (recovered, pruned, orphans); the grace period keeps writes that are
+    # mid-flight out of the orphan count
+    root = _index_root()
+    shard_root = os.path.join(BASE_DATA_DIR, ".objects")
+    if not os.path.isdir(shard_root):
+        return 0, 0, 0
+    known = {row["physical"] for row in metadata_index.iter_prefix(root, "")}
+    recovered = pruned = orphans = 0
+    for dirpath, _, filenames in os.walk(shard_root):
         for fn in filenames:
-            rel = os.path.relpath(os.path.join(dirpath, fn), BASE_DATA_DIR)
-            stat = os.stat(os.path.join(dirpath, fn))
-            out.append({
-                "name": fn,
-                "path": rel,
-                "full_path": os.path.join(dirpath, fn),
-                "size": stat.st_size,
-                "created": datetime.utcfromtimestamp(stat.st_ctime).isoformat(),
-                "updated": datetime.utcfromtimestamp(stat.st_mtime).isoformat()
-            })
-    return out
+            p = os.path.join(dirpath, fn)
+            rel = os.path.relpath(p, BASE_DATA_DIR)
+            if fn.startswith(_TMP_PREFIX) or fn.endswith(_PATH_SUFFIX) or rel in known:
+                continue
+            path = _recorded_path(p)
+            if path is None:
+                if os.path.getmtime(p) <= started - grace:
+                    log_warn("shard has no path record; left in place", physical=rel)
+                    orphans += 1
+                continue
+            with _path_lock(path):
+                current = metadata_index.lookup(root, path)
+                if not os.path.isfile(p) or current == rel:
+                    continue  # deleted or indexed meanwhile
+                if current and os.path.isfile(os.path.join(BASE_DATA_DIR, current)) \
+                        and LOCAL_STORAGE_LAYOUT != "sharded":
+                    # rewritten at its direct path since; this copy is dead
+                    recipe = _object_info(p)[2]
+                    _remove_object(p)
+                    if recipe is not None:
+                        chunk_store.release(_chunk_root(), recipe)
+                    pruned += 1
+                else:
+                    # in the sharded layout the shard is the newest copy
+                    _index_object(path, rel)
+                    recovered += 1
+    return recovered, pruned, orphans
 
 def read_file(path):
-    p = _full_path(path)
+    p = _object_path(path)
     if not os.path.exists(p):
         return None
+    return b"".join(iter_file(path))
+
+def get_local_path(path):
+    # on-disk file holding the object's bytes verbatim, for sendfile-style serving
+    p = _object_path(path)
+    if not os.path.isfile(p):
+        return None
     with open(p, "rb") as f:
-        return f.read()
-
-def create_backup_manifest(user_id, backup_name=None):
-    files = list_files(user_id)
-    if not backup_name:
-        backup_name = f"backup_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
-    manifest = {
-        "name": backup_name,
-        "user_id": user_id,
-        "created_at": datetime.utcnow().isoformat(),
-        "files": files,
-        "file_count": len(files)
+        kind, _ = _read_header(f)
+    return p if kind is None else None
+
+def stat_file(path):
+    p = _object_path(path)
+    if not os.path.isfile(p):
+        return None
+    stat = os.stat(p)
+    return {
+        "size": _logical_size(p, stat),
+        "etag": f"{stat.st_mtime_ns:x}-{stat.st_size:x}",
+        "last_modified": datetime.fromtimestamp(stat.st_mtime, timezone.utc)
     }
-    manifest_path = f"backups/{user_id}/{backup_name}_manifest.json"
-    _ensure_dir_for(manifest_path)
-    with open(_full_path(manifest_path), "w") as f:
-        json.dump(manifest, f, indent=2)
-    return {"name": backup_name, "manifest_path": manifest_path, "url": None}
-    
-def restore_from_manifest(backup_name):
-    # naive local restore: find backups/*/*_manifest.json with name
-    # return counts (for demo)
-    restored = []
-    failed = []
-    # For simple demo, just return empty
-    return {"restored_count": len(restored), "failed_count": len(failed), "restored_files": restored, "failed_files": failed}
+
+def iter_file(path, start=0, end=None, chunk_size=None):
+    # yield bytes [start, end] (inclusive, like an HTTP range) in bounded chunks
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    with open(_object_path(path), "rb") as f:
+        kind, _ = _read_header(f)
+        if kind == _KIND_RECIPE:
+            chunks = json.loads(f.read())
+            yield from chunk_store.iter_recipe(_chunk_root(), chunks, start, end)
+            return
+        if kind == _KIND_ZSTD:
+            # no random access into a zstd stream: decompress and skip to start
+            payload = iter(lambda: f.read(chunk_size), b"")
+            yield from compression.slice_chunks(compression.decompress_chunks(payload), start, end)
+            return
+        f.seek(f.tell() + start)
+        remaining = None if end is None else end - start + 1
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+def delete_file(path):
+    with _path_lock(path):
+        p = _object_path(path)
+        if not os.path.isfile(p):
+            return False
+        recipe = _object_info(p)[2]
+        _remove_object(p)
+        metadata_index.remove(_index_root(), path)
+    if recipe is not None:
+        chunk_store.release(_chunk_root(), recipe)
+    log_info("deleted file", path=path)
+    return True
+
+def delete_files(paths):
+    # bulk delete_file: per batch, one pass of unlinks under the batch's
+    # lock stripes and one index transaction; returns how many existed
+    deleted = 0
+    for i in range(0, len(paths), _DELETE_BATCH):
+        batch, recipes = paths[i:i + _DELETE_BATCH], []
+        with _path_locks(batch):
+            removed = []
+            for path in batch:
+                p = _object_path(path)
+                if not os.path.isfile(p):
+                    continue
+                recipes.append(_object_info(p)[2])
+                _remove_object(p)
+                removed.append(path)
+            metadata_index.remove_many(_index_root(), removed)
+        for recipe in recipes:
+            if recipe is not None:
+                chunk_store.release(_chunk_root(), recipe)
+        deleted += len(removed)
+    log_info("deleted files", count=deleted)
+    return deleted
+
+def download_to_file(path, dest_path):
+    p = _object_path(path)
+    if not os.path.isfile(p):
+        return None
+    if get_local_path(path):
+        shutil.copyfile(p, dest_path)
+    else:
+        with open(dest_path, "wb") as f:
+            for chunk in iter_file(path):
+                f.write(chunk)
+    return {"path": dest_path, "size": os.path.getsize(dest_path)}
+
+def presign_url(path, method="GET", expires_in=None, size=None, owner=None):
+    # served by transfer_app, which checks only this signature and expiry
+    # and charges a PUT to owner's quota once it is written
+    token, expires_at = signed_urls.sign(path, method, expires_in, size, owner)
+    return {"url": f"{TRANSFER_BASE_URL}/transfer/{token}", "method": method, "expires_at": expires_at}
+
+def migrate_to_sharded(dry_run=False):
+    """Move every direct-layout object into the sharded tree, one at a time.
+
+    Safe while the server runs with LOCAL_STORAGE_LAYOUT=sharded: each move
+    holds the object's path lock, and readers find the object at its old
+    path until the index points at the new one. Returns (moved, skipped).
+    """
+    moved = skipped = 0
+    for top in _top_dirs():
+        # backups/ holds manifests, which are read by path
+        if top == "backups" or not os.path.isdir(_full_path(top)):
+            continue
+        for dirpath, _, filenames in os.walk(_full_path(top)):
+            for fn in filenames:
+                if fn.startswith(_TMP_PREFIX):
+                    continue
+                path = os.path.relpath(os.path.join(dirpath, fn), BASE_DATA_DIR)
+                if dry_run:
+                    moved += 1
+                    continue
+                if _migrate_object(path):
+                    moved += 1
+                else:
+                    skipped += 1
+        if not dry_run:
+            # drop the emptied direct-layout directories so walks stay cheap
+            for dirpath, _, _ in os.walk(_full_path(top), topdown=False):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+    log_info("layout migration finished", moved=moved, skipped=skipped, dry_run=dry_run)
+    return moved, skipped
+
+def _migrate_object(path):
+    src = _full_path(path)
+    dst = os.path.join(BASE_DATA_DIR, _shard_path(path))
+    with _path_lock(path):
+        if not os.path.isfile(src):
+            return False  # deleted or rewritten since the walk saw it
+        if metadata_index.lookup(_index_root(), path) == _shard_path(path):
+            # a sharded write already superseded this copy
+            os.remove(src)
+            return False
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(dst), f"{_TMP_PREFIX}{uuid.uuid4().hex}")
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copy2(src, tmp)  # DATA_DIR spans filesystems
+        _write_path_record(path, _shard_path(path))
+        os.replace(tmp, dst)
+        _index_object(path, _shard_path(path))
+        os.remove(src)
+    return True
+
+def _upload_dir(session_id):
+    return os.path.join(BASE_DATA_DIR, ".uploads", session_id)
+
+def _load_upload_session(session_id):
+    if not upload_sessions.valid_id(session_id):
+        return None
+    try:
+        with open(os.path.join(_upload_dir(session_id), "session.json")) as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        return None
+    return None if upload_sessions.is_expired(session) else session
+
+def _received_chunks(session_id):
+    return [int(fn[:-len(".part")]) for fn in os.listdir(_upload_dir(session_id)) if fn.endswith(".part")]
+
+def create_upload_session(user_id, path, total_size, chunk_size=None):
+    purge_expired_upload_sessions()
+    session = upload_sessions.new_session(user_id, path, total_size, chunk_size)
+    d = _upload_dir(session["session_id"])
+    os.makedirs(d)
+    tmp = os.path.join(d, f"{_TMP_PREFIX}session")
+    with open(tmp, "w") as f:
+        json.dump(session, f)
+    os.replace(tmp, os.path.join(d, "session.json"))
+    log_info("upload session created", session_id=session["session_id"], path=path, size=total_size)
+    return upload_sessions.status(session, [])
+
+def get_upload_session(session_id):
+    session = _load_upload_session(session_id)
+    if session is None:
+        return None
+    return upload_sessions.status(session, _received_chunks(session_id))
+
+def put_upload_chunk(session_id, index, stream):
+    # chunks are staged as <index>.part; re-sending a chunk simply replaces it
+    session = _load_upload_session(session_id)
+    if session is None:
+        return None
+    expected = upload_sessions.expected_chunk_size(session, index)
+    d = _upload_dir(session_id)
+    tmp = os.path.join(d, f"{_TMP_PREFIX}{uuid.uuid4().hex}")
+    written = 0
+    try:
+        try:
+            f = open(tmp, "wb")
+        except FileNotFoundError:
+            return None  # committed or aborted meanwhile
+        with f:
+            while written <= expected:
+                chunk = stream.read(min(STREAM_CHUNK_SIZE, expected + 1 - written))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+        if written != expected:
+            raise ValueError(f"chunk {index} must be exactly {expected} bytes")
+        os.replace(tmp, os.path.join(d, f"{index}.part"))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return upload_sessions.status(session, _received_chunks(session_id))
+
+def commit_upload_session(session_id):
+    # parts are streamed through save_stream in order, never held in memory.
+    # Renaming the session directory claims the commit: a concurrent commit
+    # (or chunk PUT) no longer finds the session and gets None
+    session = _load_upload_session(session_id)
+    if session is None:
+        return None
+    missing = upload_sessions.status(session, _received_chunks(session_id))["missing_chunks"]
+    if missing:
+        raise ValueError(f"{len(missing)} chunk(s) still missing")
+    d = _upload_dir(session_id)
+    claimed = f"{d}{_TMP_PREFIX}commit"
+    try:
+        os.rename(d, claimed)
+    except FileNotFoundError:
+        return None
+    parts = [os.path.join(claimed, f"{i}.part") for i in range(upload_sessions.chunk_count(session))]
+    try:
+        meta = save_stream(session["path"], IterStream(iter_files(parts, STREAM_CHUNK_SIZE)))
+    except BaseException:
+        os.rename(claimed, d)  # hand the session back so the commit can be retried
+        raise
+    shutil.rmtree(claimed, ignore_errors=True)
+    return meta
+
+def abort_upload_session(session_id):
+    if not upload_sessions.valid_id(session_id) or not os.path.isdir(_upload_dir(session_id)):
+        return False
+    shutil.rmtree(_upload_dir(session_id), ignore_errors=True)
+    return True
+
+def purge_expired_upload_sessions():
+    root = os.path.join(BASE_DATA_DIR, ".uploads")
+    if not os.path.isdir(root):
+        return 0
+    purged = 0
+    for entry in os.scandir(root):
+        if not entry.is_dir():
+            continue
+        try:
+            with open(os.path.join(entry.path, "session.json")) as f:
+                expired = upload_sessions.is_expired(json.load(f))
+        except FileNotFoundError:
+            # directory still being created, or left behind by a crash
+            expired = time.time() - entry.stat().st_mtime > upload_sessions.UPLOAD_SESSION_TTL
+        if expired:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            purged += 1
+    return purged
+
+def create_backup_manifest(user_id, backup_name=None, mode="auto", progress=None):
+    # full or incremental snapshot manifest under backups/<user_id>/
+    meta = backups.create_snapshot(sys.modules[__name__], user_id, backup_name, mode, progress)
+    return dict(meta, url=None)
+
+def restore_from_manifest(user_id, backup_name, target=None, progress=None, max_bytes=None, on_written=None):
+    # parallel, resumable restore of one of user_id's snapshots; see utils/backups.py
+    return backups.restore_snapshot(sys.modules[__name__], user_id, backup_name, target, progress,
+                                    max_bytes, on_written)
@@ -0,0 +1,160 @@
+# utils/manifests.py — compact, block-indexed snapshot manifests
+#
+# Layout: MAGIC, then each section ("files", "added", ...) as blocks of
+# length-prefixed compact JSON records sorted by path, each block its own
+# zstd frame when available; then a JSON footer with the snapshot metadata
+# and, per block, [first path, last path, offset, length, count]; then a
+# fixed trailer pointing at the footer. Writing streams block by block and
+# a lookup reads the tail plus the one block whose path range covers it.
+import os
+import json
+import struct
+from bisect import bisect_right
+from . import compression
+from .streams import IterStream
+
+MAGIC = b"CVM1"
+_TRAILER = struct.Struct(">QI4s")  # footer offset, footer length, magic
+_LEN = struct.Struct(">I")
+# uncompressed bytes per block: the unit of a lookup read
+MANIFEST_BLOCK_BYTES = int(os.getenv("MANIFEST_BLOCK_BYTES", str(64 * 1024)))
+# "zstd" frames each block when zstandard is installed; "none" stores them raw
+MANIFEST_COMPRESSION = os.getenv("MANIFEST_COMPRESSION", "zstd").lower()
+# the manifest keys stored as sections; everything else is metadata
+SECTIONS = ("files", "added", "modified", "deleted", "dirs")
+# the first read takes this much of the tail, which holds most footers whole
+_TAIL_BYTES = 64 * 1024
+
+def _codec():
+    return "zstd" if MANIFEST_COMPRESSION == "zstd" and compression.zstandard is not None else None
+
+def iter_manifest(meta, sections):
+    """Yield the encoded manifest for `meta` and {section: sorted entries}.
+
+    Entries are consumed lazily, so a section can be a generator; each must
+    be a dict with a "path" and come in ascending path order.
+    """
+    codec = _codec()
+    yield MAGIC
+    offset = len(MAGIC)
+    index = {}
+    for name, entries in sections.items():
+        blocks = index[name] = []
+        records, size, first, last = [], 0, None, None
+
+        def flush():
+            raw = b"".join(records)
+            data = compression.compress_bytes(raw) if codec else raw
+            blocks.append([first, last, offset, len(data), len(records)])
+            return data
+
+        for entry in entries:
+            path = entry["path"]
+            if last is not None and path <= last:
+                raise ValueError(f"manifest section {name!r} is not sorted at {path!r}")
+            rec = json.dumps(entry, separators=(",", ":")).encode("utf-8")
+            records.append(_LEN.pack(len(rec)) + rec)
+            size += _LEN.size + len(rec)
+            first = path if first is None else first
+            last = path
+            if size >= MANIFEST_BLOCK_BYTES:
+                data = flush()
+                yield data
+                offset += len(data)
+                records, size, first = [], 0, None
+        if records:
+            data = flush()
+            yield data
+            offset += len(data)
+    footer = json.dumps({"meta": meta, "codec": codec, "sections": index}, separators=(",", ":")).encode("utf-8")
+    yield footer
+    yield _TRAILER.pack(offset, len(footer), MAGIC)
+
+def write_manifest(store, path, meta, sections):
+    store.save_stream(path, IterStream(iter_manifest(meta, sections)))
+
+def _records(raw):
+    pos = 0
+    while pos < len(raw):
+        (n,) = _LEN.unpack_from(raw, pos)
+        pos += _LEN.size
+        yield json.loads(raw[pos:pos + n])
+        pos += n
+
+class Manifest:
+    """Reader over a stored manifest; blocks are fetched with ranged reads."""
+
+    def __init__(self, store, path, size):
+        self._store = store
+        self._path = path
+        tail_start = max(size - _TAIL_BYTES, 0)
+        tail = self._read(tail_start, size - 1)
+        footer_offset, footer_length, magic = _TRAILER.unpack(tail[-_TRAILER.size:])
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a manifest")
+        if footer_offset >= tail_start:
+            footer = tail[footer_offset - tail_start:footer_offset - tail_start + footer_length]
+        else:
+            footer = self._read(footer_offset, footer_offset + footer_length - 1)
+        footer = json.loads(footer)
+        self.meta = footer["meta"]
+        self._codec = footer["codec"]
+        self._sections = footer["sections"]
+
+    def _read(self, start, end):
+        return b"".join(self._store.iter_file(self._path, start, end))
+
+    def _block(self, block):
+        data = self._read(block[2], block[2] + block[3] - 1)
+        return _records(compression.decompress_bytes(data) if self._codec else data)
+
+    def has(self, section):
+        # written with the section, even if empty (older manifests lack "dirs")
+        return section in self._sections
+
+    def count(self, section):
+        return sum(b[4] for b in self._sections.get(section, []))
+
+    def iter(self, section):
+        for block in self._sections.get(section, []):
+            yield from self._block(block)
+
+    def lookup(self, section, path):
+        # one block read at most, none when path falls outside every block
+        blocks = self._sections.get(section, [])
+        i = bisect_right([b[0] for b in blocks], path) - 1
+        if i < 0 or path > blocks[i][1]:
+            return None
+        return next((e for e in self._block(blocks[i]) if e["path"] == path), None)
+
+    def to_dict(self):
+        manifest = dict(self.meta)
+        for section in self._sections:
+            manifest[section] = list(self.iter(section))
+        if "deleted" in manifest:
+            manifest["deleted"] = [e["path"] for e in manifest["deleted"]]
+        return manifest
+
+class MemoryManifest(Manifest):
+    """The same interface over a manifest held as one dict (being written,
+    or stored as a single JSON document by earlier versions)."""
+
+    def __init__(self, manifest):
+        self.meta = {k: v for k, v in manifest.items() if k not in SECTIONS}
+        self._lists = {k: manifest[k] for k in ("files", "added", "modified", "dirs") if k in manifest}
+        if "deleted" in manifest:
+            self._lists["deleted"] = [{"path": p} for p in manifest["deleted"]]
+        self._sections = self._lists
+
+    def count(self, section):
+        return len(self._lists.get(section, []))
+
+    def iter(self, section):
+        return iter(self._lists.get(section, []))
+
+    def lookup(self, section, path):
+        return next((e for e in self._lists.get(section, []) if e["path"] == path), None)
+
+def open_manifest(store, path):
+    info = store.stat_file(path)
+    return Manifest(store, path, info["size"]) if info is not None else None
@@ -0,0 +1,88 @@
+# utils/merkle.py — directory hash trees for diffs proportional to change
+#
+# Every file has a 64-bit leaf hash over (path, size, updated), the fields
+# backups.diff uses to decide a file changed. A directory's hash is the XOR
+# of the leaves below it, i.e. of its files' leaves and its subdirectories'
+# hashes, so a write updates each ancestor in place without re-reading
+# siblings (metadata_index maintains the live tree that way, in triggers).
+#
+# A node is {"path", "hash", "files": {name: leaf}, "dirs": {name: hash}}
+# for one directory. Trees are passed around as a function path -> node
+# (None when the directory doesn't exist): a dict's .get for trees built in
+# memory, index or manifest lookups otherwise. diff() only asks for nodes
+# whose hashes differ, so comparing two mostly equal trees reads little.
+import json
+import hashlib
+
+def leaf(path, size, updated):
+    digest = hashlib.sha256(f"{path}\x00{size}\x00{updated}".encode("utf-8")).digest()
+    # signed, so SQLite can store and XOR it as an INTEGER
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+def ancestors(path):
+    # "u1/a/b.txt" -> ["u1", "u1/a"]
+    parts = path.split("/")[:-1]
+    return ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+def ancestors_json(path):
+    # for SQL triggers, which iterate it with json_each
+    return json.dumps(ancestors(path))
+
+def build(entries):
+    """dir path -> node for every directory holding one of `entries`."""
+    nodes = {}
+    for e in entries:
+        parent, _, name = e["path"].rpartition("/")
+        if not parent:
+            continue
+        h = leaf(e["path"], e["size"], e["updated"])
+        for d in ancestors(e["path"]):
+            node = nodes.get(d)
+            if node is None:
+                node = nodes[d] = {"path": d, "hash": 0, "files": {}, "dirs": {}}
+            node["hash"] ^= h
+        nodes[parent]["files"][name] = h
+    for d, node in nodes.items():
+        if "/" in d:
+            parent, _, name = d.rpartition("/")
+            nodes[parent]["dirs"][name] = node["hash"]
+    return nodes
+
+def changes(nodes, base):
+    """The nodes of `nodes` that differ from `base`, plus a {"path",
+    "removed": True} marker for each directory only `base` has, in path
+    order: what an incremental manifest stores."""
+    out = [nodes[d] for d in nodes if d not in base or base[d]["hash"] != nodes[d]["hash"]]
+    out += [{"path": d, "removed": True} for d in base if d not in nodes]
+    return sorted(out, key=lambda n: n["path"])
+
+def diff(old, new, root):
+    """Files added, modified and deleted from tree `old` to tree `new` below
+    directory `root`, descending only where directory hashes differ.
+
+    Returns {"added", "modified", "deleted"} (sorted paths) and
+    "nodes_read", the number of directories compared.
+    """
+    added, modified, deleted = [], [], []
+    pending = [(root, old(root), new(root))]
+    nodes_read = 0
+    while pending:
+        path, a, b = pending.pop()
+        nodes_read += 1
+        if a is not None and b is not None and a["hash"] == b["hash"]:
+            continue
+        a_files, b_files = (a or {}).get("files", {}), (b or {}).get("files", {})
+        for name in a_files.keys() | b_files.keys():
+            if name not in b_files:
+                deleted.append(f"{path}/{name}")
+            elif name not in a_files:
+                added.append(f"{path}/{name}")
+            elif a_files[name] != b_files[name]:
+                modified.append(f"{path}/{name}")
+        a_dirs, b_dirs = (a or {}).get("dirs", {}), (b or {}).get("dirs", {})
+        for name in a_dirs.keys() | b_dirs.keys():
+            if a_dirs.get(name) != b_dirs.get(name):
+                sub = f"{path}/{name}"
+                pending.append((sub, old(sub) if name in a_dirs else None, new(sub) if name in b_dirs else None))
+    return {"added": sorted(added), "modified": sorted(modified), "deleted": sorted(deleted),
+            "nodes_read": nodes_read}
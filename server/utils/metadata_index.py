@@ -0,0 +1,377 @@
+# utils/metadata_index.py — SQLite index of stored objects keyed by logical path
+#
+# One row per object: where it lives plus the fields listings need, so
+# list_files is a range query instead of a directory walk / bucket listing.
+# Top-level prefixes (one per user) are scanned into the index the first
+# time they are listed; `scanned` remembers which ones are populated.
+#
+# search_docs mirrors objects (kept in step by triggers, so every write path
+# updates it) and feeds an FTS5 trigram index over names and paths for
+# /files/search. Doc ids are allocated per user: the high 32 bits are the
+# user's search_users id, so one user's postings form a contiguous rowid
+# range that FTS5 seeks into instead of filtering everyone else's matches.
+#
+# dir_hashes holds the live directory hash tree of utils/merkle.py: per
+# directory, the XOR of the leaf hashes below it and the number of files.
+# Triggers on objects XOR a file's leaf into each ancestor on every write,
+# so keeping the tree current costs one row update per path segment.
+import os
+import sqlite3
+import threading
+import time
+from . import listing, merkle
+
+_TOP_SQL = "substr({p}, 1, instr({p}, '/') - 1)"
+_SEARCH_USER_INSERT = "INSERT OR IGNORE INTO search_users (top) VALUES ({top})"
+# next free id in the owning user's range; evaluated once per statement, so
+# backfills go through executemany rather than INSERT ... SELECT
+_SEARCH_DOC_INSERT = (
+    "INSERT OR IGNORE INTO search_docs (id, path) SELECT (SELECT coalesce(max(d.id) + 1, u.id << 32) "
+    "FROM search_docs d WHERE d.id >= u.id << 32 AND d.id < (u.id + 1) << 32), {p} "
+    "FROM search_users u WHERE u.top = {top}")
+
+def _search_sql(template, p):
+    return template.format(p=p, top=_TOP_SQL.format(p=p))
+
+def _backfill_search_docs(conn):
+    paths = [(row[0],) for row in conn.execute("SELECT path FROM objects")]
+    conn.executemany(_search_sql(_SEARCH_USER_INSERT, "?1"), paths)
+    conn.executemany(_search_sql(_SEARCH_DOC_INSERT, "?1"), paths)
+
+def _create_search_fts(conn):
+    # the trigram tokenizer needs SQLite 3.34+; without it search falls
+    # back to LIKE scans over one user's range of search_docs
+    try:
+        conn.execute("CREATE VIRTUAL TABLE search_fts USING fts5(name, rel, content='search_docs', "
+                     "content_rowid='id', tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return
+    conn.execute("CREATE TRIGGER search_docs_ai AFTER INSERT ON search_docs BEGIN "
+                 "INSERT INTO search_fts (rowid, name, rel) VALUES (new.id, new.name, new.rel); END")
+    conn.execute("CREATE TRIGGER search_docs_ad AFTER DELETE ON search_docs BEGIN "
+                 "INSERT INTO search_fts (search_fts, rowid, name, rel) "
+                 "VALUES ('delete', old.id, old.name, old.rel); END")
+    conn.execute("INSERT INTO search_fts (search_fts) VALUES ('rebuild')")
+
+def _xor_sql(a, b):
+    # SQLite has no XOR operator
+    return f"(({a}) | ({b})) & ~(({a}) & ({b}))"
+
+def _merkle_sql(sign, row):
+    # statements applying (sign "+") or removing (sign "-") one object's leaf
+    # in every ancestor's dir_hashes row
+    leaf = f"merkle_leaf({row}.path, {row}.size, {row}.updated)"
+    ancestors = f"SELECT value FROM json_each(merkle_ancestors({row}.path))"
+    if sign == "+":
+        return (f"INSERT INTO dir_hashes (path, hash, files) SELECT value, {leaf}, 1 "
+                f"FROM json_each(merkle_ancestors({row}.path)) WHERE true ON CONFLICT(path) DO UPDATE "
+                f"SET hash = {_xor_sql('hash', 'excluded.hash')}, files = files + 1; ")
+    return (f"UPDATE dir_hashes SET hash = {_xor_sql('hash', leaf)}, files = files - 1 "
+            f"WHERE path IN ({ancestors}); "
+            f"DELETE FROM dir_hashes WHERE files = 0 AND path IN ({ancestors}); ")
+
+def _backfill_dir_hashes(conn):
+    rows = conn.execute("SELECT path, size, updated FROM objects")
+    nodes = merkle.build({"path": r[0], "size": r[1], "updated": r[2]} for r in rows)
+    counts = {}
+    for d, node in sorted(nodes.items(), reverse=True):
+        counts[d] = len(node["files"]) + sum(counts[f"{d}/{name}"] for name in node["dirs"])
+    conn.executemany("INSERT INTO dir_hashes (path, hash, files) VALUES (?, ?, ?)",
+                     [(d, node["hash"], counts[d]) for d, node in nodes.items()])
+
+# schema changes are appended here; PRAGMA user_version records how many ran
+_MIGRATIONS = [
+    "CREATE TABLE objects (path TEXT PRIMARY KEY, physical TEXT NOT NULL) WITHOUT ROWID",
+    "ALTER TABLE objects ADD COLUMN size INTEGER",
+    "ALTER TABLE objects ADD COLUMN stored_size INTEGER",
+    "ALTER TABLE objects ADD COLUMN created TEXT",
+    "ALTER TABLE objects ADD COLUMN updated TEXT",
+    "ALTER TABLE objects ADD COLUMN indexed_at REAL",
+    "CREATE TABLE scanned (prefix TEXT PRIMARY KEY) WITHOUT ROWID",
+    "ALTER TABLE scanned ADD COLUMN generation TEXT",
+    "CREATE TABLE state (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID",
+    "CREATE TABLE search_users (id INTEGER PRIMARY KEY, top TEXT NOT NULL UNIQUE)",
+    # top/rel/name/ext are derived from path so triggers only ever copy the path
+    "CREATE TABLE search_docs (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, "
+    "top TEXT AS (substr(path, 1, instr(path, '/') - 1)), "
+    "rel TEXT AS (substr(path, instr(path, '/') + 1)), "
+    "name TEXT AS (substr(path, length(rtrim(path, replace(path, '/', ''))) + 1)), "
+    "ext TEXT AS (CASE WHEN instr(name, '.') > 1 "
+    "THEN lower(substr(name, length(rtrim(name, replace(name, '.', ''))) + 1)) ELSE '' END))",
+    "CREATE INDEX search_docs_name ON search_docs (top, name COLLATE NOCASE)",
+    "CREATE INDEX search_docs_ext ON search_docs (top, ext)",
+    "CREATE TRIGGER objects_search_ai AFTER INSERT ON objects BEGIN "
+    + _search_sql(_SEARCH_USER_INSERT, "new.path") + "; "
+    + _search_sql(_SEARCH_DOC_INSERT, "new.path") + "; END",
+    "CREATE TRIGGER objects_search_ad AFTER DELETE ON objects BEGIN "
+    "DELETE FROM search_docs WHERE path = old.path; END",
+    _backfill_search_docs,
+    _create_search_fts,
+    "CREATE TABLE dir_hashes (path TEXT PRIMARY KEY, hash INTEGER NOT NULL, files INTEGER NOT NULL) WITHOUT ROWID",
+    "CREATE TRIGGER objects_merkle_ai AFTER INSERT ON objects BEGIN " + _merkle_sql("+", "new") + "END",
+    "CREATE TRIGGER objects_merkle_ad AFTER DELETE ON objects BEGIN " + _merkle_sql("-", "old") + "END",
+    "CREATE TRIGGER objects_merkle_au AFTER UPDATE OF path, size, updated ON objects "
+    "WHEN old.path IS NOT new.path OR old.size IS NOT new.size OR old.updated IS NOT new.updated BEGIN "
+    + _merkle_sql("-", "old") + _merkle_sql("+", "new") + "END",
+    _backfill_dir_hashes,
+]
+
+_local = threading.local()
+
+def _has_fts(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'search_fts'").fetchone() is not None
+
+def _migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(_MIGRATIONS):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # re-read under the write lock in case another process migrated first
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for stmt in _MIGRATIONS[version:]:
+            stmt(conn) if callable(stmt) else conn.execute(stmt)
+        conn.execute(f"PRAGMA user_version = {len(_MIGRATIONS)}")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def _db(root):
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(root)
+    if conn is None:
+        os.makedirs(root, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(root, "index.db"), timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.row_factory = sqlite3.Row
+        # used by the dir_hashes triggers, so registered on every connection
+        conn.create_function("merkle_leaf", 3, merkle.leaf, deterministic=True)
+        conn.create_function("merkle_ancestors", 1, merkle.ancestors_json, deterministic=True)
+        _migrate(conn)
+        conns[root] = conn
+    return conn
+
+def _prefix_range(prefix):
+    # a prefix names a directory: "u1" covers "u1/..." but not "u10/..."
+    prefix = prefix.rstrip("/") + "/"
+    return prefix, prefix[:-1] + "0"  # "0" sorts right after "/"
+
+def lookup(root, path):
+    row = _db(root).execute("SELECT physical FROM objects WHERE path = ?", (path,)).fetchone()
+    return row[0] if row else None
+
+def put(root, path, physical, size, stored_size, created, updated):
+    _db(root).execute(
+        "INSERT INTO objects (path, physical, size, stored_size, created, updated, indexed_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET physical = excluded.physical, "
+        "size = excluded.size, stored_size = excluded.stored_size, created = excluded.created, "
+        "updated = excluded.updated, indexed_at = excluded.indexed_at",
+        (path, physical, size, stored_size, created, updated, time.time()))
+
+def remove(root, path):
+    _db(root).execute("DELETE FROM objects WHERE path = ?", (path,))
+
+def remove_many(root, paths):
+    # one transaction for a bulk delete rather than a commit per row
+    conn = _db(root)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("DELETE FROM objects WHERE path = ?", [(p,) for p in paths])
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def iter_prefix(root, prefix, indexed_before=None):
+    # rows for every object under prefix ("" for all), in path order
+    sql = "SELECT * FROM objects"
+    args = []
+    if prefix.strip("/"):
+        sql += " WHERE path >= ? AND path < ?"
+        args += _prefix_range(prefix)
+    if indexed_before is not None:
+        sql += (" AND" if args else " WHERE") + " indexed_at < ?"
+        args.append(indexed_before)
+    yield from _db(root).execute(sql + " ORDER BY path", args)
+
+def list_page(root, prefix, delimiter=None, limit=1000, start=None):
+    """One page of an S3-style listing: raw string prefix, optional delimiter.
+
+    Keys below a delimiter are rolled up into a common prefix and skipped
+    with a single index seek, so a folder listing never reads the rows of
+    its subfolders. `start` is the (inclusive) key to resume from. Returns
+    (rows, common_prefixes, next_start) with next_start None on the last page.
+    """
+    conn = _db(root)
+    key = max(prefix, start or "")
+    end = listing.prefix_end(prefix) if prefix else None
+    rows, prefixes = [], []
+
+    def fetch(key, n):
+        if end is None:
+            return conn.execute("SELECT * FROM objects WHERE path >= ? ORDER BY path LIMIT ?", (key, n)).fetchall()
+        return conn.execute("SELECT * FROM objects WHERE path >= ? AND path < ? ORDER BY path LIMIT ?",
+                            (key, end, n)).fetchall()
+
+    while key is not None:
+        batch = fetch(key, limit - len(rows) - len(prefixes) + 1)
+        if not batch:
+            return rows, prefixes, None
+        for row in batch:
+            if len(rows) + len(prefixes) == limit:
+                return rows, prefixes, key
+            idx = row["path"].find(delimiter, len(prefix)) if delimiter else -1
+            if idx == -1:
+                rows.append(row)
+                key = row["path"] + "\x00"
+                continue
+            common = row["path"][:idx + len(delimiter)]
+            prefixes.append(common)
+            key = listing.prefix_end(common)
+            break  # re-seek past the whole subtree
+    return rows, prefixes, None
+
+def dir_node(root, path):
+    """The live merkle node (see utils/merkle.py) of directory path, or None.
+
+    Reads the directory's own files and its subdirectories' hashes with
+    delimited listings, never the rows below them.
+    """
+    conn = _db(root)
+    row = conn.execute("SELECT hash FROM dir_hashes WHERE path = ?", (path,)).fetchone()
+    if row is None:
+        return None
+    node = {"path": path, "hash": row["hash"], "files": {}, "dirs": {}}
+    start = None
+    while True:
+        rows, folders, start = list_page(root, path + "/", "/", listing.MAX_PAGE_SIZE, start)
+        for r in rows:
+            node["files"][r["path"][len(path) + 1:]] = merkle.leaf(r["path"], r["size"], r["updated"])
+        for folder in folders:
+            sub = folder.rstrip("/")
+            h = conn.execute("SELECT hash FROM dir_hashes WHERE path = ?", (sub,)).fetchone()
+            node["dirs"][sub[len(path) + 1:]] = h["hash"] if h else 0
+        if start is None:
+            return node
+
+def _like_escape(s):
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _fts_phrase(s):
+    return '"' + s.replace('"', '""') + '"'
+
+def _search_tier(conn, tier, top, ids, q, ext, after, n):
+    # one tier's rows, in the order its index yields them; ids is the
+    # user's [lo, hi) doc id range
+    like = _like_escape(q)
+    fts = len(q) >= 3 and _has_fts(conn)
+    where, args = [], []
+    if ext:
+        where.append("d.top = ? AND d.ext = ?")
+        args += [top, ext]
+    if tier < 2:
+        # exact name (or name minus extension), then other name prefixes:
+        # ranges on (top, name) in name order
+        exact = "(d.name = ? COLLATE NOCASE OR (d.name >= ? COLLATE NOCASE AND d.name < ? COLLATE NOCASE))"
+        exact_args = [q, q + ".", q + ".\U0010ffff"]
+        source, order = "search_docs d", "d.name COLLATE NOCASE, d.id"
+        if tier == 0:
+            where.append("d.top = ? AND " + exact)
+            args += [top] + exact_args
+        else:
+            where.append(f"d.top = ? AND d.name >= ? COLLATE NOCASE AND d.name < ? COLLATE NOCASE AND NOT {exact}")
+            args += [top, q, q + "\U0010ffff"] + exact_args
+        if after:
+            where.append("(d.name > ? COLLATE NOCASE OR (d.name = ? COLLATE NOCASE AND d.id > ?))")
+            args += [after[0], after[0], after[1]]
+    else:
+        # newest first, straight off the trigram doclist when there is one
+        col = "f.rowid" if fts else "d.id"
+        source = "search_fts f JOIN search_docs d ON d.id = f.rowid" if fts else "search_docs d"
+        order = col + " DESC"
+        where.append(f"{col} >= ? AND {col} < ?")
+        args += [ids[0], after[0] if after else ids[1]]
+        if fts:
+            phrase = _fts_phrase(q)
+            where.insert(0, "search_fts MATCH ?")
+            args.insert(0, "name : " + phrase if tier == 2 else f"rel : {phrase} NOT name : {phrase}")
+        if tier == 2 and q:
+            where.append("d.name NOT LIKE ? ESCAPE '\\'")
+            args.append(like + "%")
+            if not fts:
+                where.append("d.name LIKE ? ESCAPE '\\'")
+                args.append("%" + like + "%")
+        elif tier == 3 and not fts:
+            where.append("d.name NOT LIKE ? ESCAPE '\\' AND d.rel LIKE ? ESCAPE '\\'")
+            args += ["%" + like + "%", "%" + like + "%"]
+    sql = (f"SELECT o.*, d.id AS doc_id, d.name AS name, {tier} AS rank FROM {source} "
+           f"JOIN objects o ON o.path = d.path WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ?")
+    return conn.execute(sql, args + [n]).fetchall()
+
+def search(root, top, query="", ext=None, match="substring", limit=50, after=None):
+    """Ranked file search within one user (top-level prefix).
+
+    Results come in tiers, reported as each row's rank: 0 the name is
+    query (with or without an extension), 1 the name starts with it, 2 the
+    name contains it, 3 only a folder name does; the first two in name
+    order, the others newest first. match="prefix" keeps tiers 0-1 and an
+    empty query lists everything with extension ext (as rank 2). Every
+    tier is read in index order and stops once the page is full, so the
+    cost of a page doesn't grow with the number of matches. `after` is the
+    position returned with the previous page; returns (rows, next_after)
+    with next_after None on the last page.
+    """
+    if after is not None and not (isinstance(after, list) and after and after[0] in (0, 1, 2, 3)
+                                  and len(after) == (3 if after[0] < 2 else 2)):
+        raise ValueError("invalid cursor")
+    conn = _db(root)
+    user = conn.execute("SELECT id FROM search_users WHERE top = ?", (top,)).fetchone()
+    if user is None:
+        return [], None
+    ids = (user["id"] << 32, (user["id"] + 1) << 32)
+    q = query.lower()
+    ext = (ext or "").lower().lstrip(".")
+    tiers = [2] if not q else [0, 1] if match == "prefix" else [0, 1, 2, 3]
+    if after:
+        tiers = [t for t in tiers if t >= after[0]]
+    rows = []
+    for tier in tiers:
+        key = after[1:] if after and after[0] == tier else None
+        for row in _search_tier(conn, tier, top, ids, q, ext, key, limit + 1 - len(rows)):
+            rows.append((tier, row))
+        if len(rows) > limit:
+            break
+    if len(rows) <= limit:
+        return [row for _, row in rows], None
+    tier, last = rows[limit - 1]
+    next_after = [tier, last["name"], last["doc_id"]] if tier < 2 else [tier, last["doc_id"]]
+    return [row for _, row in rows[:limit]], next_after
+
+def is_scanned(root, top):
+    return _db(root).execute("SELECT 1 FROM scanned WHERE prefix = ?", (top,)).fetchone() is not None
+
+def mark_scanned(root, top, generation=None):
+    # generation: the backend's change marker the scan corresponds to, if any
+    _db(root).execute("INSERT INTO scanned (prefix, generation) VALUES (?, ?) "
+                      "ON CONFLICT(prefix) DO UPDATE SET generation = excluded.generation", (top, generation))
+
+def scanned_generation(root, top):
+    # None if top was never scanned, else the generation recorded with it ("" if none)
+    row = _db(root).execute("SELECT generation FROM scanned WHERE prefix = ?", (top,)).fetchone()
+    return None if row is None else row["generation"] or ""
+
+def get_state(root, key, default=None):
+    row = _db(root).execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return default if row is None else row["value"]
+
+def set_state(root, key, value):
+    _db(root).execute("INSERT INTO state (key, value) VALUES (?, ?) "
+                      "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+
+def top_level(prefix):
+    # the unit of lazy scanning: the first path segment (the user id)
+    return prefix.strip("/").split("/", 1)[0]
@@ -0,0 +1,41 @@
+# utils/rate_limit.py — token bucket for pacing bytes shared between threads
+import time
+import threading
+
+class TokenBucket:
+    """Allows `rate` units per second on average with bursts up to `burst`.
+
+    consume() takes the units and sleeps off any debt, so callers that
+    report work after doing it (bytes already copied) are paced instead
+    of refused. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate, burst=None):
+        # tokens earned so far are kept at the old rate, capped to the new burst
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self.rate = rate
+            self.burst = burst or rate
+            self._tokens = min(self._tokens, self.burst)
+
+    def consume(self, n):
+        if not self.rate or n <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
@@ -1,75 +1,896 @@
 # utils/s3_storage.py — S3 adapter implementing same contract as storage.py
-import os, json
+import os, io, sys, json, time, uuid, functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import boto3
-from datetime import datetime
-from .logger import log_info
+from datetime import datetime, timezone
+from .logger import log_info, log_warn
+from . import backups, compression, list_cache, listing, merkle, metadata_index, upload_sessions, signed_urls
+from .streams import IterStream
 
 S3_BUCKET = os.getenv("S3_BUCKET")
 AWS_REGION = os.getenv("AWS_REGION")
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(8 * 1024 * 1024)))
 
-s3 = boto3.client("s3", region_name=AWS_REGION) if S3_BUCKET else None
+# multipart uploads: payloads at or above the threshold are split into parts
+# and uploaded concurrently; at most S3_MAX_CONCURRENCY parts are in memory
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(16 * 1024 * 1024)))
+S3_PART_SIZE = int(os.getenv("S3_PART_SIZE", str(8 * 1024 * 1024)))
+S3_MAX_CONCURRENCY = int(os.getenv("S3_MAX_CONCURRENCY", "8"))
+S3_PART_RETRIES = int(os.getenv("S3_PART_RETRIES", "3"))
+_MIN_PART_SIZE = 5 * 1024 * 1024
+_MAX_PARTS = 10000
+
+# ranged reads: spans at or above the threshold are fetched as S3_RANGE_SIZE
+# slices in parallel and reassembled in order
+S3_RANGE_SIZE = int(os.getenv("S3_RANGE_SIZE", str(8 * 1024 * 1024)))
+S3_PARALLEL_READ_THRESHOLD = int(os.getenv("S3_PARALLEL_READ_THRESHOLD", str(16 * 1024 * 1024)))
+
+# server-side copies: objects above 5 GiB must be copied in parts
+S3_COPY_PART_SIZE = int(os.getenv("S3_COPY_PART_SIZE", str(512 * 1024 * 1024)))
+_MAX_COPY_SIZE = 5 * 1024 ** 3
+
+# bulk deletes: keys per DeleteObjects request (at most 1000)
+S3_DELETE_BATCH = int(os.getenv("S3_DELETE_BATCH", "1000"))
+
+# compressed objects carry their encoding and logical size as user metadata.
+# Bucket listings only report stored sizes, so the first compressed write
+# under a top also drops a marker under .meta/compressed/; listings HEAD
+# objects for their logical size only in tops that have one, and only when
+# no cached or indexed entry already knows it
+_META_ENCODING = "cv-encoding"
+_META_LOGICAL_SIZE = "cv-logical-size"
+_COMPRESSED_PREFIX = ".meta/compressed/"
+
+# listing cache: each user's listing is kept in memory (or, with
+# S3_METADATA_INDEX, in a local SQLite index) and written through on every
+# save/delete. Every write, from any node, rewrites the user's generation
+# object under .meta/generations/, so revalidating a cached listing is one
+# HEAD instead of a relist. Listings are reloaded outright after
+# S3_LIST_CACHE_MAX_AGE as a backstop for changes that slip past that.
+S3_LIST_CACHE = os.getenv("S3_LIST_CACHE", "1") == "1"
+S3_LIST_CACHE_TTL = float(os.getenv("S3_LIST_CACHE_TTL", "30"))
+S3_LIST_CACHE_MAX_AGE = float(os.getenv("S3_LIST_CACHE_MAX_AGE", "600"))
+S3_LIST_CACHE_MAX_ENTRIES = int(os.getenv("S3_LIST_CACHE_MAX_ENTRIES", "200000"))
+S3_METADATA_INDEX = os.getenv("S3_METADATA_INDEX", "0") == "1"
+METADATA_INDEX_DIR = os.getenv("METADATA_INDEX_DIR", os.path.join(os.getenv("DATA_DIR", "./data"), ".index"))
+_GENERATION_PREFIX = ".meta/generations/"
+
+# point at MinIO/LocalStack etc. for local testing
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+
+s3 = boto3.client("s3", region_name=AWS_REGION, endpoint_url=S3_ENDPOINT_URL) if S3_BUCKET else None
+_list_cache = list_cache.ListCache(S3_LIST_CACHE_MAX_ENTRIES)
+_compressed_tops = {}  # top -> (has marker, checked at)
 
 def _ensure_bucket():
     if not S3_BUCKET:
         raise RuntimeError("S3_BUCKET not configured")
 
-def save_file(path, content_bytes):
-    _ensure_bucket()
-    s3.put_object(Bucket=S3_BUCKET, Key=path, Body=content_bytes)
-    url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{path}" if AWS_REGION else f"https://{S3_BUCKET}.s3.amazonaws.com/{path}"
-    meta = {
+def _object_url(key):
+    return f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{key}" if AWS_REGION else f"https://{S3_BUCKET}.s3.amazonaws.com/{key}"
+
+def _read_full(stream, n):
+    # file-like reads may come back short; keep reading until n bytes or EOF
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = stream.read(n - len(buf))
+        if not chunk:
+            break
+        buf += chunk
+    return bytes(buf)
+
+def _upload_part(key, upload_id, part_number, data):
+    for attempt in range(S3_PART_RETRIES + 1):
+        try:
+            res = s3.upload_part(Bucket=S3_BUCKET, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data)
+            return {"PartNumber": part_number, "ETag": res["ETag"]}, len(data)
+        except Exception as e:
+            if attempt == S3_PART_RETRIES:
+                raise
+            log_warn("s3 part upload failed, retrying", key=key, part=part_number, attempt=attempt + 1, error=str(e))
+            time.sleep(min(0.5 * 2 ** attempt, 8))
+
+def _multipart_upload(key, parts, progress=None, metadata=None):
+    """Upload an iterable of part payloads concurrently; returns total bytes.
+
+    Parts are pulled from the iterable only when a worker slot is free, so a
+    streaming source is never read more than S3_MAX_CONCURRENCY parts ahead.
+    Any failure aborts the upload so no orphaned parts are left billed.
+    """
+    upload_id = s3.create_multipart_upload(Bucket=S3_BUCKET, Key=key, Metadata=metadata or {})["UploadId"]
+    completed = []
+    total = 0
+
+    def collect(done):
+        nonlocal total
+        for fut in done:
+            part, size = fut.result()
+            completed.append(part)
+            total += size
+            log_info("s3 part uploaded", key=key, part=part["PartNumber"], size=size, bytes_done=total)
+            if progress:
+                progress(total)
+
+    pool = ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY)
+    try:
+        pending = set()
+        for part_number, data in enumerate(parts, start=1):
+            if part_number > _MAX_PARTS:
+                raise ValueError(f"upload exceeds {_MAX_PARTS} parts; raise S3_PART_SIZE")
+            if len(pending) >= S3_MAX_CONCURRENCY:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(pool.submit(_upload_part, key, upload_id, part_number, data))
+        collect(pending)
+        completed.sort(key=lambda p: p["PartNumber"])
+        s3.complete_multipart_upload(Bucket=S3_BUCKET, Key=key, UploadId=upload_id,
+                                     MultipartUpload={"Parts": completed})
+    except BaseException:
+        pool.shutdown(wait=True, cancel_futures=True)
+        s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=key, UploadId=upload_id)
+        log_warn("s3 multipart upload aborted", key=key, upload_id=upload_id)
+        raise
+    pool.shutdown(wait=True)
+    return total
+
+def _copy_object(src, dst, metadata=None):
+    # server-side copy; metadata=None keeps the source's, otherwise replaces it
+    head = s3.head_object(Bucket=S3_BUCKET, Key=src)
+    size = head["ContentLength"]
+    source = {"Bucket": S3_BUCKET, "Key": src}
+    if size <= _MAX_COPY_SIZE:
+        extra = {"MetadataDirective": "REPLACE", "Metadata": metadata} if metadata is not None else {}
+        s3.copy_object(Bucket=S3_BUCKET, Key=dst, CopySource=source, **extra)
+        return size
+    part_size = max(S3_COPY_PART_SIZE, -(-size // _MAX_PARTS))
+    upload_id = s3.create_multipart_upload(Bucket=S3_BUCKET, Key=dst,
+                                           Metadata=head.get("Metadata", {}) if metadata is None else metadata)["UploadId"]
+
+    def copy_part(numbered):
+        part_number, (start, end) = numbered
+        res = s3.upload_part_copy(Bucket=S3_BUCKET, Key=dst, UploadId=upload_id, PartNumber=part_number,
+                                  CopySource=source, CopySourceRange=f"bytes={start}-{end}")
+        return {"PartNumber": part_number, "ETag": res["CopyPartResult"]["ETag"]}
+
+    try:
+        with ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY) as pool:
+            parts = list(pool.map(copy_part, enumerate(_split_range(0, size - 1, part_size), start=1)))
+        s3.complete_multipart_upload(Bucket=S3_BUCKET, Key=dst, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except BaseException:
+        s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=dst, UploadId=upload_id)
+        raise
+    return size
+
+def _is_missing(e):
+    return e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+def _head_generation(top):
+    try:
+        return s3.head_object(Bucket=S3_BUCKET, Key=_GENERATION_PREFIX + top)["ETag"].strip('"')
+    except s3.exceptions.ClientError as e:
+        if _is_missing(e):
+            return ""
+        raise
+
+def _known_generation(top):
+    slot = _list_cache.get(top)
+    if slot is not None:
+        return slot.generation
+    if S3_METADATA_INDEX:
+        return metadata_index.scanned_generation(METADATA_INDEX_DIR, top)
+    return None
+
+def _note_compressed(path):
+    # before the compressed object itself is written, so no listing can see
+    # the object without the marker
+    top = metadata_index.top_level(path)
+    if _compressed_tops.get(top, (False,))[0]:
+        return
+    s3.put_object(Bucket=S3_BUCKET, Key=_COMPRESSED_PREFIX + top, Body=b"")
+    _compressed_tops[top] = (True, time.time())
+
+def _has_compressed(top):
+    # a marker, once seen, stays; its absence is rechecked every S3_LIST_CACHE_TTL
+    found, checked_at = _compressed_tops.get(top, (False, 0))
+    if found or time.time() - checked_at < S3_LIST_CACHE_TTL:
+        return found
+    try:
+        s3.head_object(Bucket=S3_BUCKET, Key=_COMPRESSED_PREFIX + top)
+        found = True
+    except s3.exceptions.ClientError as e:
+        if not _is_missing(e):
+            raise
+    _compressed_tops[top] = (found, time.time())
+    return found
+
+def _written_entry(path, size, stored_size):
+    now = datetime.now(timezone.utc).isoformat()
+    return {
+        "name": os.path.basename(path),
+        "path": path,
+        "full_path": f"s3://{S3_BUCKET}/{path}",
+        "size": size,
+        "stored_size": stored_size,
+        "created": now,
+        "updated": now
+    }
+
+def _tracked(top):
+    # user tops are cached/indexed and carry a generation. backups/ (blobs,
+    # manifests, checkpoints: read by key, paged straight from the bucket)
+    # and the dot-prefixed internals aren't, so writing them costs nothing extra
+    return bool(top) and not top.startswith(".") and top != "backups"
+
+def _record_change(path, entry):
+    # write-through after a save (entry) or delete (entry=None)
+    _record_changes([(path, entry)])
+
+def _record_changes(changes):
+    # [(path, entry or None)]: one generation bump per user, however many paths
+    changes = [(path, entry) for path, entry in changes if _tracked(metadata_index.top_level(path))]
+    if not changes:
+        return
+    if S3_METADATA_INDEX:
+        for path, entry in changes:
+            if entry:
+                metadata_index.put(METADATA_INDEX_DIR, path, path, entry["size"], entry["stored_size"],
+                                   entry["created"], entry["updated"])
+        removed = [path for path, entry in changes if not entry]
+        if removed:
+            metadata_index.remove_many(METADATA_INDEX_DIR, removed)
+    if not (S3_LIST_CACHE or S3_METADATA_INDEX):
+        return
+    by_top = {}
+    for path, entry in changes:
+        by_top.setdefault(metadata_index.top_level(path), []).append((path, entry))
+    for top, top_changes in by_top.items():
+        known = _known_generation(top)
+        current = _head_generation(top)
+        res = s3.put_object(Bucket=S3_BUCKET, Key=_GENERATION_PREFIX + top, Body=uuid.uuid4().hex.encode("ascii"))
+        generation = res["ETag"].strip('"')
+        if known is None or current != known:
+            # someone else changed this user since we last looked, so our copy
+            # is missing their write: let the next listing reload. (A write that
+            # lands between the HEAD and PUT above is caught by the max age.)
+            _list_cache.invalidate(top)
+            continue
+        for path, entry in top_changes:
+            if entry:
+                _list_cache.upsert(top, entry, generation)
+            else:
+                _list_cache.remove(top, path, generation)
+        if S3_METADATA_INDEX:
+            metadata_index.mark_scanned(METADATA_INDEX_DIR, top, generation)
+
+def _saved_meta(path, size):
+    return {
         "filename": os.path.basename(path),
         "path": path,
         "full_path": f"s3://{S3_BUCKET}/{path}",
-        "size": len(content_bytes),
-        "url": url,
+        "size": size,
+        "url": _object_url(path),
         "uploaded_at": datetime.utcnow().isoformat()
     }
+
+def save_file(path, content_bytes):
+    _ensure_bucket()
+    if compression.should_compress(content_bytes[:64 * 1024]):
+        return save_stream(path, io.BytesIO(content_bytes))
+    if len(content_bytes) >= S3_MULTIPART_THRESHOLD:
+        part_size = max(S3_PART_SIZE, _MIN_PART_SIZE, -(-len(content_bytes) // _MAX_PARTS))
+        view = memoryview(content_bytes)
+        parts = (bytes(view[i:i + part_size]) for i in range(0, len(content_bytes), part_size))
+        _multipart_upload(path, parts)
+    else:
+        s3.put_object(Bucket=S3_BUCKET, Key=path, Body=content_bytes)
+    meta = _saved_meta(path, len(content_bytes))
+    _record_change(path, _written_entry(path, len(content_bytes), len(content_bytes)))
     log_info("s3 saved file", meta=meta)
     return meta
 
+def save_stream(path, stream, chunk_size=None, progress=None):
+    # small bodies go up in one put_object; anything reaching the multipart
+    # threshold is read part by part and uploaded concurrently
+    _ensure_bucket()
+    part_size = max(chunk_size or S3_PART_SIZE, _MIN_PART_SIZE)
+    part = _read_full(stream, part_size)
+    metadata = {}
+    logical = None
+    if compression.should_compress(part):
+        logical = {"size": 0}
+        source, first = stream, part
+
+        def raw_chunks():
+            chunk = first
+            while chunk:
+                logical["size"] += len(chunk)
+                yield chunk
+                chunk = source.read(part_size)
+
+        stream = IterStream(compression.compress_chunks(raw_chunks()))
+        part = _read_full(stream, part_size)
+        metadata[_META_ENCODING] = "zstd"
+        _note_compressed(path)
+
+    head = []
+    buffered = 0
+    while part:
+        head.append(part)
+        buffered += len(part)
+        if buffered >= S3_MULTIPART_THRESHOLD or len(part) < part_size:
+            break
+        part = _read_full(stream, part_size)
+
+    if buffered < S3_MULTIPART_THRESHOLD:
+        if logical:
+            metadata[_META_LOGICAL_SIZE] = str(logical["size"])
+        s3.put_object(Bucket=S3_BUCKET, Key=path, Body=b"".join(head), Metadata=metadata)
+        size = buffered
+        if progress:
+            progress(size)
+    else:
+        def parts():
+            yield from head
+            head.clear()
+            while True:
+                part = _read_full(stream, part_size)
+                if not part:
+                    return
+                yield part
+        size = _multipart_upload(path, parts(), progress=progress, metadata=metadata)
+        if logical:
+            # the logical size is only known once the stream is drained, and
+            # metadata can't change after the upload; rewrite it in place
+            metadata[_META_LOGICAL_SIZE] = str(logical["size"])
+            try:
+                _copy_object(path, path, metadata)
+            except BaseException:
+                s3.delete_object(Bucket=S3_BUCKET, Key=path)
+                raise
+
+    meta = _saved_meta(path, logical["size"] if logical else size)
+    if logical:
+        meta["stored_size"] = size
+    _record_change(path, _written_entry(path, meta["size"], size))
+    log_info("s3 saved stream", meta=meta)
+    return meta
+
+def _index_entry(row):
+    return {
+        "name": os.path.basename(row["path"]),
+        "path": row["path"],
+        "full_path": f"s3://{S3_BUCKET}/{row['path']}",
+        "size": row["size"],
+        "stored_size": row["stored_size"],
+        "created": row["created"],
+        "updated": row["updated"]
+    }
+
+def _ensure_indexed(prefix):
+    # reindex the user when the index may have missed a change; otherwise at
+    # most one HEAD of the generation object per S3_LIST_CACHE_TTL
+    top = metadata_index.top_level(prefix)
+    if not top:
+        return
+    now = time.time()
+    volatile = _list_cache.volatile(top)
+    slot = _list_cache.get(top)
+    if not volatile and slot is not None and now - slot.loaded_at < S3_LIST_CACHE_MAX_AGE \
+            and now - slot.validated_at < S3_LIST_CACHE_TTL:
+        return
+    generation = _head_generation(top)
+    if volatile or metadata_index.scanned_generation(METADATA_INDEX_DIR, top) != generation \
+            or (slot is not None and now - slot.loaded_at >= S3_LIST_CACHE_MAX_AGE):
+        _rebuild_index(top, generation)
+        _list_cache.store(top, None, generation)
+    elif slot is None:
+        _list_cache.store(top, None, generation)
+    else:
+        _list_cache.touch(top, generation)
+
+def _cached_entries(top):
+    # path -> entry for everything under top, from memory when still current
+    now = time.time()
+    volatile = _list_cache.volatile(top)
+    slot = _list_cache.get(top)
+    generation = None
+    if not volatile and slot is not None and now - slot.loaded_at < S3_LIST_CACHE_MAX_AGE:
+        if now - slot.validated_at < S3_LIST_CACHE_TTL:
+            return slot.entries
+        generation = _head_generation(top)
+        if generation == slot.generation:
+            _list_cache.touch(top, generation)
+            return slot.entries
+    if generation is None:
+        # read before listing, so a write racing the listing shows up as a
+        # generation change on the next revalidation
+        generation = _head_generation(top)
+    entries = {e["path"]: e for e in _list_bucket(top + "/", slot.entries if slot is not None else None)}
+    return _list_cache.store(top, entries, generation).entries
+
 def list_files(prefix):
     _ensure_bucket()
+    top = metadata_index.top_level(prefix)
+    if not _tracked(top):
+        return _list_bucket(prefix)
+    if S3_METADATA_INDEX:
+        _ensure_indexed(prefix)
+        return [_index_entry(row) for row in metadata_index.iter_prefix(METADATA_INDEX_DIR, prefix)]
+    if S3_LIST_CACHE:
+        entries = _cached_entries(top)
+        under = prefix.strip("/") + "/"
+        return [dict(entries[p]) for p in sorted(entries) if p.startswith(under)]
+    return _list_bucket(prefix)
+
+def dir_tree(top):
+    # the live directory hash tree under top, as path -> node (see utils/merkle.py);
+    # without the metadata index it is built from one listing
+    _ensure_bucket()
+    if S3_METADATA_INDEX:
+        _ensure_indexed(top)
+        return functools.partial(metadata_index.dir_node, METADATA_INDEX_DIR)
+    return merkle.build(list_files(top)).get
+
+def iter_listing(prefix, page_size=listing.MAX_PAGE_SIZE):
+    # same entries as list_files, produced one bucket page at a time
+    _ensure_bucket()
+    cursor = None
+    while True:
+        page = list_page(prefix, limit=page_size, cursor=cursor)
+        yield from page["files"]
+        cursor = page["next_cursor"]
+        if not cursor:
+            return
+
+def list_page(prefix, delimiter=None, limit=None, cursor=None):
+    # one list_objects_v2 call per page; S3 rolls deeper keys up into
+    # CommonPrefixes itself, so other folders are never enumerated
+    _ensure_bucket()
+    limit = listing.clamp_limit(limit)
+    state = listing.decode_cursor(cursor) if cursor else {}
+    if S3_METADATA_INDEX and _tracked(metadata_index.top_level(prefix)):
+        _ensure_indexed(prefix)
+        rows, folders, next_start = metadata_index.list_page(METADATA_INDEX_DIR, prefix, delimiter, limit,
+                                                             listing.cursor_field(state, "s", str))
+        return {
+            "files": [_index_entry(row) for row in rows],
+            "folders": folders,
+            "next_cursor": listing.encode_cursor({"s": next_start}) if next_start is not None else None
+        }
+    kwargs = {"Bucket": S3_BUCKET, "Prefix": prefix, "MaxKeys": limit}
+    if delimiter:
+        kwargs["Delimiter"] = delimiter
+    token = listing.cursor_field(state, "t", str)
+    if token:
+        kwargs["ContinuationToken"] = token
+    res = s3.list_objects_v2(**kwargs)
+    files = [_bucket_entry(obj) for obj in res.get("Contents", [])]
+    slot = _list_cache.get(metadata_index.top_level(prefix))
+    _resolve_logical_sizes(files, slot.entries if slot is not None else None)
+    token = res.get("NextContinuationToken") if res.get("IsTruncated") else None
+    return {
+        "files": files,
+        "folders": [p["Prefix"] for p in res.get("CommonPrefixes", [])],
+        "next_cursor": listing.encode_cursor({"t": token}) if token else None
+    }
+
+def search_files(prefix, query="", ext=None, match="substring", limit=None, cursor=None):
+    # ranked name/path search within one user: from the metadata index when
+    # enabled, otherwise over the cached listing with an offset cursor
+    _ensure_bucket()
+    limit = listing.clamp_limit(limit)
+    state = listing.decode_cursor(cursor) if cursor else {}
+    top = metadata_index.top_level(prefix)
+    if S3_METADATA_INDEX:
+        _ensure_indexed(top)
+        rows, after = metadata_index.search(METADATA_INDEX_DIR, top, query, ext, match, limit, state.get("a"))
+        return {
+            "files": [dict(_index_entry(row), rank=row["rank"]) for row in rows],
+            "next_cursor": listing.encode_cursor({"a": after}) if after else None
+        }
+    entries = _cached_entries(top).values() if S3_LIST_CACHE else _list_bucket(top + "/")
+    hits = listing.rank_matches(entries, query, ext, match)
+    offset = state.get("o", 0)
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError("invalid cursor")
+    page = hits[offset:offset + limit]
+    return {
+        "files": [dict(entry, rank=rank) for rank, entry in page],
+        "next_cursor": listing.encode_cursor({"o": offset + limit}) if offset + limit < len(hits) else None
+    }
+
+def reindex(prefix=""):
+    # relist the bucket under prefix ("" for everything) into the index and
+    # drop rows for keys that no longer exist
+    _ensure_bucket()
+    top = metadata_index.top_level(prefix)
+    return _rebuild_index(prefix, _head_generation(top) if top else None)
+
+def _rebuild_index(prefix, generation):
+    started = time.time()
+    seen = set()
+    known = {row["path"]: row for row in metadata_index.iter_prefix(METADATA_INDEX_DIR, prefix)}
+    for entry in _list_bucket(prefix, known):
+        if not _tracked(metadata_index.top_level(entry["path"])):
+            continue  # backups/, .uploads/ session records, .meta/ generations
+        metadata_index.put(METADATA_INDEX_DIR, entry["path"], entry["path"], entry["size"],
+                           entry["stored_size"], entry["created"], entry["updated"])
+        seen.add(entry["path"])
+    removed = 0
+    for row in list(metadata_index.iter_prefix(METADATA_INDEX_DIR, prefix, indexed_before=started)):
+        if row["path"] not in seen:
+            metadata_index.remove(METADATA_INDEX_DIR, row["path"])
+            removed += 1
+    top = metadata_index.top_level(prefix)
+    for t in [top] if top else {metadata_index.top_level(p) for p in seen}:
+        metadata_index.mark_scanned(METADATA_INDEX_DIR, t, generation)
+    log_info("s3 metadata index rebuilt", prefix=prefix, indexed=len(seen), removed=removed)
+    return {"indexed": len(seen), "removed": removed, "recovered": 0, "pruned": 0, "orphans": 0}
+
+def _bucket_entry(obj):
+    return {
+        "name": os.path.basename(obj["Key"]),
+        "path": obj["Key"],
+        "full_path": f"s3://{S3_BUCKET}/{obj['Key']}",
+        "size": obj["Size"],
+        "stored_size": obj["Size"],
+        "created": obj["LastModified"].isoformat(),
+        "updated": obj["LastModified"].isoformat()
+    }
+
+def _list_bucket(prefix, known=None):
     paginator = s3.get_paginator("list_objects_v2")
     pages = paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix)
-    out = []
-    for p in pages:
-        for obj in p.get("Contents", []):
-            out.append({
-                "name": os.path.basename(obj["Key"]),
-                "path": obj["Key"],
-                "full_path": f"s3://{S3_BUCKET}/{obj['Key']}",
-                "size": obj["Size"],
-                "created": obj["LastModified"].isoformat(),
-                "updated": obj["LastModified"].isoformat()
-            })
+    out = [_bucket_entry(obj) for p in pages for obj in p.get("Contents", [])]
+    _resolve_logical_sizes(out, known)
     return out
 
+def _resolve_logical_sizes(entries, known=None):
+    # listings only carry the stored size. Take the logical size from a known
+    # entry (path -> cached entry or index row) for the same object: same
+    # stored size, and not modified after the entry was recorded. Anything
+    # else is HEADed, but only in tops that have ever held a compressed object
+    unknown = []
+    for entry in entries:
+        prev = known.get(entry["path"]) if known else None
+        if prev is not None and prev["stored_size"] == entry["stored_size"] \
+                and datetime.fromisoformat(entry["updated"]) <= datetime.fromisoformat(prev["updated"]):
+            entry["size"] = prev["size"]
+        elif _has_compressed(metadata_index.top_level(entry["path"])):
+            unknown.append(entry)
+    if not unknown:
+        return
+
+    def logical_size(entry):
+        info = stat_file(entry["path"])
+        return info["size"] if info else entry["size"]
+
+    with ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY) as pool:
+        for entry, size in zip(unknown, pool.map(logical_size, unknown)):
+            entry["size"] = size
+
 def read_file(path):
     _ensure_bucket()
+    info = stat_file(path)
+    if info is None:
+        return None
+    return b"".join(iter_file(path, 0, info["size"] - 1))
+
+def get_local_path(path):
+    # objects never live on local disk; callers stream through iter_file
+    return None
+
+def stat_file(path):
+    _ensure_bucket()
+    try:
+        res = s3.head_object(Bucket=S3_BUCKET, Key=path)
+    except s3.exceptions.ClientError as e:
+        if _is_missing(e):
+            return None
+        raise
+    metadata = res.get("Metadata") or {}
+    return {
+        "size": int(metadata.get(_META_LOGICAL_SIZE, res["ContentLength"])),
+        "stored_size": res["ContentLength"],
+        "encoding": metadata.get(_META_ENCODING),
+        "etag": res["ETag"].strip('"'),
+        "last_modified": res["LastModified"]
+    }
+
+def _split_range(start, end, size):
+    for offset in range(start, end + 1, size):
+        yield offset, min(offset + size - 1, end)
+
+def _get_range(key, start, end):
+    for attempt in range(S3_PART_RETRIES + 1):
+        try:
+            res = s3.get_object(Bucket=S3_BUCKET, Key=key, Range=f"bytes={start}-{end}")
+            return res["Body"].read()
+        except s3.exceptions.NoSuchKey:
+            raise
+        except Exception as e:
+            if attempt == S3_PART_RETRIES:
+                raise
+            log_warn("s3 ranged get failed, retrying", key=key, range=f"{start}-{end}", attempt=attempt + 1, error=str(e))
+            time.sleep(min(0.5 * 2 ** attempt, 8))
+
+def _iter_ranges_parallel(key, start, end):
+    # keep S3_MAX_CONCURRENCY range GETs in flight and yield results in
+    # order; memory is bounded by the window, not the object size
+    ranges = _split_range(start, end, S3_RANGE_SIZE)
+    pool = ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY)
+    try:
+        pending = deque()
+        for rng in ranges:
+            pending.append(pool.submit(_get_range, key, *rng))
+            if len(pending) >= S3_MAX_CONCURRENCY:
+                break
+        while pending:
+            data = pending.popleft().result()
+            nxt = next(ranges, None)
+            if nxt:
+                pending.append(pool.submit(_get_range, key, *nxt))
+            yield data
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _iter_decoded(path, start, end, chunk_size):
+    # compressed objects have no random access: stream the whole body
+    # through the decompressor and cut out [start, end]
+    body = s3.get_object(Bucket=S3_BUCKET, Key=path)["Body"]
+    try:
+        yield from compression.slice_chunks(compression.decompress_chunks(body.iter_chunks(chunk_size)), start, end)
+    finally:
+        body.close()
+
+def iter_file(path, start=0, end=None, chunk_size=None):
+    # yields bytes [start, end] (inclusive); large spans use parallel ranged
+    # GETs, small ones a single GET proxied in chunks
+    _ensure_bucket()
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    info = None
+    if end is None or end - start + 1 >= S3_PARALLEL_READ_THRESHOLD:
+        info = stat_file(path)
+        if info is None:
+            raise FileNotFoundError(path)
+        if end is None:
+            end = info["size"] - 1
+    if end < start:
+        return
+    if info is not None:
+        if info["encoding"]:
+            yield from _iter_decoded(path, start, end, chunk_size)
+            return
+        if end - start + 1 >= S3_PARALLEL_READ_THRESHOLD:
+            yield from _iter_ranges_parallel(path, start, end)
+            return
+    try:
+        res = s3.get_object(Bucket=S3_BUCKET, Key=path, Range=f"bytes={start}-{end}")
+    except s3.exceptions.ClientError as e:
+        # a logical range can lie past the end of a compressed body
+        if e.response.get("Error", {}).get("Code") != "InvalidRange":
+            raise
+        yield from _iter_decoded(path, start, end, chunk_size)
+        return
+    body = res["Body"]
+    if (res.get("Metadata") or {}).get(_META_ENCODING):
+        body.close()
+        yield from _iter_decoded(path, start, end, chunk_size)
+        return
+    try:
+        for chunk in body.iter_chunks(chunk_size):
+            yield chunk
+    finally:
+        body.close()
+
+def download_to_file(path, dest_path):
+    # parallel ranged GETs written straight to their offsets in dest_path
+    _ensure_bucket()
+    info = stat_file(path)
+    if info is None:
+        return None
+    size = info["size"]
+    tmp = f"{dest_path}.part"
+    if info["encoding"]:
+        with open(tmp, "wb") as f:
+            for chunk in _iter_decoded(path, 0, size - 1, STREAM_CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(tmp, dest_path)
+        return {"path": dest_path, "size": size}
+    with open(tmp, "wb") as f:
+        f.truncate(size)
+        fd = f.fileno()
+
+        def fetch(rng):
+            os.pwrite(fd, _get_range(path, *rng), rng[0])
+
+        with ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY) as pool:
+            for _ in pool.map(fetch, _split_range(0, size - 1, S3_RANGE_SIZE)):
+                pass
+    os.replace(tmp, dest_path)
+    log_info("s3 downloaded to file", key=path, dest=dest_path, size=size)
+    return {"path": dest_path, "size": size}
+
+def copy_file(src, dst):
+    # server-side copy (CopyObject, or UploadPartCopy past 5 GiB) keeping the
+    # stored encoding and metadata; raises FileNotFoundError when src is missing
+    _ensure_bucket()
+    info = stat_file(src)
+    if info is None:
+        raise FileNotFoundError(src)
+    if info["encoding"]:
+        _note_compressed(dst)
+    _copy_object(src, dst)
+    _record_change(dst, _written_entry(dst, info["size"], info["stored_size"]))
+    return {"path": dst, "size": info["size"]}
+
+def delete_file(path):
+    _ensure_bucket()
+    if stat_file(path) is None:
+        return False
+    s3.delete_object(Bucket=S3_BUCKET, Key=path)
+    _record_change(path, None)
+    log_info("s3 deleted file", key=path)
+    return True
+
+def delete_files(paths):
+    """Delete many keys with DeleteObjects, S3_DELETE_BATCH per request.
+
+    Missing keys aren't errors (as with delete_file they simply aren't
+    there afterwards); returns how many keys were deleted or already gone.
+    """
+    _ensure_bucket()
+    deleted = []
+    for i in range(0, len(paths), S3_DELETE_BATCH):
+        batch = paths[i:i + S3_DELETE_BATCH]
+        res = s3.delete_objects(Bucket=S3_BUCKET, Delete={"Objects": [{"Key": p} for p in batch], "Quiet": True})
+        failed = {e["Key"] for e in res.get("Errors", [])}
+        for e in res.get("Errors", []):
+            log_warn("s3 delete failed", key=e["Key"], code=e.get("Code"))
+        deleted += [p for p in batch if p not in failed]
+    if deleted:
+        _record_changes([(p, None) for p in deleted])
+    log_info("s3 deleted files", count=len(deleted))
+    return len(deleted)
+
+def presign_url(path, method="GET", expires_in=None, size=None, owner=None):
+    # S3 presigned URL; a signed ContentLength pins the size of a PUT. The
+    # upload never reaches us, so the caller charges owner once it sees it
+    _ensure_bucket()
+    expires_in = signed_urls.clamp_ttl(expires_in)
+    params = {"Bucket": S3_BUCKET, "Key": path}
+    if method == "PUT" and size is not None:
+        params["ContentLength"] = int(size)
+    url = s3.generate_presigned_url("put_object" if method == "PUT" else "get_object",
+                                    Params=params, ExpiresIn=expires_in)
+    if method == "PUT":
+        # the upload bypasses us, so nothing writes it through; other nodes
+        # see it by S3_LIST_CACHE_MAX_AGE at the latest
+        _list_cache.mark_volatile(metadata_index.top_level(path), time.time() + expires_in)
+    return {"url": url, "method": method, "expires_at": int(time.time()) + expires_in}
+
+def _session_key(session_id):
+    return f".uploads/{session_id}.json"
+
+def _commit_key(session_id):
+    return f".uploads/{session_id}.commit"
+
+def _load_upload_session(session_id):
+    if not upload_sessions.valid_id(session_id):
+        return None
     try:
-        res = s3.get_object(Bucket=S3_BUCKET, Key=path)
-        return res["Body"].read()
+        res = s3.get_object(Bucket=S3_BUCKET, Key=_session_key(session_id))
     except s3.exceptions.NoSuchKey:
         return None
+    session = json.loads(res["Body"].read())
+    return None if upload_sessions.is_expired(session) else session
 
-def create_backup_manifest(user_id, backup_name=None):
-    files = list_files(user_id)
-    if not backup_name:
-        backup_name = f"backup_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
-    manifest = {
-        "name": backup_name,
-        "user_id": user_id,
-        "created_at": datetime.utcnow().isoformat(),
-        "files": files,
-        "file_count": len(files)
-    }
-    manifest_key = f"backups/{user_id}/{backup_name}_manifest.json"
-    s3.put_object(Bucket=S3_BUCKET, Key=manifest_key, Body=json.dumps(manifest).encode("utf-8"))
-    url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{manifest_key}" if AWS_REGION else f"https://{S3_BUCKET}.s3.amazonaws.com/{manifest_key}"
-    return {"name": backup_name, "manifest_path": manifest_key, "url": url}
-
-def restore_from_manifest(backup_name):
-    # find manifest in backups/<user_id>/<backup_name>_manifest.json — require user_id? For demo, simple list
-    # In production you must include user_id to protect restore scope
-    return {"restored_count":0,"failed_count":0,"restored_files":[],"failed_files":[]}
+def _list_parts(session):
+    parts = []
+    kwargs = {"Bucket": S3_BUCKET, "Key": session["path"], "UploadId": session["upload_id"]}
+    while True:
+        res = s3.list_parts(**kwargs)
+        parts.extend(res.get("Parts", []))
+        if not res.get("IsTruncated"):
+            return parts
+        kwargs["PartNumberMarker"] = res["NextPartNumberMarker"]
+
+def create_upload_session(user_id, path, total_size, chunk_size=None):
+    # chunks map 1:1 onto parts of an S3 multipart upload
+    _ensure_bucket()
+    session = upload_sessions.new_session(user_id, path, total_size, chunk_size)
+    if upload_sessions.chunk_count(session) > 1 and session["chunk_size"] < _MIN_PART_SIZE:
+        raise ValueError(f"chunk_size must be at least {_MIN_PART_SIZE} bytes on S3")
+    session["upload_id"] = s3.create_multipart_upload(Bucket=S3_BUCKET, Key=path)["UploadId"]
+    s3.put_object(Bucket=S3_BUCKET, Key=_session_key(session["session_id"]), Body=json.dumps(session).encode("utf-8"))
+    log_info("s3 upload session created", session_id=session["session_id"], path=path, size=total_size)
+    return upload_sessions.status(session, [])
+
+def get_upload_session(session_id):
+    _ensure_bucket()
+    session = _load_upload_session(session_id)
+    if session is None:
+        return None
+    return upload_sessions.status(session, [p["PartNumber"] - 1 for p in _list_parts(session)])
+
+def put_upload_chunk(session_id, index, stream):
+    _ensure_bucket()
+    session = _load_upload_session(session_id)
+    if session is None:
+        return None
+    expected = upload_sessions.expected_chunk_size(session, index)
+    data = _read_full(stream, expected + 1)
+    if len(data) != expected:
+        raise ValueError(f"chunk {index} must be exactly {expected} bytes")
+    _upload_part(session["path"], session["upload_id"], index + 1, data)
+    return get_upload_session(session_id)
+
+def commit_upload_session(session_id):
+    _ensure_bucket()
+    session = _load_upload_session(session_id)
+    if session is None:
+        return None
+    parts = _list_parts(session)
+    missing = upload_sessions.status(session, [p["PartNumber"] - 1 for p in parts])["missing_chunks"]
+    if missing:
+        raise ValueError(f"{len(missing)} chunk(s) still missing")
+    # a conditional create claims the commit; a concurrent one gets None
+    try:
+        s3.put_object(Bucket=S3_BUCKET, Key=_commit_key(session_id), Body=b"", IfNoneMatch="*")
+    except s3.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("PreconditionFailed", "ConditionalRequestConflict"):
+            return None
+        raise
+    try:
+        s3.complete_multipart_upload(Bucket=S3_BUCKET, Key=session["path"], UploadId=session["upload_id"],
+                                     MultipartUpload={"Parts": [{"PartNumber": p["PartNumber"], "ETag": p["ETag"]}
+                                                                for p in parts]})
+    except BaseException:
+        s3.delete_object(Bucket=S3_BUCKET, Key=_commit_key(session_id))
+        raise
+    s3.delete_object(Bucket=S3_BUCKET, Key=_session_key(session_id))
+    s3.delete_object(Bucket=S3_BUCKET, Key=_commit_key(session_id))
+    meta = _saved_meta(session["path"], session["total_size"])
+    _record_change(session["path"], _written_entry(session["path"], session["total_size"], session["total_size"]))
+    log_info("s3 upload session committed", session_id=session_id, meta=meta)
+    return meta
+
+def abort_upload_session(session_id):
+    _ensure_bucket()
+    if not upload_sessions.valid_id(session_id):
+        return False
+    try:
+        res = s3.get_object(Bucket=S3_BUCKET, Key=_session_key(session_id))
+    except s3.exceptions.NoSuchKey:
+        return False
+    session = json.loads(res["Body"].read())
+    s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=session["path"], UploadId=session["upload_id"])
+    s3.delete_object(Bucket=S3_BUCKET, Key=_session_key(session_id))
+    return True
+
+def purge_expired_upload_sessions():
+    # a bucket lifecycle rule (AbortIncompleteMultipartUpload) is the
+    # backstop; this also removes the session records
+    _ensure_bucket()
+    purged = 0
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=S3_BUCKET, Prefix=".uploads/"):
+        for obj in page.get("Contents", []):
+            session_id, ext = os.path.splitext(os.path.basename(obj["Key"]))
+            if ext == ".commit":
+                # claim left by a commit that died midway
+                if time.time() - obj["LastModified"].timestamp() > upload_sessions.UPLOAD_SESSION_TTL:
+                    s3.delete_object(Bucket=S3_BUCKET, Key=obj["Key"])
+            elif _load_upload_session(session_id) is None and abort_upload_session(session_id):
+                purged += 1
+    return purged
+
+def create_backup_manifest(user_id, backup_name=None, mode="auto", progress=None):
+    # full or incremental snapshot manifest under backups/<user_id>/
+    meta = backups.create_snapshot(sys.modules[__name__], user_id, backup_name, mode, progress)
+    return dict(meta, url=_object_url(meta["manifest_path"]))
+
+def restore_from_manifest(user_id, backup_name, target=None, progress=None, max_bytes=None, on_written=None):
+    # parallel, resumable restore of one of user_id's snapshots; see utils/backups.py
+    return backups.restore_snapshot(sys.modules[__name__], user_id, backup_name, target, progress,
+                                    max_bytes, on_written)
@@ -0,0 +1,56 @@
+# utils/signed_urls.py — HMAC-signed, expiring tokens for direct transfers
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+from .logger import log_warn
+
+TRANSFER_SIGNING_KEY = os.getenv("TRANSFER_SIGNING_KEY")
+TRANSFER_URL_TTL = int(os.getenv("TRANSFER_URL_TTL", "900"))
+TRANSFER_URL_MAX_TTL = int(os.getenv("TRANSFER_URL_MAX_TTL", "3600"))
+
+if not TRANSFER_SIGNING_KEY:
+    log_warn("TRANSFER_SIGNING_KEY not set; signed transfer URLs only verify in this process")
+_KEY = (TRANSFER_SIGNING_KEY or secrets.token_hex(32)).encode("utf-8")
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def clamp_ttl(expires_in):
+    try:
+        expires_in = int(expires_in or TRANSFER_URL_TTL)
+    except (TypeError, ValueError):
+        expires_in = TRANSFER_URL_TTL
+    return max(1, min(expires_in, TRANSFER_URL_MAX_TTL))
+
+def sign(path, method, expires_in=None, size=None, owner=None):
+    # token = base64(claims) "." base64(hmac-sha256(claims)); owner is the
+    # account whose quota an upload is charged to
+    claims = {"p": path, "m": method, "e": int(time.time()) + clamp_ttl(expires_in)}
+    if size is not None:
+        claims["s"] = int(size)
+    if owner is not None:
+        claims["o"] = owner
+    body = _b64(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    sig = _b64(hmac.new(_KEY, body.encode("ascii"), hashlib.sha256).digest())
+    return f"{body}.{sig}", claims["e"]
+
+def verify(token, method):
+    # returns the claims if the signature, method and expiry check out
+    body, _, sig = (token or "").partition(".")
+    expected = _b64(hmac.new(_KEY, body.encode("ascii"), hashlib.sha256).digest())
+    if not sig or not hmac.compare_digest(sig, expected):
+        return None
+    try:
+        claims = json.loads(_unb64(body))
+    except ValueError:
+        return None
+    if claims.get("m") != method or claims.get("e", 0) < time.time():
+        return None
+    return claims
@@ -6,16 +6,54 @@ USE_S3 = bool(os.getenv("S3_BUCKET"))
 if USE_S3:
     from .s3_storage import (
         save_file,
+        save_stream,
         list_files,
+        list_page,
+        iter_listing,
+        search_files,
+        dir_tree,
+        reindex,
         read_file,
+        get_local_path,
+        stat_file,
+        iter_file,
+        download_to_file,
+        copy_file,
+        delete_file,
+        delete_files,
+        create_upload_session,
+        get_upload_session,
+        put_upload_chunk,
+        commit_upload_session,
+        abort_upload_session,
+        presign_url,
         create_backup_manifest,
         restore_from_manifest
     )
 else:
     from .local_storage import (
         save_file,
+        save_stream,
         list_files,
+        list_page,
+        iter_listing,
+        search_files,
+        dir_tree,
+        reindex,
         read_file,
+        get_local_path,
+        stat_file,
+        iter_file,
+        download_to_file,
+        copy_file,
+        delete_file,
+        delete_files,
+        create_upload_session,
+        get_upload_session,
+        put_upload_chunk,
+        commit_upload_session,
+        abort_upload_session,
+        presign_url,
         create_backup_manifest,
         restore_from_manifest
     )
@@ -23,8 +61,27 @@ else:
 
 class StorageAdapter:
     save_file = staticmethod(save_file)
+    save_stream = staticmethod(save_stream)
     list_files = staticmethod(list_files)
+    list_page = staticmethod(list_page)
+    iter_listing = staticmethod(iter_listing)
+    search_files = staticmethod(search_files)
+    dir_tree = staticmethod(dir_tree)
+    reindex = staticmethod(reindex)
     read_file = staticmethod(read_file)
+    get_local_path = staticmethod(get_local_path)
+    stat_file = staticmethod(stat_file)
+    iter_file = staticmethod(iter_file)
+    download_to_file = staticmethod(download_to_file)
+    copy_file = staticmethod(copy_file)
+    delete_file = staticmethod(delete_file)
+    delete_files = staticmethod(delete_files)
+    create_upload_session = staticmethod(create_upload_session)
+    get_upload_session = staticmethod(get_upload_session)
+    put_upload_chunk = staticmethod(put_upload_chunk)
+    commit_upload_session = staticmethod(commit_upload_session)
+    abort_upload_session = staticmethod(abort_upload_session)
+    presign_url = staticmethod(presign_url)
     create_backup_manifest = staticmethod(create_backup_manifest)
     restore_from_manifest = staticmethod(restore_from_manifest)
 
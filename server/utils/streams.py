@@ -0,0 +1,60 @@
+# utils/streams.py — small file-like adapters shared by the storage adapters
+import io
+
+class IterStream(io.RawIOBase):
+    """Read-only file-like view over an iterable of byte strings.
+
+    Lets generator-produced data (concatenated upload parts, archive
+    writers, manifest encoders) feed anything that expects .read().
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            try:
+                self._buf = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+class LimitedStream(io.RawIOBase):
+    """Read-only view of `stream` that raises ValueError once more than
+    `limit` bytes have been read, so a writer consuming it fails (and
+    cleans up) before storing an oversized body."""
+
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self._remaining = limit
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # ask for one byte past the limit so overruns are seen, not truncated
+        data = self._stream.read(min(len(b), max(self._remaining, 0) + 1))
+        if not data:
+            return 0
+        self._remaining -= len(data)
+        if self._remaining < 0:
+            raise ValueError("stream exceeds its size limit")
+        b[:len(data)] = data
+        return len(data)
+
+def iter_files(paths, chunk_size):
+    # yield the concatenated contents of `paths` in bounded chunks
+    for p in paths:
+        with open(p, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
@@ -0,0 +1,74 @@
+# utils/upload_sessions.py — backend-neutral bookkeeping for resumable uploads
+import os
+import re
+import uuid
+import time
+
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+# a chunk is buffered whole on S3 (one part per chunk), so bound it
+UPLOAD_MAX_CHUNK_SIZE = int(os.getenv("UPLOAD_MAX_CHUNK_SIZE", str(64 * 1024 * 1024)))
+MAX_CHUNKS = 10000
+
+_SESSION_ID = re.compile(r"^[0-9a-f]{32}$")
+
+def valid_id(session_id):
+    return bool(_SESSION_ID.match(session_id or ""))
+
+def new_session(user_id, path, total_size, chunk_size=None):
+    try:
+        chunk_size = int(chunk_size or UPLOAD_CHUNK_SIZE)
+        total_size = int(total_size)
+    except TypeError:
+        raise ValueError("size and chunk_size must be integers")
+    if total_size < 0 or chunk_size <= 0:
+        raise ValueError("size and chunk_size must be positive")
+    if chunk_size > UPLOAD_MAX_CHUNK_SIZE:
+        raise ValueError(f"chunk_size must be at most {UPLOAD_MAX_CHUNK_SIZE} bytes")
+    session = {
+        "session_id": uuid.uuid4().hex,
+        "user_id": user_id,
+        "path": path,
+        "total_size": total_size,
+        "chunk_size": chunk_size,
+        "created_at": int(time.time()),
+        "expires_at": int(time.time()) + UPLOAD_SESSION_TTL
+    }
+    if chunk_count(session) > MAX_CHUNKS:
+        raise ValueError(f"upload would need more than {MAX_CHUNKS} chunks; use a larger chunk_size")
+    return session
+
+def chunk_count(session):
+    # an empty upload still has one (empty) chunk to PUT
+    return max(1, -(-session["total_size"] // session["chunk_size"]))
+
+def expected_chunk_size(session, index):
+    if index < 0 or index >= chunk_count(session):
+        raise ValueError(f"chunk index out of range (0..{chunk_count(session) - 1})")
+    start = index * session["chunk_size"]
+    return min(session["chunk_size"], session["total_size"] - start)
+
+def is_expired(session):
+    return time.time() > session["expires_at"]
+
+def status(session, received):
+    # received: iterable of chunk indices already stored
+    received = sorted(set(received))
+    ranges = []
+    for index in received:
+        start = index * session["chunk_size"]
+        end = start + expected_chunk_size(session, index) - 1
+        if end < start:
+            continue
+        if ranges and ranges[-1][1] + 1 == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    have = set(received)
+    return {
+        **session,
+        "chunk_count": chunk_count(session),
+        "received_chunks": len(received),
+        "received_ranges": ranges,
+        "missing_chunks": [i for i in range(chunk_count(session)) if i not in have],
+    }